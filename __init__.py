@@ -1,2 +1 @@
 from .datasets import *
-from .models import *
\ No newline at end of file
@@ -1,7 +1,7 @@
 import argparse
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     sol_init_args = parser.add_mutually_exclusive_group(required=True)
 
@@ -15,6 +15,24 @@ def parse_args():
         required=True,
         help="Index of logit to be maximized",
     )
+    parser.add_argument(
+        "--num_explanations",
+        type=int,
+        default=1,
+        help="Number of non-isomorphic explanations to collect per class from the solution pool",
+    )
+    parser.add_argument(
+        "--explain_classes",
+        type=int,
+        nargs="+",
+        help="Classes to collect explanations for (from the same encoded model), defaults to max_class",
+    )
+    parser.add_argument(
+        "--max_duplicate_cuts",
+        type=int,
+        default=1000,
+        help="Stop collecting explanations of a class after cutting off this many relabeled copies of earlier ones",
+    )
     sol_init_args.add_argument(
         "-n",
         "--num_nodes",
@@ -43,6 +61,25 @@ def parse_args():
         nargs="+",
         help="Regularizer weights, with order corresponding to the names provided to the 'regularizers' argument",
     )
+    parser.add_argument(
+        "--regularizer_encoding",
+        type=str,
+        choices=["soc", "pwl", "nonconvex"],
+        default="soc",
+        help="Encoding for regularizers: convex cones, their piecewise-linear outer approximation (needs --outer_approximation), "
+        "or the original nonconvex equalities. With soc or pwl, the Cosine similarity is discretized to --cosine_precision_bits bits",
+    )
+    parser.add_argument(
+        "--cosine_precision_bits",
+        type=int,
+        default=8,
+        help="Binaries of the discretized Cosine similarity in the soc and pwl encodings, its value is a multiple of 1 / (2^bits - 1)",
+    )
+    parser.add_argument(
+        "--outer_approximation",
+        action="store_true",
+        help="Replace quadratic terms with piecewise-linear outer approximations refined by lazy constraints",
+    )
 
     parser.add_argument(
         "--init_with_data",
@@ -52,6 +89,24 @@ def parse_args():
     sol_init_args.add_argument(
         "--init_index", type=int, help="Index of initialization graph"
     )
+    parser.add_argument(
+        "--init_with_gradient",
+        action="store_true",
+        help="Add the best explanations of the gradient-based explainer (fast_explain.py) as extra MIP starts",
+    )
+    parser.add_argument(
+        "--fast_starts",
+        type=int,
+        default=5,
+        help="Number of gradient-based explanations used as MIP starts with --init_with_gradient",
+    )
+
+    parser.add_argument(
+        "--warm_start_repair",
+        type=str,
+        choices=["project"],
+        help="How to repair warm start values that violate the bounds of a layer: clip them into the bounds (by default, raise an error)",
+    )
 
     parser.add_argument(
         "-o",
@@ -65,11 +120,139 @@ def parse_args():
         "--param_file",
         type=str,
         default="./tune0.prm",
-        help="Name of file containing solver parameters",
+        help="Name of file containing solver parameters, or 'auto' for the best parameters stored by tuning.py for this model family",
+    )
+    parser.add_argument(
+        "--param_store",
+        type=str,
+        default="results/parameters.json",
+        help="Tuned parameters of each model family, written by tuning.py and read with --param_file auto",
+    )
+    parser.add_argument(
+        "--connectivity",
+        type=str,
+        choices=["ordering", "lazy", "flow"],
+        default="ordering",
+        help="How the explanation graph is constrained to be connected",
+    )
+    parser.add_argument(
+        "--variable_size",
+        action="store_true",
+        help="Encode the network once for up to num_nodes nodes, with a binary per node that decides whether it is part of the explanation",
+    )
+    parser.add_argument(
+        "--min_nodes",
+        type=int,
+        default=1,
+        help="Smallest number of active nodes with --variable_size",
+    )
+    parser.add_argument(
+        "--size_sweep",
+        type=int,
+        nargs="+",
+        help="With --variable_size, solve the same model once for each of these numbers of nodes",
+    )
+    parser.add_argument(
+        "--edge_types",
+        action="store_true",
+        help="Add one adjacency binary per edge type (for datasets with EDGE_CLS, like MUTAG's bond types), needed for networks with RGCNConv layers",
+    )
+    parser.add_argument(
+        "--fast_only",
+        action="store_true",
+        help="Only run the gradient-based explainer (fast_explain.py) and return its explanations, without building the MIP",
+    )
+    parser.add_argument(
+        "--fast_restarts",
+        type=int,
+        default=64,
+        help="Number of random restarts of the gradient-based explainer, optimized as one batch",
+    )
+    parser.add_argument(
+        "--fast_steps",
+        type=int,
+        default=200,
+        help="Number of optimization steps of the gradient-based explainer",
+    )
+    parser.add_argument(
+        "--fast_relaxation",
+        type=str,
+        choices=["gumbel", "continuous"],
+        default="gumbel",
+        help="Relaxation of the graph in the gradient-based explainer: Gumbel-softmax samples or the softmax of the logits",
+    )
+    parser.add_argument(
+        "--relaxation_only",
+        action="store_true",
+        help="Only compute a certified upper bound on the margin from the continuous relaxation of the model, see Inverter.relaxation_bound",
+    )
+    parser.add_argument(
+        "--obbt_rounds",
+        type=int,
+        default=0,
+        help="Rounds of optimization-based bound tightening before the relaxation bound",
+    )
+    parser.add_argument(
+        "--relaxation_cache",
+        type=str,
+        default="results/relaxation_bounds.pkl",
+        help="File that caches relaxation bounds by model, number of nodes and class",
+    )
+    parser.add_argument(
+        "--time_limit",
+        type=float,
+        default=3600 * 2,
+        help="Solver time limit in seconds",
+    )
+    parser.add_argument(
+        "--simplify",
+        action="store_true",
+        help="Prune, remove dead neurons from and merge layers of the network before encoding it",
+    )
+    parser.add_argument(
+        "--simplify_budget",
+        type=float,
+        default=1e-6,
+        help="Largest total change to each neuron's output allowed when pruning weights",
+    )
+    parser.add_argument(
+        "--round_decimals",
+        type=int,
+        help="Round the simplified network's weights to this many decimals",
+    )
+    parser.add_argument(
+        "--stable_units",
+        type=str,
+        choices=["certified", "heuristic"],
+        help="Remove dead ReLU units and linearize always active ones before encoding, "
+        "certified uses propagated bounds and heuristic uses activations on the dataset",
+    )
+    parser.add_argument(
+        "--check_divergence",
+        action="store_true",
+        help="Record every layer's solver values and compare all solutions with the network after the solve",
     )
     parser.add_argument(
         "--log", action="store_true", help="Log the run with Weights & Biases"
     )
     parser.add_argument("--no-log", dest="log", action="store_false")
+    parser.add_argument(
+        "--log_backends",
+        type=str,
+        nargs="+",
+        choices=["local", "wandb"],
+        default=["wandb"],
+        help="Where to send logs when logging is enabled, local writes to results/logs/<run id>",
+    )
+    parser.add_argument(
+        "--min_figure_interval",
+        type=float,
+        default=5.0,
+        help="Minimum number of seconds between logged solution figures",
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.regularizer_encoding == "pwl" and not args.outer_approximation:
+        # Without refinement, the fixed planes are a loose relaxation and the reported regularizers would be wrong
+        parser.error("--regularizer_encoding pwl needs --outer_approximation")
+    return args
@@ -0,0 +1,75 @@
+import argparse
+import os
+import pickle
+import numpy as np
+import explain_gnn
+
+# Compares the connectivity encodings of explain_gnn.py by solve time on the same problems
+# Arguments that aren't listed below are passed on to explain_gnn.py, for example:
+#   python benchmark_connectivity.py --repeats 3 -d MUTAG -m 1 -n 8 --time_limit 600 --init_with_data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark connectivity encodings for explain_gnn.py"
+    )
+    parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        choices=["ordering", "lazy", "flow"],
+        default=["ordering", "lazy", "flow"],
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=1, help="Number of runs of each method"
+    )
+    parser.add_argument(
+        "--benchmark_output",
+        type=str,
+        default="results/benchmarks/connectivity.pkl",
+        help="Where to save the results of every run",
+    )
+    args, explain_args = parser.parse_known_args()
+
+    results = []
+    for repeat in range(args.repeats):
+        for method in args.methods:
+            print(f"=== {method} (run {repeat + 1}/{args.repeats}) ===")
+            run_data = explain_gnn.main(
+                explain_args + ["--connectivity", method, "--no-log"]
+            )
+            results.append(
+                {
+                    "method": method,
+                    "repeat": repeat,
+                    "solve_time": run_data["solve_time"],
+                    "runtime": run_data["runtime"],
+                    "model_status": run_data["model_status"],
+                    "node_count": run_data["node_count"],
+                    "mip_gap": run_data["mip_gap"],
+                    "objective": (
+                        run_data["solutions"][-1]["Objective Value"]
+                        if run_data["solutions"]
+                        else None
+                    ),
+                }
+            )
+
+    print(f"{'Method':<10}{'Solve Time':>12}{'Nodes':>12}{'MIP Gap':>10}")
+    for method in args.methods:
+        runs = [result for result in results if result["method"] == method]
+        print(
+            f"{method:<10}"
+            f"{np.mean([run['solve_time'] for run in runs]):>12.2f}"
+            f"{np.mean([run['node_count'] for run in runs]):>12.0f}"
+            f"{np.mean([run['mip_gap'] for run in runs]):>10.4f}"
+        )
+
+    os.makedirs(os.path.dirname(args.benchmark_output) or ".", exist_ok=True)
+    with open(args.benchmark_output, "wb") as f:
+        pickle.dump(results, f)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
-import pickle
 import os
 from .dataset import GraphDataset
+from .graph_store import GraphStore
 
 
 class Is_Acyclic_Ones_dataset(GraphDataset):
@@ -10,8 +10,10 @@ class Is_Acyclic_Ones_dataset(GraphDataset):
     }
 
     def get_data(self):
-        dataset = pickle.load(
-            open(os.path.join(self.root, "Is_Acyclic_Ones/dataset.pkl"), "rb")
+        # The pickled dataset is converted to a memory-mapped store the first time it is loaded
+        dataset = GraphStore.load_or_convert(
+            os.path.join(self.root, "Is_Acyclic_Ones/dataset.pkl"),
+            os.path.join(self.root, "Is_Acyclic_Ones/store"),
         )
         return dataset
 
@@ -1,5 +1,4 @@
 from .dataset import GraphDataset
-from torch_geometric.datasets import TUDataset
 import os
 
 
@@ -47,5 +46,7 @@ class MUTAG_dataset(GraphDataset):
         super().__init__(*args, **kwargs)
 
     def get_data(self):
+        from torch_geometric.datasets import TUDataset
+
         dataset = TUDataset(root=os.path.join(self.root, "TUDataset"), name="MUTAG")
         return dataset
@@ -1,15 +1,20 @@
 from .MUTAG import MUTAG_dataset
 from .Shapes_Ones import Shapes_Ones_dataset
 from .Is_Acyclic_Ones import Is_Acyclic_Ones_dataset
+from .graph_store import GraphStore
 
+DATASETS = {
+    "MUTAG": MUTAG_dataset,
+    "Shapes_Ones": Shapes_Ones_dataset,
+    "Is_Acyclic_Ones": Is_Acyclic_Ones_dataset,
+}
 
-def get_dataset(name):
-    if name == "MUTAG":
-        dataset = MUTAG_dataset()
-    elif name == "Shapes_Ones":
-        dataset = Shapes_Ones_dataset()
-    elif name == "Is_Acyclic_Ones":
-        dataset = Is_Acyclic_Ones_dataset()
-    else:
+
+def get_dataset_class(name):
+    if name not in DATASETS:
         raise ValueError(f"No dataset with the name '{name}' was found")
-    return dataset
+    return DATASETS[name]
+
+
+def get_dataset(name):
+    return get_dataset_class(name)()
@@ -1,15 +1,14 @@
 # Modified from https://github.com/yolandalalala/GNNInterpreter/blob/main/gnninterpreter/datasets/base_graph_dataset.py
 
 import torch
-from torch_geometric.utils import to_networkx
 from torch_geometric.data import DataLoader
-import networkx as nx
 import pickle
 from abc import ABC, abstractmethod
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
 import random
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from .graph_store import GraphStore
 
 
 class Dataset(torch.utils.data.Dataset, ABC):
@@ -21,8 +20,12 @@ class Dataset(torch.utils.data.Dataset, ABC):
         self._seed_all(seed)
         self.data = self.get_data()
 
-        self.ys = [int(d.y) for d in self.data]
-        self.num_classes = len(set(self.ys))
+        # Stores keep the labels in their own array, so the graphs don't need to be materialized
+        if isinstance(self.data, GraphStore):
+            self.ys = np.asarray(self.data.y)
+        else:
+            self.ys = np.array([int(d.y) for d in self.data])
+        self.num_classes = len(np.unique(self.ys))
 
     @abstractmethod
     def get_data(self, data_dir):
@@ -69,7 +72,7 @@ class Dataset(torch.utils.data.Dataset, ABC):
         return len(self.data)
 
     def __getitem__(self, key):
-        if isinstance(key, int):
+        if isinstance(key, (int, np.integer)):
             return self.data[key]
         elif type(key) == tuple and len(key) == 2:
             pass
@@ -83,6 +86,107 @@ class GraphDataset(Dataset):
         super().__init__(*args, **kwargs)
         self.num_node_features = self.data[0].num_node_features
         self.num_edge_features = self.data[0].num_edge_features
+        self._graph_attributes = None
+        self._index = None
+        self._logits = dict()
+
+    def get_concatenated_graphs(self):
+        # Returns node offsets and edge indices of all graphs, with edge indices shifted by their graph's node offset
+        if isinstance(self.data, GraphStore):
+            node_ptr = np.asarray(self.data.node_ptr)
+            edge_offsets = np.repeat(node_ptr[:-1], self.data.num_edges)
+            return node_ptr, np.asarray(self.data.edge_index) + edge_offsets
+        node_ptr, edge_indices = [0], []
+        for data in self:
+            edge_indices.append(data.edge_index.numpy() + node_ptr[-1])
+            node_ptr.append(node_ptr[-1] + data.num_nodes)
+        return np.array(node_ptr, dtype=np.int64), np.concatenate(edge_indices, axis=1)
+
+    def get_graph_attributes(self):
+        # Per-graph attributes, computed once for the whole dataset as a disjoint union of all graphs
+        if self._graph_attributes is not None:
+            return self._graph_attributes
+        node_ptr, edge_index = self.get_concatenated_graphs()
+        num_graphs, total_nodes = len(node_ptr) - 1, node_ptr[-1]
+        num_nodes = np.diff(node_ptr)
+        graph_of_node = np.repeat(np.arange(num_graphs), num_nodes)
+
+        adjacency = coo_matrix(
+            (np.ones(edge_index.shape[1]), (edge_index[0], edge_index[1])),
+            shape=(total_nodes, total_nodes),
+        )
+        _, component = connected_components(adjacency, directed=False)
+        # Components never span graphs, so count the distinct components within each graph
+        _, first_nodes = np.unique(component, return_index=True)
+        num_components = np.bincount(graph_of_node[first_nodes], minlength=num_graphs)
+
+        degrees = np.bincount(edge_index[0], minlength=total_nodes)
+        nonempty = num_nodes > 0
+        max_degree = np.zeros(num_graphs, dtype=degrees.dtype)
+        max_degree[nonempty] = np.maximum.reduceat(degrees, node_ptr[:-1][nonempty])
+        num_edges = np.bincount(graph_of_node[edge_index[0]], minlength=num_graphs)
+
+        self._graph_attributes = {
+            "num_nodes": num_nodes,
+            "num_edges": num_edges,
+            "connected": num_components == 1,
+            "max_degree": max_degree,
+            "mean_degree": np.divide(
+                num_edges, num_nodes, out=np.zeros(num_graphs), where=nonempty
+            ),
+        }
+        return self._graph_attributes
+
+    def get_index(self):
+        # Maps (class, number of nodes) to the indices of the matching graphs
+        if self._index is None:
+            num_nodes = self.get_graph_attributes()["num_nodes"]
+            keys, inverse = np.unique(
+                np.stack([self.ys, num_nodes], axis=1), axis=0, return_inverse=True
+            )
+            order = np.argsort(inverse.ravel(), kind="stable")
+            groups = np.split(order, np.cumsum(np.bincount(inverse.ravel()))[:-1])
+            self._index = {
+                (int(y), int(n)): group for (y, n), group in zip(keys, groups)
+            }
+        return self._index
+
+    def select_graphs(self, y=None, num_nodes=None, connected=None):
+        # Indices of graphs with the given class, number of nodes and connectivity (None matches anything)
+        if y is not None and num_nodes is not None:
+            indices = self.get_index().get((y, num_nodes), np.array([], dtype=int))
+        else:
+            attributes = self.get_graph_attributes()
+            mask = np.ones(len(self), dtype=bool)
+            if y is not None:
+                mask &= self.ys == y
+            if num_nodes is not None:
+                mask &= attributes["num_nodes"] == num_nodes
+            indices = np.nonzero(mask)[0]
+        if connected is not None:
+            indices = indices[
+                self.get_graph_attributes()["connected"][indices] == connected
+            ]
+        return indices
+
+    @torch.no_grad()
+    def get_logits(self, nn, batch_size=256):
+        # Model outputs for every graph in the dataset, cached per model
+        if id(nn) not in self._logits:
+            nn.eval()
+            self._logits[id(nn)] = (
+                torch.cat([nn(batch) for batch in self.loader(batch_size=batch_size)])
+                .detach()
+                .numpy()
+            )
+        return self._logits[id(nn)]
+
+    def rank_graphs(self, nn, y, indices=None):
+        # Sorts graphs (all of them, or the given indices) by the margin of logit y over the largest other logit, best first
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        logits = self.get_logits(nn)[indices]
+        margins = logits[:, y] - np.delete(logits, y, axis=1).max(axis=1)
+        return indices[np.argsort(-margins, kind="stable")]
 
     def loader(self, *args, **kwargs):
         return DataLoader(self, *args, **kwargs)
@@ -105,6 +209,11 @@ class GraphDataset(Dataset):
         with_labels=True,
         **kwargs,
     ):
+        # Plotting libraries are only imported when drawing
+        import networkx as nx
+        import matplotlib.pyplot as plt
+        from torch_geometric.utils import to_networkx
+
         if isinstance(A, torch.Tensor):
             A = A.detach().numpy()
         if isinstance(X, torch.Tensor):
@@ -135,9 +244,7 @@ class GraphDataset(Dataset):
                 x_indices = np.argmax(X, axis=1)
 
             if hasattr(self, "NODE_CLS"):
-                labels = (
-                    dict(zip(range(X.shape[0]), map(self.NODE_CLS.get, x_indices)))
-                )
+                labels = dict(zip(range(X.shape[0]), map(self.NODE_CLS.get, x_indices)))
             else:
                 labels = None
 
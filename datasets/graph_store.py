@@ -0,0 +1,138 @@
+import argparse
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import torch
+from torch_geometric.data import Data
+
+
+class GraphStore:
+    # Compact on-disk storage for a list of graphs: node features, edge indices and edge attributes of all graphs are concatenated,
+    # and node_ptr/edge_ptr hold the offsets where each graph starts. Arrays are memory-mapped and Data objects are only built on access.
+    # Edge indices are stored relative to the first node of their graph.
+    # A store is written to a temporary directory and renamed into place, with a marker file written last, so an interrupted
+    # conversion never looks complete.
+
+    COMPLETE_MARKER = "complete"
+
+    def __init__(self, path):
+        self.path = path
+        self.x = self._load("x")
+        self.edge_index = self._load("edge_index")
+        self.node_ptr = self._load("node_ptr")
+        self.edge_ptr = self._load("edge_ptr")
+        self.y = self._load("y")
+        self.edge_attr = (
+            self._load("edge_attr")
+            if os.path.exists(os.path.join(path, "edge_attr.npy"))
+            else None
+        )
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, cls.COMPLETE_MARKER))
+
+    @classmethod
+    def is_stale(cls, pickle_path, path):
+        # The store is older than the pickle it was converted from
+        return os.path.exists(pickle_path) and os.path.getmtime(
+            pickle_path
+        ) > os.path.getmtime(os.path.join(path, cls.COMPLETE_MARKER))
+
+    @classmethod
+    def from_data_list(cls, data_list, path):
+        # Writes the graphs in data_list to path (replacing any store there) and returns the store
+        path = os.path.normpath(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        data_list = list(data_list)
+        num_nodes = [data.num_nodes for data in data_list]
+        num_edges = [data.edge_index.shape[1] for data in data_list]
+        arrays = {
+            "x": np.concatenate([data.x.numpy() for data in data_list]),
+            "edge_index": np.concatenate(
+                [data.edge_index.numpy() for data in data_list], axis=1
+            ).astype(np.int64),
+            "node_ptr": np.concatenate([[0], np.cumsum(num_nodes)]).astype(np.int64),
+            "edge_ptr": np.concatenate([[0], np.cumsum(num_edges)]).astype(np.int64),
+            "y": np.array([int(data.y) for data in data_list], dtype=np.int64),
+        }
+        if data_list and data_list[0].edge_attr is not None:
+            arrays["edge_attr"] = np.concatenate(
+                [data.edge_attr.numpy() for data in data_list]
+            )
+        tmp_path = tempfile.mkdtemp(
+            prefix=f".{os.path.basename(path)}_", dir=os.path.dirname(path) or "."
+        )
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+            open(os.path.join(tmp_path, cls.COMPLETE_MARKER), "w").close()
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        return cls(path)
+
+    @classmethod
+    def from_pickle(cls, pickle_path, path):
+        # Converts a pickled list of Data objects
+        with open(pickle_path, "rb") as f:
+            data_list = pickle.load(f)
+        return cls.from_data_list(data_list, path)
+
+    @classmethod
+    def load_or_convert(cls, pickle_path, path):
+        # Converts the pickle if there is no complete store yet, or if the pickle changed since the conversion
+        if not cls.exists(path) or cls.is_stale(pickle_path, path):
+            return cls.from_pickle(pickle_path, path)
+        return cls(path)
+
+    @property
+    def num_nodes(self):
+        return np.diff(self.node_ptr)
+
+    @property
+    def num_edges(self):
+        return np.diff(self.edge_ptr)
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        node_start, node_end = self.node_ptr[idx], self.node_ptr[idx + 1]
+        edge_start, edge_end = self.edge_ptr[idx], self.edge_ptr[idx + 1]
+        data = Data(
+            x=torch.from_numpy(np.array(self.x[node_start:node_end])),
+            edge_index=torch.from_numpy(
+                np.array(self.edge_index[:, edge_start:edge_end])
+            ),
+            y=torch.tensor([self.y[idx]]),
+        )
+        if self.edge_attr is not None:
+            data.edge_attr = torch.from_numpy(
+                np.array(self.edge_attr[edge_start:edge_end])
+            )
+        return data
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a pickled list of PyTorch Geometric graphs to a GraphStore"
+    )
+    parser.add_argument("pickle_path", type=str, help="Path to the pickled dataset")
+    parser.add_argument("path", type=str, help="Directory to write the store to")
+    args = parser.parse_args()
+    store = GraphStore.from_pickle(args.pickle_path, args.path)
+    print(f"Wrote {len(store)} graphs to {args.path}")
@@ -0,0 +1,280 @@
+import argparse
+import multiprocessing
+import os
+import pickle
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations
+from math import comb
+import numpy as np
+import gurobipy as gp
+from gurobipy import GRB
+import explain_gnn
+from tuning import solver_params
+
+# Splits the explanation MIP of a categorical-feature dataset (like MUTAG) by the number of nodes of each type, and solves the parts in parallel
+# Every subproblem fixes the feature counts through variable bounds, on copies of one model read from an MPS file by a process pool
+# Subproblems are solved best relaxation bound first, with a shared incumbent that cuts off and stops the ones that can't improve on it
+# Arguments that aren't listed below are passed on to explain_gnn.py, for example:
+#   python decompose.py --workers 8 -d MUTAG -m 1 -n 8 --connectivity flow --time_limit 600
+
+TOLERANCE = 1e-6
+
+# State of each worker process, set once by init_worker
+_worker = dict()
+
+
+def feature_count_vectors(num_features, sizes, max_vectors=None, seed=None):
+    # Every way to split each number of nodes in sizes into num_features counts, or a random sample of max_vectors of them
+    num_vectors = sum(comb(size + num_features - 1, num_features - 1) for size in sizes)
+    vectors = [
+        np.diff((-1,) + bars + (size + num_features - 1,)) - 1
+        for size in sizes
+        for bars in combinations(range(size + num_features - 1), num_features - 1)
+    ]
+    if max_vectors is not None and num_vectors > max_vectors:
+        vectors = random.Random(seed).sample(vectors, max_vectors)
+    return vectors
+
+
+def relaxation_bounds(inverter, counts, vectors):
+    # Upper bound on the objective of each subproblem, from one continuous relaxation of the model with the counts changed through their bounds
+    # Also returns the bound with the counts free, which holds for every subproblem (sampled or not)
+    inverter.model.update()
+    all_vars = inverter.model.getVars()
+    relaxed = inverter.build_relaxation(
+        np.array(inverter.model.getAttr("LB", all_vars)),
+        np.array(inverter.model.getAttr("UB", all_vars)),
+    )
+    relaxed.Params.OutputFlag = 0
+    relaxed_vars = relaxed.getVars()
+    relaxed_counts = [relaxed_vars[var.index] for var in counts.tolist()]
+
+    def bound(lb, ub):
+        relaxed.setAttr("LB", relaxed_counts, lb)
+        relaxed.setAttr("UB", relaxed_counts, ub)
+        relaxed.optimize()
+        if relaxed.Status == GRB.OPTIMAL:
+            return relaxed.ObjVal
+        elif relaxed.Status == GRB.INFEASIBLE:
+            return float("-inf")
+        return float("inf")
+
+    bounds = [bound(vector.tolist(), vector.tolist()) for vector in vectors]
+    free_bound = bound(counts.getAttr("LB").tolist(), counts.getAttr("UB").tolist())
+    relaxed.dispose()
+    return bounds, free_bound
+
+
+def init_worker(model_file, count_indices, input_indices, incumbent, params):
+    env = gp.Env(params={"OutputFlag": 0})
+    model = gp.read(model_file, env=env)
+    for param_name, param_value in params.items():
+        model.setParam(param_name, param_value)
+    model_vars = model.getVars()
+    _worker.update(
+        model=model,
+        env=env,
+        counts=[model_vars[i] for i in count_indices],
+        inputs={
+            name: (indices.shape, [model_vars[i] for i in indices.flatten()])
+            for name, indices in input_indices.items()
+        },
+        incumbent=incumbent,
+    )
+
+
+def solve_subproblem(vector, relaxation_bound):
+    # Solves the subproblem with the feature counts in vector, unless its relaxation bound can't beat the shared incumbent
+    model, incumbent = _worker["model"], _worker["incumbent"]
+    result = {"Counts": vector, "Relaxation Bound": relaxation_bound}
+    if relaxation_bound <= incumbent.value + TOLERANCE:
+        return result | {"Status": "Pruned", "Upper Bound": relaxation_bound}
+
+    def callback(model, where):
+        if where == GRB.Callback.MIPSOL:
+            objective = model.cbGet(GRB.Callback.MIPSOL_OBJ)
+            with incumbent.get_lock():
+                if objective > incumbent.value:
+                    incumbent.value = objective
+        elif where == GRB.Callback.MIP:
+            # Another subproblem found a solution at least as good as anything left here
+            if model.cbGet(GRB.Callback.MIP_OBJBND) <= incumbent.value + TOLERANCE:
+                model.terminate()
+
+    model.setAttr("LB", _worker["counts"], vector.tolist())
+    model.setAttr("UB", _worker["counts"], vector.tolist())
+    model.Params.Cutoff = max(incumbent.value, -GRB.INFINITY)
+    model.optimize(callback)
+
+    result["Status"] = model.Status
+    result["Runtime"] = model.Runtime
+    if model.Status in [GRB.INFEASIBLE, GRB.CUTOFF]:
+        result["Upper Bound"] = min(incumbent.value, relaxation_bound)
+    else:
+        result["Upper Bound"] = min(model.ObjBound, relaxation_bound)
+    if model.SolCount > 0:
+        result["Objective"] = model.ObjVal
+        result["Inputs"] = {
+            name: np.array(model.getAttr("X", var_list)).reshape(shape)
+            for name, (shape, var_list) in _worker["inputs"].items()
+        }
+    return result
+
+
+def decompose(
+    inverter,
+    num_features,
+    workers=None,
+    threads_per_worker=None,
+    max_subproblems=None,
+    seed=None,
+    **kwargs,
+):
+    # Returns the best explanation over all subproblems, a certified upper bound on the objective, and the result of every subproblem
+    # kwargs are solver parameters for every subproblem, the model file the workers read doesn't carry the parameters of inverter.model
+    if inverter.has_lazy_relations():
+        raise ValueError(
+            "Lazy constraints live in the main process, use a connectivity encoding without them and no outer approximation"
+        )
+    workers = workers or os.cpu_count()
+    threads_per_worker = threads_per_worker or max(os.cpu_count() // workers, 1)
+    m = inverter.model
+
+    # counts[k] is the number of nodes with feature k, fixing it fixes the multiset of node types
+    X = inverter.input_vars["X"]
+    counts = m.addMVar(
+        (num_features,), lb=0, ub=X.shape[0], vtype=GRB.INTEGER, name="feature_counts"
+    )
+    m.addConstr(counts == X.sum(axis=0), name="feature_counts_constraint")
+    m.update()
+    if inverter.node_mask_name is None:
+        sizes = [X.shape[0]]
+    else:
+        sizes = range(inverter.min_nodes, X.shape[0] + 1)
+    vectors = feature_count_vectors(num_features, sizes, max_subproblems, seed)
+    sampled = len(vectors) < sum(
+        comb(size + num_features - 1, num_features - 1) for size in sizes
+    )
+
+    bounds, free_bound = relaxation_bounds(inverter, counts, vectors)
+    tasks = sorted(
+        [
+            (vector, bound)
+            for vector, bound in zip(vectors, bounds)
+            if bound > float("-inf")
+        ],
+        key=lambda task: -task[1],
+    )
+    print(
+        f"{len(vectors)} subproblems, {len(vectors) - len(tasks)} infeasible in the relaxation"
+    )
+
+    input_indices = {
+        name: np.array([v.index for v in var.reshape(-1).tolist()]).reshape(var.shape)
+        for name, var in inverter.input_vars.items()
+    }
+    context = multiprocessing.get_context("spawn")
+    incumbent = context.Value("d", float("-inf"))
+    params = kwargs | {"Threads": threads_per_worker}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_file = os.path.join(tmp_dir, f"{inverter.model_name}.mps")
+        m.write(model_file)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(
+                model_file,
+                [var.index for var in counts.tolist()],
+                input_indices,
+                incumbent,
+                params,
+            ),
+        ) as executor:
+            futures = [executor.submit(solve_subproblem, *task) for task in tasks]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(
+                    f"[{len(results)}/{len(tasks)}] counts {result['Counts'].tolist()}: status {result['Status']}, incumbent {incumbent.value}"
+                )
+
+    solved = [result for result in results if "Objective" in result]
+    best = max(solved, key=lambda result: result["Objective"], default=None)
+    # Pruned and stopped subproblems can't beat the incumbent, so the best solution is optimal up to the open subproblems' bounds
+    # Subproblems that weren't sampled are only bounded by the relaxation with free counts
+    upper_bounds = [incumbent.value] + [result["Upper Bound"] for result in results]
+    if sampled:
+        upper_bounds.append(free_bound)
+    return {
+        "Best": best,
+        "Objective": best["Objective"] if best else None,
+        "Upper Bound": max(upper_bounds),
+        "Sampled": sampled,
+        "Subproblems": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Solve explain_gnn.py in parallel, split by the number of nodes of each type"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes (by default, one per core)",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        help="Solver threads of each worker (by default, the cores split evenly)",
+    )
+    parser.add_argument(
+        "--max_subproblems",
+        type=int,
+        help="Solve a random sample of this many feature count vectors if there are more",
+    )
+    parser.add_argument("--seed", type=int, help="Seed of the sample of subproblems")
+    parser.add_argument(
+        "--decompose_output",
+        type=str,
+        default="results/decompose.pkl",
+        help="Where to save the best explanation and the result of every subproblem",
+    )
+    args, explain_argv = parser.parse_known_args(argv)
+    explain_args = explain_gnn.parse_args(explain_argv)
+    if explain_gnn.NODE_FEATURES.get(explain_args.dataset_name) != "categorical":
+        raise ValueError(
+            f"{explain_args.dataset_name} doesn't have categorical node features"
+        )
+
+    env = gp.Env(logfilename="")
+    inverter, dataset, _ = explain_gnn.build_explanation_model(explain_args, env)
+    result = decompose(
+        inverter,
+        dataset.num_node_features,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        max_subproblems=args.max_subproblems,
+        seed=args.seed,
+        **solver_params(explain_args),
+        TimeLimit=explain_args.time_limit,
+    )
+    if result["Best"] is not None:
+        inputs = result["Best"]["Inputs"]
+        result["Best"]["Output"] = (
+            inverter.nn(**inverter.convert_inputs(**inputs)).detach().numpy()
+        )
+    print(f"Objective: {result['Objective']}, Upper Bound: {result['Upper Bound']}")
+
+    os.makedirs(os.path.dirname(args.decompose_output) or ".", exist_ok=True)
+    with open(args.decompose_output, "wb") as f:
+        pickle.dump(result, f)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -301,6 +301,12 @@ def main():
         default=False,
         help="For Saving the current nn",
     )
+    parser.add_argument(
+        "--stable-units",
+        action="store_true",
+        default=False,
+        help="Remove ReLU units that are dead on the training set and linearize always active ones",
+    )
     args = parser.parse_args()
     use_cuda = not args.no_cuda and torch.cuda.is_available()
     use_mps = not args.no_mps and torch.backends.mps.is_available()
@@ -338,6 +344,24 @@ def main():
     nn.eval()
     nn.to(torch.float64)
     prune_weights_below_threshold(nn, 1e-5)
+    from simplify import fold_batch_norm
+
+    with torch.no_grad():
+        nn.layers, _ = fold_batch_norm(nn.layers)
+    if args.stable_units and not args.load:
+        # Bounds can't be propagated through the convolutions, so stable units come from the training set activations
+        from simplify import activation_statistics, prune_stable_units, stable_units
+
+        batches = (
+            X
+            for X, _ in torch.utils.data.DataLoader(
+                dataset1, batch_size=args.test_batch_size
+            )
+        )
+        nn, report = prune_stable_units(
+            nn, stable_units(nn.layers, statistics=activation_statistics(nn, batches))
+        )
+        print("Stable Units (heuristic):", report)
 
     # summary(nn, input_size=dataset1[0][0].shape)
 
@@ -346,42 +370,15 @@ def main():
     inverter = Inverter(args, nn, dataset1, env)
 
     if args.load:
-        inverter.load_model()
-        # TODO: Ensure correct row
-        X = inverter.get_mvar("X", shape=(1, 1, 28, 28))
-        inverter.set_input_vars({"X": X})
-        inverter.load_inverter()
-        inverter.m.update()
+        inverter.load_inverter(input_shapes={"X": (1, 1, 28, 28)})
+        X = inverter.input_vars["X"]
     else:
         X = inverter.m.addMVar(
             (1, 1, 28, 28), lb=-3, ub=3, vtype=GRB.CONTINUOUS, name="X"
         )
         inverter.set_input_vars({"X": X})
-        previous_layer_output = X
-
-        # previous_layer_output = inverter.output_vars["conv2_ReLU"]
-        for name, layer in nn.layers.items():
-            # if "conv" in name:
-            #     continue
-            # if name == "fc1":
-            #     breakpoint()
-            print("Working on layer", name)
-            if isinstance(layer, torch.nn.Dropout):
-                continue
-            try:
-                previous_layer_output = invert_utils.invert_torch_layer(
-                    inverter.model,
-                    layer,
-                    name=name,
-                    X=previous_layer_output,
-                )
-            except Exception as e:
-                print(e)
-                breakpoint()
-            print("Output Shape:", previous_layer_output.shape)
-            inverter.output_vars[name] = previous_layer_output
-
-        inverter.save_model()
+        # Modules that are the identity at evaluation time, like the dropout layers, are encoded as no-ops
+        inverter.encode_network(X)
 
         inverter.save_inverter()
 
@@ -1,54 +1,50 @@
-import torch
-import gurobipy as gp
-from gurobipy import GRB
-from torch_geometric.utils import to_dense_adj, dense_to_sparse
-from torch_geometric.data import Data
-import networkx as nx
+import time
+
+_process_start_time = time.perf_counter()
+
 import os
 import pickle
-import matplotlib.pyplot as plt
-from torch_geometric.utils import to_networkx
+import random
+import uuid
+from functools import partial
+import numpy as np
+import gurobipy as gp
+from gurobipy import GRB
 from arg_parser import parse_args
-from datasets import get_dataset
 from inverter import Inverter, ObjectiveTerm
 import invert_utils
-import numpy as np
-import random
-from gnn import GNN  # noqa: F401
-import time
-
-args = parse_args()
-
-dataset_name = args.dataset_name
-model_path = args.model_path
-max_class = args.max_class
-output_file = args.output_file
-sim_weights = dict(zip(args.regularizers, args.regularizer_weights))
-sim_methods = args.regularizers
-num_nodes = args.num_nodes
-device = (
-    args.device
-    if args.device is not None
-    else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+from graph_hash import wl_hash
+from run_logging import (
+    ExperimentLogger,
+    GraphDrawer,
+    LocalFileBackend,
+    WandbBackend,
 )
 
-if not model_path:
-    model_path = f"models/{dataset_name}_model.pth"
-
-# torch.manual_seed(12345)
-# TODO: Seed for Gurobi
-
-if not os.path.isdir("solutions"):
-    os.mkdir("solutions")
+# torch, PyG, datasets, plotting and logging are imported where they are used, so importing this module is cheap
+_import_time = time.perf_counter() - _process_start_time
 
-dataset = get_dataset(dataset_name)
-num_node_features = dataset.num_node_features
+# How the node features of each dataset's explanations are constrained: one-hot categories, node degrees, or all ones
+NODE_FEATURES = {
+    "MUTAG": "categorical",
+    "OurMotifs": "categorical",
+    "Is_Acyclic": "degree",
+    "Shapes": "degree",
+    "Shapes_Clean": "degree",
+    "Shapes_Ones": "ones",
+    "Is_Acyclic_Ones": "ones",
+}
 
 
 def canonicalize_graph(graph):
     # This function will reorder the nodes of a given graph (PyTorch Geometric "Data" Object) to a canonical (maybe) version
+    import torch
+    import networkx as nx
+    from torch_geometric.utils import to_dense_adj, to_networkx
 
-    G = to_networkx(init_graph)
+    # Edge attributes (like bond types) are carried along with their edges
+    has_edge_attr = graph.edge_attr is not None
+    G = to_networkx(graph, edge_attrs=["edge_attr"] if has_edge_attr else None)
 
     # TODO: Generalize to non one-hot vector node features
     # Lexicographic ordering of node features (one-hot)
@@ -86,189 +82,192 @@ def canonicalize_graph(graph):
 
     graph.x = graph.x[sorted_nodes, :]
     graph.edge_index = torch.Tensor(list(G.edges)).to(torch.int64).T
+    if has_edge_attr:
+        graph.edge_attr = torch.Tensor(
+            [attrs["edge_attr"] for _, _, attrs in G.edges(data=True)]
+        )
 
 
-# Load the model
-nn = torch.load(model_path, fix_imports=True, map_location=device)
-nn.device = device
-nn.eval()
-nn.to(torch.float64)
+def dense_edge_types(graph, num_relations):
+    # Stacked adjacency matrices of each edge type, with shape (num_relations, n, n), from the one-hot edge attributes of a graph
+    # Graphs without edge attributes only have edges of the first type
+    import torch
+    from torch_geometric.utils import to_dense_adj
 
-# Track hyperparameters
-if args.log:
-    import wandb
+    edge_attr = graph.edge_attr
+    if edge_attr is None:
+        edge_attr = torch.nn.functional.one_hot(
+            torch.zeros(graph.edge_index.shape[1], dtype=torch.int64), num_relations
+        )
+    return to_dense_adj(
+        graph.edge_index, edge_attr=edge_attr.double(), max_num_nodes=graph.num_nodes
+    )[0].permute(2, 0, 1)
 
-    wandb.login()
-    config = {
-        "architecture": str(nn),
-        "model_path": model_path,
+
+def get_start_values(args, graph, num_nodes, num_relations=None):
+    # Start values of the input variables for a graph, padded with inactive nodes up to num_nodes with --variable_size
+    import torch
+    from torch_geometric.utils import to_dense_adj
+
+    values = {
+        "X": graph.x,
+        "A": to_dense_adj(graph.edge_index, max_num_nodes=graph.num_nodes)[0],
     }
-    config.update(vars(args))
-    wandb.init(
-        project="GNN-Inverter",
-        config=config,
-    )
-    wandb.save(args.param_file, policy="now")
-    wandb.save(output_file, policy="end")
-    wandb.run.log_code(".")
-
-print("Args:", args)
-print("Device:", device)
-print("Number of Classes", dataset.num_classes)
-print("Number of Node Features", num_node_features)
-
-# # Max nn Output Logit for each class in the dataset
-# max_logits = [0] * dataset.num_classes
-# for i, graph in enumerate(dataset):
-#     logits = nn(graph).detach().numpy().squeeze()
-#     for j, logit in enumerate(logits):
-#         if logit > max_logits[j]:
-#             max_logits[j] = logit
-# print("Max Logits:", max_logits)
-
-if args.init_with_data:
-    # Initialize with a graph from the dataset
-    if args.init_index is not None:
-        print(f"Initializing from dataset with graph at index {args.init_index}")
-        init_graph = dataset[args.init_index]
-    elif num_nodes is not None:
-        print(f"Initializing from dataset graph with {num_nodes} nodes")
-        init_graph = random.choice(
-            [d for d in dataset if int(d.y) == max_class and d.num_nodes == num_nodes]
-        )
-    A = to_dense_adj(init_graph.edge_index).detach().numpy().squeeze()
-    print(
-        "Connected before reordering:",
-        all(
-            [
-                sum(A[i][j] + A[j][i] for j in range(i + 1, A.shape[0])) >= 1
-                for i in range(A.shape[0] - 1)
-            ]
-        ),
+    if num_relations is not None:
+        values["A_rel"] = dense_edge_types(graph, num_relations)
+    if args.variable_size:
+        padding = num_nodes - graph.num_nodes
+        values = {
+            name: torch.nn.functional.pad(
+                value, (0, 0, 0, padding) if name == "X" else (0, padding, 0, padding)
+            )
+            for name, value in values.items()
+        }
+        values["active"] = (torch.arange(num_nodes) < graph.num_nodes).double()
+    return values
+
+
+def get_fast_explanations(args, nn, dataset, num_nodes, num_explanations=None):
+    # Gradient-based explanations of args.max_class with all num_nodes nodes, see fast_explain.py
+    from fast_explain import fast_explain
+
+    regularizers = dict(zip(args.regularizers or [], args.regularizer_weights))
+    return fast_explain(
+        nn,
+        num_nodes,
+        dataset.num_node_features,
+        args.max_class,
+        features=NODE_FEATURES[args.dataset_name],
+        num_relations=len(dataset.EDGE_CLS) if args.edge_types else None,
+        restarts=args.fast_restarts,
+        steps=args.fast_steps,
+        relaxation=args.fast_relaxation,
+        phi=dataset.get_average_phi(nn, "Aggregation") if regularizers else None,
+        regularizers=regularizers,
+        num_explanations=num_explanations,
+        convert_inputs=convert_inputs,
+        solution_hash=solution_key,
     )
 
-    A = to_dense_adj(init_graph.edge_index).detach().numpy().squeeze()
-    assert all(
-        [
-            sum(A[i][j] + A[j][i] for j in range(i + 1, A.shape[0])) >= 1
-            for i in range(A.shape[0] - 1)
-        ]
-    ), "Initialization graph was not connected"
-
-    num_nodes = init_graph.num_nodes
-
-else:
-    # Initialize with a dummy graph
-    # By default, will generate a line graph with uniform random node features
-    print("Initializing with dummy graph")
-    # init_graph_adj = np.clip(init_graph_adj + np.eye(num_nodes, k=1), a_min=0, a_max=1)
-    # init_graph_adj = torch.diag_embed(
-    #     torch.diag(torch.ones((num_nodes, num_nodes)), diagonal=-1), offset=-1
-    # ) + torch.diag_embed(
-    #     torch.diag(torch.ones((num_nodes, num_nodes)), diagonal=1), offset=1
-    # )
-    ## Randomly initialized adjacency matrix of a connected graph
-    init_graph_adj = torch.randint(0, 2, (num_nodes, num_nodes))
-    init_graph_adj = torch.triu(init_graph_adj, diagonal=1)
-    init_graph_adj = init_graph_adj + init_graph_adj.T
-    init_graph_adj = torch.clip(init_graph_adj, 0, 1)
-    init_graph_adj = init_graph_adj.numpy()
-    init_graph_adj = np.clip(init_graph_adj + np.eye(num_nodes, k=1), a_min=0, a_max=1)
-    init_graph_adj = np.clip(init_graph_adj + np.eye(num_nodes, k=-1), a_min=0, a_max=1)
-    init_graph_adj = torch.Tensor(init_graph_adj)
-
-    if dataset_name in ["Is_Acyclic", "Shapes", "Shapes_Clean"]:
-        init_graph_x = torch.unsqueeze(torch.sum(init_graph_adj, dim=-1), dim=-1)
-    elif dataset_name in ["MUTAG", "OurMotifs"]:
-        # init_graph_x = torch.eye(num_node_features)[torch.randint(num_node_features, (num_nodes,)),:]
-        init_graph_x = torch.eye(num_node_features)[torch.randint(1, (num_nodes,)), :]
-    elif dataset_name in ["Shapes_Ones", "Is_Acyclic_Ones"]:
-        init_graph_x = torch.ones((num_nodes, num_node_features))
-
-    # init_graph_adj = torch.randint(0, 2, (num_nodes, num_nodes))
-    # init_graph_adj = torch.ones((num_nodes, num_nodes))
-    init_graph = Data(x=init_graph_x, edge_index=dense_to_sparse(init_graph_adj)[0])
-
-print(nn)
-num_model_params = sum(param.numel() for param in nn.parameters())
-print("Model Parameters:", num_model_params)
-if args.log:
-    wandb.run.summary["# Model Parameter"] = num_model_params
-
-env = gp.Env(logfilename="")
-
-
-def convert_inputs(X, A):
+
+def active_subgraph(X, A, active=None):
+    # Node features and adjacency matrix of only the active nodes of a variable size solution
+    # A can also be the stacked adjacency matrices of each edge type, with shape (num_relations, n, n)
+    X, A = np.asarray(X), np.asarray(A)
+    if active is None:
+        return X, A
+    nodes = np.asarray(active).reshape(-1) > 0.5
+    return X[nodes], A[..., nodes, :][..., nodes]
+
+
+def solution_key(X, A, active=None, A_rel=None):
+    # With edge types, graphs that only differ in the types of their edges are different solutions
+    X, A = active_subgraph(X, A if A_rel is None else A_rel, active)
+    return wl_hash(A, X)
+
+
+def convert_inputs(X, A, active=None, A_rel=None):
+    import torch
+    from torch_geometric.data import Data
+    from torch_geometric.utils import dense_to_sparse
+
+    if A_rel is not None:
+        _, A_rel = active_subgraph(X, A_rel, active)
+    X, A = active_subgraph(X, A, active)
     X = torch.Tensor(X)
     A = torch.Tensor(A)
-    return {"data": Data(x=X, edge_index=dense_to_sparse(A)[0])}
-
-
-start_time = time.time()
-
-inverter = Inverter(args, nn, dataset, env, convert_inputs)
-m = inverter.model
-
-# Add and constrain decision variables for adjacency matrix
-A = m.addMVar((num_nodes, num_nodes), vtype=GRB.BINARY, name="A")
-invert_utils.force_connected(m, A)
-invert_utils.force_undirected(m, A)
-invert_utils.remove_self_loops(m, A)
-# m.addConstr(gp.quicksum(A) >= 1, name="non_isolatied") # Nodes need an edge. Need this for SAGEConv inverse to work. UNCOMMENT IF NO OTHER CONSTRAINTS DO THIS
-
-# Add and constrain decision variables for node feature matrix
-if dataset_name in ["MUTAG", "OurMotifs"]:
-    X = m.addMVar((num_nodes, num_node_features), vtype=GRB.BINARY, name="X")
-    m.addConstr(gp.quicksum(X.T) == 1, name="categorical_features")
-elif dataset_name in ["Is_Acyclic", "Shapes", "Shapes_Clean"]:
-    X = m.addMVar(
-        (num_nodes, num_node_features),
-        lb=0,
-        ub=init_graph.num_nodes,
-        name="X",
-        vtype=GRB.INTEGER,
-    )
-    m.addConstr(X == gp.quicksum(A)[:, np.newaxis], name="features_are_node_degrees")
-elif dataset_name in ["Shapes_Ones", "Is_Acyclic_Ones"]:
-    X = m.addMVar((num_nodes, num_node_features), vtype=GRB.BINARY, name="X")
-    m.addConstr(X == 1, name="features_are_ones")
-    X.setAttr("lb", 1)
-    X.setAttr("ub", 1)
-else:
-    raise ValueError(f"Unknown Decision Variables for {dataset_name}")
-
-inverter.set_input_vars({"X": X, "A": A})
-inverter.set_tracked_vars({"X": X, "A": A})
-
-# if args.log:
-#     wandb.run.tags += ("MaxDeg",)
-# if dataset_name == "MUTAG":
-#     print("MUTAG: Adding Node Degree Constraint")
-#     m.addConstr(
-#         gp.quicksum(A)
-#         <= 4 * X[:, 0]
-#         + 3 * X[:, 1]
-#         + 2 * X[:, 2]
-#         + 1 * X[:, 3]
-#         + 1 * X[:, 4]
-#         + 1 * X[:, 5]
-#         + 1 * X[:, 6],
-#         name="max_node_degree",
-#     )  #! DO YOU WANT THIS?
-
-# invert_utils.order_onehot_features(inverter.m, A, X) # TODO: See if this works better for MUTAG
-
-canonicalize_graph(init_graph)
-# # Test the canonicalization with the constraints
-# A.Start = to_dense_adj(init_graph.edge_index).squeeze().detach().numpy()
-# inverter.solve()
-# breakpoint()
-# inverter.computeIIS()
-
-## Build a MIQCP for the trained neural network
-## For each layer, create and constrain decision variables to represent the output
-debug_start = False
-if debug_start:
+    data = Data(x=X, edge_index=dense_to_sparse(A)[0])
+    if A_rel is not None:
+        # The edge attributes are the one-hot edge types, as in the dataset
+        A_rel = torch.Tensor(A_rel)
+        data.edge_attr = A_rel[:, data.edge_index[0], data.edge_index[1]].T
+        data.edge_type = data.edge_attr.argmax(dim=1)
+    return {"data": data}
+
+
+def load_model(model_path, device):
+    import torch
+    from gnn import GNN  # noqa: F401
+
+    nn = torch.load(model_path, fix_imports=True, map_location=device)
+    nn.device = device
+    nn.eval()
+    nn.to(torch.float64)
+    # BatchNorms are folded into the layers before them, so they don't need to be encoded
+    from simplify import fold_batch_norm
+
+    with torch.no_grad():
+        nn.layers, _ = fold_batch_norm(nn.layers)
+    return nn
+
+
+def get_init_graph(args, dataset, num_nodes):
+    import torch
+    from torch_geometric.data import Data
+    from torch_geometric.utils import dense_to_sparse
+
+    dataset_name = args.dataset_name
+    num_node_features = dataset.num_node_features
+    if args.init_with_data:
+        # Initialize with a graph from the dataset
+        if args.init_index is not None:
+            print(f"Initializing from dataset with graph at index {args.init_index}")
+            init_index = args.init_index
+        elif num_nodes is not None:
+            print(f"Initializing from dataset graph with {num_nodes} nodes")
+            init_index = int(
+                random.choice(
+                    dataset.select_graphs(args.max_class, num_nodes, connected=True)
+                )
+            )
+        init_graph = dataset[init_index]
+        assert dataset.get_graph_attributes()["connected"][
+            init_index
+        ], "Initialization graph was not connected"
+
+    else:
+        # Initialize with a dummy graph
+        # By default, will generate a line graph with uniform random node features
+        print("Initializing with dummy graph")
+        # init_graph_adj = np.clip(init_graph_adj + np.eye(num_nodes, k=1), a_min=0, a_max=1)
+        # init_graph_adj = torch.diag_embed(
+        #     torch.diag(torch.ones((num_nodes, num_nodes)), diagonal=-1), offset=-1
+        # ) + torch.diag_embed(
+        #     torch.diag(torch.ones((num_nodes, num_nodes)), diagonal=1), offset=1
+        # )
+        ## Randomly initialized adjacency matrix of a connected graph
+        init_graph_adj = torch.randint(0, 2, (num_nodes, num_nodes))
+        init_graph_adj = torch.triu(init_graph_adj, diagonal=1)
+        init_graph_adj = init_graph_adj + init_graph_adj.T
+        init_graph_adj = torch.clip(init_graph_adj, 0, 1)
+        init_graph_adj = init_graph_adj.numpy()
+        init_graph_adj = np.clip(
+            init_graph_adj + np.eye(num_nodes, k=1), a_min=0, a_max=1
+        )
+        init_graph_adj = np.clip(
+            init_graph_adj + np.eye(num_nodes, k=-1), a_min=0, a_max=1
+        )
+        init_graph_adj = torch.Tensor(init_graph_adj)
+
+        if dataset_name in ["Is_Acyclic", "Shapes", "Shapes_Clean"]:
+            init_graph_x = torch.unsqueeze(torch.sum(init_graph_adj, dim=-1), dim=-1)
+        elif dataset_name in ["MUTAG", "OurMotifs"]:
+            # init_graph_x = torch.eye(num_node_features)[torch.randint(num_node_features, (num_nodes,)),:]
+            init_graph_x = torch.eye(num_node_features)[
+                torch.randint(1, (num_nodes,)), :
+            ]
+        elif dataset_name in ["Shapes_Ones", "Is_Acyclic_Ones"]:
+            init_graph_x = torch.ones((num_nodes, num_node_features))
+
+        # init_graph_adj = torch.randint(0, 2, (num_nodes, num_nodes))
+        # init_graph_adj = torch.ones((num_nodes, num_nodes))
+        init_graph = Data(x=init_graph_x, edge_index=dense_to_sparse(init_graph_adj)[0])
+    return init_graph
+
+
+def debug_encode(inverter, nn, X, A, init_graph, A_rel=None):
+    from torch_geometric.utils import to_dense_adj
+
     ## If in Debug Mode, we add layers one at a time and fix them to their starting values. If the model becomes infeasible, we can diagnose the problem by computing a minimal IIS
     previous_layer_output = X
     X.start = init_graph.x.detach().numpy()
@@ -280,14 +279,9 @@ if debug_start:
     for name, layer in nn.layers.items():
         inverter.model.update()
         print("Encoding Layer:", name)
-        previous_layer_output = invert_utils.invert_torch_layer(
-            inverter.model,
-            layer,
-            name=name,
-            X=previous_layer_output,
-            A=A,
+        previous_layer_output = inverter.encode_layer(
+            name, layer, previous_layer_output, A=A, A_rel=A_rel
         )
-        inverter.output_vars[name] = previous_layer_output
         assert inverter.output_vars[name].shape == all_layer_outputs[name].shape
         inverter.output_vars[name].Start = all_layer_outputs[name].detach().numpy()
         fixing_constraints.append(
@@ -372,225 +366,681 @@ if debug_start:
         old_numconstrs = numconstrs
 
     inverter.model.remove(fixing_constraints)
-else:
-    previous_layer_output = X
-    for name, layer in nn.layers.items():
-        inverter.model.update()
-        previous_layer_output = invert_utils.invert_torch_layer(
-            inverter.model,
-            layer,
-            name=name,
-            X=previous_layer_output,
-            A=A,
+
+
+def build_inverter(args, nn, dataset, env, num_nodes, init_graph, debug_start=False):
+    # Creates the input decision variables for the dataset and encodes the network on top of them
+    dataset_name = args.dataset_name
+    num_node_features = dataset.num_node_features
+
+    inverter = Inverter(
+        args,
+        nn,
+        dataset,
+        env,
+        convert_inputs,
+        outer_approximation=args.outer_approximation,
+        solution_hash=solution_key,
+        record_layer_values=args.check_divergence,
+    )
+    m = inverter.model
+
+    # Add and constrain decision variables for adjacency matrix
+    A = m.addMVar((num_nodes, num_nodes), vtype=GRB.BINARY, name="A")
+    active = None
+    if args.variable_size:
+        # active[i] is 1 if node i is part of the explanation, inactive nodes come last and have no edges or features
+        active = m.addMVar((num_nodes,), vtype=GRB.BINARY, name="active")
+        m.addConstr(active[1:] <= active[:-1], name="active_nodes_first")
+        m.addConstr(A <= active.reshape(-1, 1), name="active_edges_out")
+        m.addConstr(A <= active.reshape(1, -1), name="active_edges_in")
+    invert_utils.force_connected(
+        m,
+        A,
+        method=args.connectivity,
+        lazy_constraints=inverter.lazy_constraints,
+        node_mask=active,
+    )
+    invert_utils.force_undirected(m, A)
+    invert_utils.remove_self_loops(m, A)
+    A_rel = None
+    if args.edge_types:
+        # A_rel[r] is the adjacency matrix of the edges of type r (like MUTAG's bond types), every edge of A has exactly one type
+        if getattr(dataset, "EDGE_CLS", None) is None:
+            raise ValueError(f"{dataset_name} has no edge types")
+        A_rel = m.addMVar(
+            (len(dataset.EDGE_CLS), num_nodes, num_nodes),
+            vtype=GRB.BINARY,
+            name="A_rel",
+        )
+        m.addConstr(A_rel.sum(axis=0) == A, name="one_edge_type")
+        for r in range(A_rel.shape[0]):
+            m.addConstr(A_rel[r] == A_rel[r].T, name=f"undirected_edge_type_{r}")
+    # m.addConstr(gp.quicksum(A) >= 1, name="non_isolatied") # Nodes need an edge. Need this for SAGEConv inverse to work. UNCOMMENT IF NO OTHER CONSTRAINTS DO THIS
+
+    # Add and constrain decision variables for node feature matrix
+    features = NODE_FEATURES.get(dataset_name)
+    if features == "categorical":
+        X = m.addMVar((num_nodes, num_node_features), vtype=GRB.BINARY, name="X")
+        m.addConstr(
+            gp.quicksum(X.T) == (1 if active is None else active),
+            name="categorical_features",
         )
-        inverter.output_vars[name] = previous_layer_output
-
-## Create decision variables to represent (unweighted) regularizer terms based on embedding similarity/distance
-## These can also be used in constraints!!!
-embedding = inverter.output_vars["Aggregation"][0]
-regularizers = {}
-if sim_methods:
-    # Each row of phi is the average embedding of the graphs in the corresponding class of the dataset
-    phi = dataset.get_average_phi(nn, "Aggregation")
-if "Cosine" in sim_methods:
-    var, calc = invert_utils.get_cosine_similarity(
-        inverter.model, embedding, phi[max_class]
+    elif features == "degree":
+        X = m.addMVar(
+            (num_nodes, num_node_features),
+            lb=0,
+            ub=init_graph.num_nodes,
+            name="X",
+            vtype=GRB.INTEGER,
+        )
+        m.addConstr(
+            X == gp.quicksum(A)[:, np.newaxis], name="features_are_node_degrees"
+        )
+    elif features == "ones":
+        X = m.addMVar((num_nodes, num_node_features), vtype=GRB.BINARY, name="X")
+        if active is None:
+            m.addConstr(X == 1, name="features_are_ones")
+            X.setAttr("lb", 1)
+            X.setAttr("ub", 1)
+        else:
+            m.addConstr(X == active.reshape(-1, 1), name="features_are_ones")
+    else:
+        raise ValueError(f"Unknown Decision Variables for {dataset_name}")
+
+    input_vars = {"X": X, "A": A}
+    if active is not None:
+        input_vars["active"] = active
+    if A_rel is not None:
+        input_vars["A_rel"] = A_rel
+    inverter.set_input_vars(input_vars)
+    inverter.set_tracked_vars(
+        {"X": X, "A": A} if A_rel is None else {"X": X, "A": A, "A_rel": A_rel}
     )
-    inverter.add_objective_term(
-        ObjectiveTerm(
-            name="Cosine Similarity",
-            var=var,
-            calc=calc,
-            weight=sim_weights["Cosine"],
-            required_vars=[embedding],
-        ),
+    if active is not None:
+        inverter.set_node_mask("active", min_nodes=args.min_nodes)
+
+    # The simplified network is what gets encoded and what solutions are verified against
+    m.update()
+    input_lb, input_ub = X.getAttr("lb").min(axis=0), X.getAttr("ub").max(axis=0)
+    # Sum pooling over a variable size graph only adds up its active nodes
+    min_nodes = args.min_nodes if active is not None else None
+    if args.simplify:
+        from simplify import simplify_network
+
+        nn, report = simplify_network(
+            nn,
+            input_lb,
+            input_ub,
+            num_nodes,
+            budget=args.simplify_budget,
+            round_decimals=args.round_decimals,
+            min_nodes=min_nodes,
+        )
+        print("Simplified Network:", report)
+        inverter.nn = nn
+    if args.stable_units:
+        from simplify import (
+            activation_statistics,
+            propagate_bounds,
+            prune_stable_units,
+            stable_units,
+        )
+
+        if args.stable_units == "certified":
+            units = stable_units(
+                nn.layers,
+                bounds=propagate_bounds(
+                    nn.layers,
+                    input_lb,
+                    input_ub,
+                    num_nodes,
+                    symbolic=True,
+                    min_nodes=min_nodes,
+                ),
+            )
+        else:
+            units = stable_units(
+                nn.layers,
+                statistics=activation_statistics(nn, dataset.loader(batch_size=256)),
+            )
+        nn, report = prune_stable_units(nn, units)
+        print(f"Stable Units ({args.stable_units}):", report)
+        inverter.nn = nn
+
+    # if args.log:
+    #     wandb.run.tags += ("MaxDeg",)
+    # if dataset_name == "MUTAG":
+    #     print("MUTAG: Adding Node Degree Constraint")
+    #     m.addConstr(
+    #         gp.quicksum(A)
+    #         <= 4 * X[:, 0]
+    #         + 3 * X[:, 1]
+    #         + 2 * X[:, 2]
+    #         + 1 * X[:, 3]
+    #         + 1 * X[:, 4]
+    #         + 1 * X[:, 5]
+    #         + 1 * X[:, 6],
+    #         name="max_node_degree",
+    #     )  #! DO YOU WANT THIS?
+
+    # invert_utils.order_onehot_features(inverter.m, A, X) # TODO: See if this works better for MUTAG
+
+    ## Build a MIQCP for the trained neural network
+    ## For each layer, create and constrain decision variables to represent the output
+    if debug_start:
+        debug_encode(inverter, nn, X, A, init_graph, A_rel=A_rel)
+    else:
+        # Pooling layers only aggregate over the active nodes
+        # Layers with edge types (RGCNConv) use A_rel, the others only see A
+        inverter.encode_network(X, A=A, A_rel=A_rel, node_mask=active)
+    return inverter
+
+
+def add_objective(args, inverter, nn, dataset, max_class=None):
+    # Adds the regularizers and the logit margin objective for max_class (by default args.max_class)
+    max_class = args.max_class if max_class is None else max_class
+    sim_weights = dict(zip(args.regularizers, args.regularizer_weights))
+    sim_methods = args.regularizers
+
+    ## Create decision variables to represent (unweighted) regularizer terms based on embedding similarity/distance
+    ## These can also be used in constraints!!!
+    embedding = inverter.output_vars["Aggregation"][0]
+    if sim_methods:
+        # Each row of phi is the average embedding of the graphs in the corresponding class of the dataset
+        phi = dataset.get_average_phi(nn, "Aggregation")
+
+    def regularizer_encoding(weight, rewarded):
+        # Convex encodings are only exact when the objective pushes the regularizer in the right direction
+        if (weight >= 0) == rewarded:
+            return "pwl" if args.outer_approximation else args.regularizer_encoding
+        return "nonconvex"
+
+    if "Cosine" in sim_methods:
+        var, calc = invert_utils.get_cosine_similarity(
+            inverter.model,
+            embedding,
+            phi[max_class],
+            method=regularizer_encoding(sim_weights["Cosine"], rewarded=True),
+            precision_bits=args.cosine_precision_bits,
+            outer_approx=inverter.outer_approx,
+        )
+        inverter.add_objective_term(
+            ObjectiveTerm(
+                name="Cosine Similarity",
+                var=var,
+                calc=calc,
+                weight=sim_weights["Cosine"],
+                required_vars=[embedding],
+            ),
+        )
+    if "L2" in sim_methods:
+        var, calc = invert_utils.get_l2_distance(
+            inverter.model,
+            embedding,
+            phi[max_class],
+            method=regularizer_encoding(sim_weights["L2"], rewarded=False),
+            outer_approx=inverter.outer_approx,
+        )
+        inverter.add_objective_term(
+            ObjectiveTerm(
+                name="L2 Distance",
+                var=var,
+                calc=calc,
+                weight=sim_weights["L2"],
+                required_vars=[embedding],
+            ),
+        )
+    if "Squared L2" in sim_methods:
+        var, calc = invert_utils.get_squared_l2_distance(
+            inverter.model,
+            embedding,
+            phi[max_class],
+            method=regularizer_encoding(sim_weights["Squared L2"], rewarded=False),
+            outer_approx=inverter.outer_approx,
+        )
+        inverter.add_objective_term(
+            ObjectiveTerm(
+                name="Squared L2 Distance",
+                var=var,
+                calc=calc,
+                weight=sim_weights["Squared L2"],
+                required_vars=[embedding],
+            ),
+        )
+    inverter.model.update()
+
+    ## MIQCP objective function: the target logit minus the largest other logit
+    inverter.add_margin_objective(max_class)
+
+    inverter.model.update()
+
+
+def build_explanation_model(args, env):
+    # Loads the dataset and network and builds the same model as main (inputs, network and objective), without logging, warm starts or solving
+    import torch
+    from datasets import get_dataset
+
+    device = (
+        args.device
+        if args.device is not None
+        else torch.device("cuda" if torch.cuda.is_available() else "cpu")
     )
-if "L2" in sim_methods:
-    var, calc = invert_utils.get_l2_distance(inverter.model, embedding, phi[max_class])
-    inverter.add_objective_term(
-        ObjectiveTerm(
-            name="L2 Distance",
-            var=var,
-            calc=calc,
-            weight=sim_weights["L2"],
-            required_vars=[embedding],
-        ),
+    dataset = get_dataset(args.dataset_name)
+    nn = load_model(args.model_path or f"models/{args.dataset_name}_model.pth", device)
+    init_graph = get_init_graph(args, dataset, args.num_nodes)
+    num_nodes = (
+        max(args.num_nodes or 0, init_graph.num_nodes)
+        if args.variable_size
+        else init_graph.num_nodes
     )
-if "Squared L2" in sim_methods:
-    var, calc = invert_utils.get_l2_distance(inverter.model, embedding, phi[max_class])
-    inverter.add_objective_term(
-        ObjectiveTerm(
-            name="Squared L2 Distance",
-            var=var,
-            calc=calc,
-            weight=sim_weights["Squared L2"],
-            required_vars=[embedding],
-        ),
+    if args.connectivity == "ordering":
+        canonicalize_graph(init_graph)
+    inverter = build_inverter(args, nn, dataset, env, num_nodes, init_graph)
+    inverter.checkpoint("Objective")
+    add_objective(args, inverter, inverter.nn, dataset)
+    return inverter, dataset, init_graph
+
+
+def main(argv=None):
+    import torch
+    from datasets import get_dataset
+
+    args = parse_args(argv)
+
+    dataset_name = args.dataset_name
+    model_path = args.model_path
+    max_class = args.max_class
+    output_file = args.output_file
+    num_nodes = args.num_nodes
+    device = (
+        args.device
+        if args.device is not None
+        else torch.device("cuda" if torch.cuda.is_available() else "cpu")
     )
-m.update()
-
-# List of decision variables representing the logits that are not the max_class logit
-other_outputs_vars = [
-    inverter.output_vars["Output"][0, j]
-    for j in range(dataset.num_classes)
-    if j != max_class
-]
-
-# # Create a decision variable and constrain it to the maximum of the non max_class logits
-other_outputs_max = m.addVar(
-    name="other_outputs_max",
-    lb=max(v.getAttr("lb") for v in other_outputs_vars),
-    ub=max(v.getAttr("ub") for v in other_outputs_vars),
-)
-m.addGenConstrMax(other_outputs_max, other_outputs_vars, name="max_of_other_outputs")
-
-max_output_var = inverter.output_vars["Output"][0, max_class]
 
-## MIQCP objective function
-inverter.add_objective_term(ObjectiveTerm("Target Class Output", max_output_var))
-inverter.add_objective_term(
-    ObjectiveTerm("Max Non-Target Class Output", other_outputs_max, weight=-1)
-)
+    if not model_path:
+        model_path = f"models/{dataset_name}_model.pth"
 
-m.update()
+    # torch.manual_seed(12345)
+    # TODO: Seed for Gurobi
 
-# Save a copy of the model
-model_files = inverter.save_model()
-if args.log:
-    for fn in model_files:
-        wandb.save(fn, policy="now")
+    if not os.path.isdir("solutions"):
+        os.mkdir("solutions")
 
+    dataset = get_dataset(dataset_name)
 
-# Define the callback function for the solver to save intermediate solutions, other metrics
-mip_information = []
+    # Load the model
+    nn = load_model(model_path, device)
 
+    # Track hyperparameters
+    # Logging and plotting happen in a background process, so the solver callback never waits on them
+    logger, run_id = None, uuid.uuid4().hex[:8]
+    config = {
+        "architecture": str(nn),
+        "model_path": model_path,
+    }
+    config.update(vars(args))
+    if args.log:
+        backend_factories = []
+        if "local" in args.log_backends:
+            backend_factories.append(
+                partial(LocalFileBackend, run_id=run_id, config=config)
+            )
+        if "wandb" in args.log_backends:
+            backend_factories.append(
+                partial(WandbBackend, run_id=run_id, config=config)
+            )
+        logger = ExperimentLogger(
+            backend_factories,
+            draw_graph=GraphDrawer(dataset_name),
+            min_figure_interval=args.min_figure_interval,
+            graph_hash=wl_hash,
+        )
+        if args.param_file != "auto":
+            logger.save_file(args.param_file, policy="now")
+        logger.save_file(output_file, policy="end")
+        logger.log_code(".")
+
+    print("Args:", args)
+    print("Device:", device)
+    print("Number of Classes", dataset.num_classes)
+    print("Number of Node Features", dataset.num_node_features)
+
+    # # Max nn Output Logit for each class in the dataset
+    # max_logits = [0] * dataset.num_classes
+    # for i, graph in enumerate(dataset):
+    #     logits = nn(graph).detach().numpy().squeeze()
+    #     for j, logit in enumerate(logits):
+    #         if logit > max_logits[j]:
+    #             max_logits[j] = logit
+    # print("Max Logits:", max_logits)
+
+    init_graph = get_init_graph(args, dataset, num_nodes)
+    # With variable_size, num_nodes is the largest explanation and the initial graph can be smaller
+    num_nodes = (
+        max(num_nodes or 0, init_graph.num_nodes)
+        if args.variable_size
+        else init_graph.num_nodes
+    )
 
-def callback(model, where):
-    global mip_information
-    inverter.get_default_callback()(model, where)
-    if where == GRB.Callback.MIPSOL:
-        print("New Solution Found:", len(inverter.solutions))
-        if args.log and inverter.solutions:
-            solution = inverter.solutions[-1]
-            fig, _ = dataset.draw_graph(A=solution["A"], X=solution["X"])
-            # plt.savefig("test.png")
-            wandb.log(solution, commit=False)
-            wandb.log(
+    print(nn)
+    num_model_params = sum(param.numel() for param in nn.parameters())
+    print("Model Parameters:", num_model_params)
+    if logger:
+        logger.update_summary({"# Model Parameter": num_model_params})
+
+    fast_explanations = None
+    if args.fast_only or args.init_with_gradient:
+        fast_start_time = time.time()
+        fast_explanations = get_fast_explanations(
+            args,
+            nn,
+            dataset,
+            num_nodes,
+            num_explanations=args.num_explanations if args.fast_only else None,
+        )
+        fast_time = time.time() - fast_start_time
+        print(
+            f"Fast Explanations: {len(fast_explanations)} in {fast_time:.2f}s, best objective {fast_explanations[0]['Objective Value']}"
+        )
+        if logger:
+            logger.update_summary(
                 {
-                    f"Output Logit {i}": solution["Output"].squeeze()[i]
-                    for i in range(solution["Output"].shape[1])
-                },
-                commit=False,
+                    "Fast Explanation Time": fast_time,
+                    "Fast Explanation Objective": fast_explanations[0][
+                        "Objective Value"
+                    ],
+                }
             )
-            wandb.log({"fig": wandb.Image(fig)})
-            plt.close()
-
-        # with open(output_file, "wb") as f:
-        #     pickle.dump(inverter.solutions, f)
-    elif where == GRB.Callback.MIP:
-        # Access MIP information when upper bound is updated
-        runtime = model.cbGet(GRB.Callback.RUNTIME)
-        if mip_information and runtime - mip_information[-1]["Runtime"] < 1:
-            return
-        obj_bound = model.cbGet(GRB.Callback.MIP_OBJBST)
-        best_bound = model.cbGet(GRB.Callback.MIP_OBJBND)
-        node_count = model.cbGet(GRB.Callback.MIP_NODCNT)
-        explored_node_count = model.cbGet(GRB.Callback.MIP_NODCNT)
-        unexplored_node_count = model.cbGet(GRB.Callback.MIP_NODLFT)
-        cut_count = model.cbGet(GRB.Callback.MIP_CUTCNT)
-        work_units = model.cbGet(GRB.Callback.WORK)
-
-        # Save the information to a dictionary
-        mip_info = {
-            "ObjBound": obj_bound,
-            "BestBound": best_bound,
-            "NodeCount": node_count,
-            "ExploredNodeCount": explored_node_count,
-            "UnexploredNodeCount": unexplored_node_count,
-            "CutCount": cut_count,
-            "Runtime": runtime,
-            "WorkUnits": work_units,
+    if args.fast_only:
+        # No MIP is built, the gradient-based explanations are the solutions
+        with open(output_file, "wb") as f:
+            pickle.dump(fast_explanations, f)
+        run_data = {
+            "solutions": fast_explanations,
+            "runtime": fast_time,
+            "import_time": _import_time,
         }
+        if logger:
+            run_data.update(logger.close())
+        return run_data
+
+    env = gp.Env(logfilename="")
+
+    start_time = time.time()
+
+    # The ordering connectivity constraints only hold for a canonically ordered initial graph
+    if args.connectivity == "ordering":
+        canonicalize_graph(init_graph)
+    # # Test the canonicalization with the constraints
+    # A.Start = to_dense_adj(init_graph.edge_index).squeeze().detach().numpy()
+    # inverter.solve()
+    # breakpoint()
+    # inverter.computeIIS()
+
+    inverter = build_inverter(args, nn, dataset, env, num_nodes, init_graph)
+    nn = inverter.nn
+    m = inverter.model
+
+    if args.relaxation_only:
+        # A certified upper bound on the margin of every graph with num_nodes nodes, without solving the MIP
+        relaxation = inverter.relaxation_bound(
+            max_class,
+            obbt_rounds=args.obbt_rounds,
+            cache_file=args.relaxation_cache,
+        )
+        print(
+            f"Relaxation Bound: {relaxation['Upper Bound']} in {relaxation['Runtime']:.2f}s"
+        )
+        if logger:
+            logger.update_summary(
+                {
+                    "Relaxation Bound": relaxation["Upper Bound"],
+                    "Relaxation Time": relaxation["Runtime"],
+                }
+            )
+        run_data = {"relaxation": relaxation, "runtime": time.time() - start_time}
+        if logger:
+            run_data.update(logger.close())
+        return run_data
+
+    ## Everything added from here on (regularizers and objective) can be swapped out with inverter.rollback("Objective")
+    inverter.checkpoint("Objective")
+    add_objective(args, inverter, nn, dataset)
+
+    # Save a copy of the model
+    model_files = inverter.save_model()
+    if logger:
+        for fn in model_files:
+            logger.save_file(fn, policy="now")
+
+    # Define the callback function for the solver to save intermediate solutions, other metrics
+    mip_information = []
+    default_callback = inverter.get_default_callback()
+
+    def callback(model, where):
+        num_solutions = len(inverter.solutions)
+        default_callback(model, where)
+        if where == GRB.Callback.MIPSOL:
+            if len(inverter.solutions) == num_solutions:
+                # The default callback skipped a graph isomorphic to an earlier solution
+                return
+            print("New Solution Found:", len(inverter.solutions))
+            if logger:
+                solution = inverter.solutions[-1]
+                metrics = dict(solution)
+                metrics.update(
+                    {
+                        f"Output Logit {i}": solution["Output"].squeeze()[i]
+                        for i in range(solution["Output"].shape[1])
+                    }
+                )
+                logger.log(metrics)
+                # Only queued here, the figure is drawn (if it's a new graph) in the logging process
+                X, A = active_subgraph(
+                    solution["X"], solution["A"], solution.get("active")
+                )
+                logger.log_graph(A, X)
+
+            # with open(output_file, "wb") as f:
+            #     pickle.dump(inverter.solutions, f)
+        elif where == GRB.Callback.MIP:
+            # Access MIP information when upper bound is updated
+            runtime = model.cbGet(GRB.Callback.RUNTIME)
+            if mip_information and runtime - mip_information[-1]["Runtime"] < 1:
+                return
+            obj_bound = model.cbGet(GRB.Callback.MIP_OBJBST)
+            best_bound = model.cbGet(GRB.Callback.MIP_OBJBND)
+            node_count = model.cbGet(GRB.Callback.MIP_NODCNT)
+            explored_node_count = model.cbGet(GRB.Callback.MIP_NODCNT)
+            unexplored_node_count = model.cbGet(GRB.Callback.MIP_NODLFT)
+            cut_count = model.cbGet(GRB.Callback.MIP_CUTCNT)
+            work_units = model.cbGet(GRB.Callback.WORK)
+
+            # Save the information to a dictionary
+            mip_info = {
+                "ObjBound": obj_bound,
+                "BestBound": best_bound,
+                "NodeCount": node_count,
+                "ExploredNodeCount": explored_node_count,
+                "UnexploredNodeCount": unexplored_node_count,
+                "CutCount": cut_count,
+                "Runtime": runtime,
+                "WorkUnits": work_units,
+                "Duplicate Solutions": inverter.duplicate_count,
+            }
+
+            if logger:
+                logger.log(mip_info)
+
+            mip_information.append(mip_info)
+
+    ## Warm start - create an initial solution for the model
+    num_relations = len(dataset.EDGE_CLS) if args.edge_types else None
+    bound_summary = inverter.warm_start(
+        get_start_values(args, init_graph, num_nodes, num_relations),
+        debug_mode=False,
+        repair=args.warm_start_repair,
+    )
+    print(bound_summary)
+    if logger:
+        logger.update_summary(bound_summary)
+    if fast_explanations:
+        # The best gradient-based explanations are extra starts after the initial graph
+        for start_number, explanation in enumerate(
+            fast_explanations[: args.fast_starts], start=1
+        ):
+            graph = convert_inputs(
+                **{
+                    name: explanation[name]
+                    for name in explanation
+                    if name in ["X", "A", "A_rel"]
+                }
+            )["data"]
+            if args.connectivity == "ordering":
+                canonicalize_graph(graph)
+            inverter.warm_start(
+                get_start_values(args, graph, num_nodes, num_relations),
+                repair=args.warm_start_repair,
+                start_number=start_number,
+            )
+
+    # Get solver parameters, with "auto" the best tuned set of this model family (see tuning.py) or the default file if it was never tuned
+    if args.param_file == "auto":
+        from tuning import solver_params
+
+        params = solver_params(args)
+        print("Solver Parameters:", params)
+        for param_name, param_value in params.items():
+            m.setParam(param_name, param_value)
+        if logger:
+            logger.update_summary({"Solver Parameters": params})
+    else:
+        m.read(args.param_file)
+
+    # Cold-start time: everything from interpreter start up to the solver
+    startup_time = time.perf_counter() - _process_start_time
+    print(f"Import Time: {_import_time:.2f}s, Startup Time: {startup_time:.2f}s")
+    if logger:
+        logger.update_summary(
+            {"Import Time": _import_time, "Startup Time": startup_time}
+        )
 
-        if args.log:
-            wandb.log(mip_info)
+    # Run Optimization
+    explanations, size_sweep = None, None
+    if args.size_sweep:
+        # Only the bounds of the node mask change between sizes, the encoding is built once
+        if not args.variable_size:
+            raise ValueError("--size_sweep needs --variable_size")
+        size_sweep = inverter.solve_size_sweep(
+            args.size_sweep, callback, TimeLimit=args.time_limit
+        )
+        for size, result in size_sweep.items():
+            print(
+                f"{size} Nodes: objective {result['Objective']}, bound {result['Upper Bound']}, status {result['Status']}"
+            )
+        inverter.solutions = [
+            solution
+            for result in size_sweep.values()
+            for solution in result["Solutions"]
+        ]
+    elif args.num_explanations > 1 or args.explain_classes:
+        # Collect several non-isomorphic explanations per class, swapping only the objective between solves
+        explanations = inverter.enumerate_explanations(
+            args.num_explanations,
+            classes=args.explain_classes or [max_class],
+            objective_func=lambda inverter, target_class: add_objective(
+                args, inverter, nn, dataset, max_class=target_class
+            ),
+            callback=callback,
+            max_duplicate_cuts=args.max_duplicate_cuts,
+            TimeLimit=args.time_limit,
+        )
+        with open(f"{os.path.splitext(output_file)[0]}_explanations.pkl", "wb") as f:
+            pickle.dump(explanations, f)
+    else:
+        inverter.solve(
+            callback,
+            TimeLimit=args.time_limit,
+        )
 
-        mip_information.append(mip_info)
+    # Save all solutions
+    with open(output_file, "wb") as f:
+        pickle.dump(inverter.solutions, f)
+
+    run_data = {
+        "mip_information": mip_information,
+        "solutions": inverter.solutions,
+        "duplicate_solutions": inverter.duplicate_count,
+        "explanations": explanations,
+        "size_sweep": size_sweep,
+        "import_time": _import_time,
+        "startup_time": startup_time,
+    }
 
+    if args.log:
+        # Drawn here after the solve, so the figures are part of run_data
+        for key, solution in [
+            ("initialization", inverter.solutions[0]),
+            ("solution", inverter.solutions[-1]),
+        ]:
+            X, A = active_subgraph(solution["X"], solution["A"], solution.get("active"))
+            run_data[key] = GraphDrawer(dataset_name)(A, X)
+        run_data["initialization_output"] = inverter.solutions[0]["Output"].squeeze()
+        run_data["solution_output"] = inverter.solutions[-1]["Output"].squeeze()
+
+    if args.check_divergence and inverter.solutions:
+        run_data["layer_divergence"] = inverter.check_divergence()
+        for name, layer in run_data["layer_divergence"].items():
+            print(
+                f"{name}: max error {layer['Max Error']:.3e}, max relative error {layer['Max Relative Error']:.3e}"
+            )
 
-## Warm start - create an initial solution for the model
-bound_summary = inverter.warm_start(
-    {"X": init_graph.x, "A": to_dense_adj(init_graph.edge_index).squeeze()},
-    debug_mode=False,
-)
-print(bound_summary)
-if args.log:
-    wandb.run.summary.update(bound_summary)
+    print("Model Status:", m.Status)
+
+    save_file = f"solutions/{dataset_name}_{max_class}_{num_nodes}.pkl"
+
+    if m.Status in [3, 4]:  # If the model is infeasible, see why
+        inverter.computeIIS()
+
+    end_time = time.time()
+    run_data["runtime"] = end_time - start_time
+    run_data["solve_time"] = m.Runtime
+    run_data["model_status"] = m.Status
+    run_data["node_count"] = m.NodeCount
+    run_data["mip_gap"] = m.MIPGap if m.SolCount else float("inf")
+
+    if logger:
+        logger.update_summary(
+            {
+                "Model Status": m.Status,
+                "Node Count": m.NodeCount,
+                "Open Node Count": m.OpenNodeCount,
+                "MIPGap": m.MIPGap,
+                "Duplicate Solutions": inverter.duplicate_count,
+                "Dropped Log Messages": logger.num_dropped,
+            }
+        )
+        run_data.update(logger.close())
+        run_data.update(config)
+        run_data["run_id"] = run_id
+        run_data_keys = list(run_data.keys())
 
-# Get solver parameters
-m.read(args.param_file)
+        ## Temporary Solution TODO: Remove non-picklable objects
+        for key in run_data_keys:
+            try:
+                pickle.dumps(run_data[key])
+            except:
+                del run_data[key]
 
-# Run Optimization
-inverter.solve(
-    callback,
-    TimeLimit=round(3600 * 2),
-)
+        if not os.path.isdir(f"results/runs_{dataset_name}"):
+            os.mkdir(f"results/runs_{dataset_name}")
+        with open(f"results/runs_{dataset_name}/{run_id}.pkl", "wb") as f:
+            pickle.dump(run_data, f)
 
-# Save all solutions
-with open(output_file, "wb") as f:
-    pickle.dump(inverter.solutions, f)
+    return run_data
 
-run_data = {"mip_information": mip_information, "solutions": inverter.solutions}
 
-if args.log:
-    image_dir = f"./results/{dataset_name}/"
-    if not os.path.isdir(image_dir):
-        os.makedirs(image_dir)
-    imgname = f"{max_class}_{num_nodes}_{wandb.run.id}"
-    fig, ax = dataset.draw_graph(
-        A=inverter.solutions[0]["A"], X=inverter.solutions[0]["X"]
-    )
-    # fig.savefig(image_dir + imgname + "_init.png")
-    run_data["initialization"] = fig
-    run_data["initialization_output"] = inverter.solutions[0]["Output"].squeeze()
-    fig, ax = dataset.draw_graph(
-        A=inverter.solutions[-1]["A"], X=inverter.solutions[-1]["X"]
-    )
-    # fig.savefig(image_dir + imgname + "_solution.png")
-    run_data["solution"] = fig
-    run_data["solution_output"] = inverter.solutions[-1]["Output"].squeeze()
-
-print("Model Status:", m.Status)
-
-save_file = f"solutions/{dataset_name}_{max_class}_{num_nodes}.pkl"
-
-if m.Status in [3, 4]:  # If the model is infeasible, see why
-    inverter.computeIIS()
-
-end_time = time.time()
-run_data["runtime"] = end_time - start_time
-
-if args.log:
-    wandb.run.summary["Model Status"] = m.Status
-    wandb.run.summary["Node Count"] = m.NodeCount
-    wandb.run.summary["Open Node Count"] = m.OpenNodeCount
-    wandb.run.summary["MIPGap"] = m.MIPGap
-
-    for key in wandb.run.summary.keys():
-        run_data[key] = wandb.run.summary[key]
-    del run_data["fig"]
-    for key in wandb.config.keys():
-        run_data[key] = wandb.config[key]
-    run_data_keys = list(run_data.keys())
-
-    ## Temporary Solution TODO: Remove non-picklable objects
-    for key in run_data_keys:
-        try:
-            pickle.dumps(run_data[key])
-        except:
-            del run_data[key]
-
-    if not os.path.isdir(f"results/runs_{dataset_name}"):
-        os.mkdir(f"results/runs_{dataset_name}")
-    with open(f"results/runs_{dataset_name}/{wandb.run.id}.pkl", "wb") as f:
-        pickle.dump(run_data, f)
+if __name__ == "__main__":
+    main()
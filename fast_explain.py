@@ -0,0 +1,228 @@
+import time
+import numpy as np
+import torch
+from scipy.sparse.csgraph import connected_components
+from graph_hash import wl_hash
+
+# Gradient-based explanations: a batch of relaxed graphs (one per random restart) is optimized with autograd against GNN.forward_dense,
+# then each one is rounded to a graph and repaired until it is connected
+# There is no optimality guarantee, but it takes seconds instead of a MIP solve, the graphs can be returned directly or used as MIP starts
+# Edges are a categorical choice per pair of nodes: class 0 is no edge and class r + 1 is an edge of type r (a single type without edge types)
+
+
+def symmetric(scores):
+    # Keeps the upper triangle of the last two dimensions and mirrors it, so every pair of nodes has one score
+    upper = torch.triu(scores, diagonal=1)
+    return upper + upper.transpose(-1, -2)
+
+
+def relaxed_inputs(
+    edge_logits,
+    feature_logits,
+    features="categorical",
+    temperature=1.0,
+    gumbel=True,
+    generator=None,
+):
+    # Returns the relaxed X (batch, n, f), A (batch, n, n) and A_rel (batch, num_relations, n, n) for the logits of each edge class and node feature
+    # With gumbel, these are Gumbel-softmax samples, otherwise the softmax of the logits
+    def sample(logits):
+        if not gumbel:
+            return logits
+        uniform = torch.rand(
+            logits.shape, generator=generator, dtype=logits.dtype, device=logits.device
+        )
+        return logits - torch.log(-torch.log(uniform.clamp(1e-10, 1 - 1e-10)))
+
+    edge_probs = torch.softmax(symmetric(sample(edge_logits)) / temperature, dim=1)
+    no_self_loops = 1 - torch.eye(
+        edge_logits.shape[-1], dtype=edge_logits.dtype, device=edge_logits.device
+    )
+    A_rel = edge_probs[:, 1:] * no_self_loops
+    A = A_rel.sum(dim=1)
+    if features == "categorical":
+        X = torch.softmax(sample(feature_logits) / temperature, dim=-1)
+    elif features == "degree":
+        X = A.sum(dim=-1, keepdim=True).expand(feature_logits.shape)
+    elif features == "ones":
+        X = torch.ones_like(feature_logits)
+    else:
+        raise ValueError(f"Unknown node features '{features}'")
+    return X, A, A_rel
+
+
+def connect_components(edge_class, edge_scores):
+    # Adds the most likely edge between two components until the graph is connected, each added edge gets its most likely type
+    edge_gain = edge_scores[1:].max(axis=0) - edge_scores[0]
+    edge_type = edge_scores[1:].argmax(axis=0) + 1
+    num_components, labels = connected_components(edge_class > 0, directed=False)
+    while num_components > 1:
+        gain = np.where(
+            labels[:, np.newaxis] != labels[np.newaxis, :], edge_gain, -np.inf
+        )
+        i, j = np.unravel_index(gain.argmax(), gain.shape)
+        edge_class[i, j] = edge_class[j, i] = edge_type[i, j]
+        num_components, labels = connected_components(edge_class > 0, directed=False)
+    return edge_class
+
+
+def round_graph(edge_scores, feature_scores, features="categorical", edge_types=False):
+    # The most likely connected graph for the scores (num_classes, n, n) of each edge class and (n, f) of each node feature
+    edge_class = edge_scores.argmax(axis=0)
+    np.fill_diagonal(edge_class, 0)
+    edge_class = connect_components(edge_class, edge_scores)
+    A = (edge_class > 0).astype(np.float64)
+    if features == "categorical":
+        X = np.eye(feature_scores.shape[1])[feature_scores.argmax(axis=1)]
+    elif features == "degree":
+        X = np.repeat(A.sum(axis=1, keepdims=True), feature_scores.shape[1], axis=1)
+    else:
+        X = np.ones(feature_scores.shape)
+    values = {"X": X, "A": A}
+    if edge_types:
+        relations = np.arange(1, edge_scores.shape[0])[:, np.newaxis, np.newaxis]
+        values["A_rel"] = (edge_class[np.newaxis] == relations).astype(np.float64)
+    return values
+
+
+def explanation_objective(
+    outputs, target_class, phi=None, regularizers=None, embedding_layer="Aggregation"
+):
+    # The MIP objective of explain_gnn.py for a batch of layer outputs: the target logit minus the largest other logit, plus the weighted regularizers
+    logits = list(outputs.values())[-1]
+    others = torch.cat([logits[:, :target_class], logits[:, target_class + 1 :]], dim=1)
+    objective = logits[:, target_class] - others.max(dim=1).values
+    for name, weight in (regularizers or {}).items():
+        embedding = outputs[embedding_layer]
+        target = torch.as_tensor(
+            phi[target_class], dtype=embedding.dtype, device=embedding.device
+        )
+        if name == "Cosine":
+            term = torch.nn.functional.cosine_similarity(
+                embedding, target.unsqueeze(0), dim=-1
+            )
+        elif name == "L2":
+            term = (embedding - target).norm(dim=-1)
+        elif name == "Squared L2":
+            term = ((embedding - target) ** 2).sum(dim=-1)
+        else:
+            raise ValueError(f"Unknown regularizer '{name}'")
+        objective = objective + weight * term
+    return objective
+
+
+def fast_explain(
+    nn,
+    num_nodes,
+    num_node_features,
+    target_class,
+    features="categorical",
+    num_relations=None,
+    restarts=64,
+    steps=200,
+    lr=0.1,
+    relaxation="gumbel",
+    temperatures=(2.0, 0.1),
+    phi=None,
+    regularizers=None,
+    num_explanations=None,
+    convert_inputs=None,
+    solution_hash=None,
+    time_limit=None,
+    seed=None,
+):
+    # Returns up to num_explanations (by default all) non-isomorphic explanations, best first, in the format of Inverter.enumerate_explanations
+    # Rounded graphs are scored with a forward pass on convert_inputs(**values) (see Inverter) if it's given, otherwise with GNN.forward_dense
+    # relaxation is "gumbel" (Gumbel-softmax samples) or "continuous" (the softmax of the logits), the temperature anneals geometrically between temperatures
+    # Optimization stops early after time_limit seconds
+    start_time = time.perf_counter()
+    generator = None if seed is None else torch.Generator().manual_seed(seed)
+    dtype = next(nn.parameters()).dtype
+    edge_logits = torch.randn(
+        (
+            restarts,
+            2 if num_relations is None else num_relations + 1,
+            num_nodes,
+            num_nodes,
+        ),
+        generator=generator,
+        dtype=dtype,
+    ).requires_grad_()
+    feature_logits = torch.randn(
+        (restarts, num_nodes, num_node_features), generator=generator, dtype=dtype
+    ).requires_grad_()
+    optimizer = torch.optim.Adam([edge_logits, feature_logits], lr=lr)
+
+    first_temperature, last_temperature = temperatures
+    for step in range(steps):
+        temperature = first_temperature * (last_temperature / first_temperature) ** (
+            step / max(steps - 1, 1)
+        )
+        X, A, A_rel = relaxed_inputs(
+            edge_logits,
+            feature_logits,
+            features,
+            temperature,
+            gumbel=relaxation == "gumbel",
+            generator=generator,
+        )
+        objective = explanation_objective(
+            nn.forward_dense(X, A, A_rel=A_rel, return_all=True),
+            target_class,
+            phi,
+            regularizers,
+        )
+        # Only the logits are optimized, the network's parameters don't get gradients
+        optimizer.zero_grad()
+        edge_logits.grad, feature_logits.grad = torch.autograd.grad(
+            -objective.sum(), [edge_logits, feature_logits], allow_unused=True
+        )
+        optimizer.step()
+        if time_limit is not None and time.perf_counter() - start_time > time_limit:
+            break
+
+    edge_scores = symmetric(edge_logits.detach()).cpu().numpy()
+    feature_scores = feature_logits.detach().cpu().numpy()
+    candidates = [
+        round_graph(
+            edge_scores[i], feature_scores[i], features, num_relations is not None
+        )
+        for i in range(restarts)
+    ]
+
+    # Restarts often round to the same graph, which is only scored once
+    explanations, hashes = [], set()
+    for values in candidates:
+        key = (
+            solution_hash(**values)
+            if solution_hash is not None
+            else wl_hash(values.get("A_rel", values["A"]), values["X"])
+        )
+        if key in hashes:
+            continue
+        hashes.add(key)
+        with torch.no_grad():
+            if convert_inputs is not None:
+                outputs = dict(nn.get_all_layer_outputs(**convert_inputs(**values)))
+            else:
+                outputs = nn.forward_dense(
+                    torch.as_tensor(values["X"])[np.newaxis],
+                    torch.as_tensor(values["A"])[np.newaxis],
+                    A_rel=(
+                        torch.as_tensor(values["A_rel"])[np.newaxis]
+                        if "A_rel" in values
+                        else None
+                    ),
+                    return_all=True,
+                )
+            objective = explanation_objective(outputs, target_class, phi, regularizers)
+        explanations.append(
+            values
+            | {
+                "Output": list(outputs.values())[-1].cpu().numpy(),
+                "Objective Value": float(objective[0]),
+                "Hash": key,
+            }
+        )
+    explanations.sort(key=lambda explanation: -explanation["Objective Value"])
+    return explanations[:num_explanations]
@@ -2,8 +2,15 @@ import torch
 from sklearn.model_selection import train_test_split
 from torch_geometric.utils import dense_to_sparse
 
-from torch.nn import Linear, ModuleDict, ReLU
-from torch_geometric.nn import SAGEConv
+from torch.nn import Linear, ModuleDict, ReLU, Sequential
+from torch_geometric.nn import (
+    SAGEConv,
+    GCNConv,
+    GINConv,
+    GraphConv,
+    RGCNConv,
+    MessagePassing,
+)
 from torch_geometric.data import Data
 from torch_geometric.nn.aggr import (
     SumAggregation,
@@ -25,6 +32,18 @@ def prune_weights_below_threshold(module, threshold):
         param.data[param.abs() < threshold] = 0.0
 
 
+def dense_aggregate(A, x, aggr):
+    # Aggregates the features x (batch, n, f) of each node's neighbors in the dense, possibly fractional, adjacency matrices A (batch, n, n)
+    # The max is weighted by the adjacency, so it is only exact for binary A and nonnegative features (like one-hot features or ReLU outputs)
+    if aggr in ["add", "sum"]:
+        return A @ x
+    elif aggr == "mean":
+        return (A @ x) / A.sum(dim=-1, keepdim=True).clamp(min=1)
+    elif aggr == "max":
+        return (A.unsqueeze(-1) * x.unsqueeze(-3)).max(dim=-2).values
+    raise ValueError(f"Unknown aggregation {aggr}")
+
+
 class GNN(torch.nn.Module):
     aggr_classes = {
         "mean": MeanAggregation,
@@ -40,19 +59,27 @@ class GNN(torch.nn.Module):
         lin_features,
         global_aggr="mean",
         conv_aggr="mean",
-        device="cpu"
+        device="cpu",
+        conv_type="sage",
+        num_relations=None,
     ):
         super(GNN, self).__init__()
 
         self.device = device
+        self.conv_type = conv_type
+        self.num_relations = num_relations
 
         self.layers = ModuleDict()
 
         # Add convolutional layers
-        self.layers["Conv_0"] = SAGEConv(in_channels, conv_features[0], aggr=conv_aggr)
+        self.layers["Conv_0"] = self.make_conv(
+            in_channels, conv_features[0], conv_type, conv_aggr, num_relations
+        )
         self.layers["Conv_0_Relu"] = ReLU()
         for i, shape in enumerate(zip(conv_features, conv_features[1:])):
-            self.layers[f"Conv_{i+1}"] = SAGEConv(*shape, aggr=conv_aggr)
+            self.layers[f"Conv_{i+1}"] = self.make_conv(
+                *shape, conv_type, conv_aggr, num_relations
+            )
             self.layers[f"Conv_{i+1}_Relu"] = ReLU()
 
         # Add Global Pooling Layer
@@ -71,6 +98,38 @@ class GNN(torch.nn.Module):
             out_channels,
         )
 
+    @staticmethod
+    def make_conv(in_channels, out_channels, conv_type, conv_aggr, num_relations=None):
+        # GCNConv always sums its (normalized) neighbors, GINConv sums them and applies a two layer MLP
+        # RGCNConv has separate weights for the neighbors of each edge type (relation)
+        if conv_type == "sage":
+            return SAGEConv(in_channels, out_channels, aggr=conv_aggr)
+        elif conv_type == "gcn":
+            return GCNConv(in_channels, out_channels)
+        elif conv_type == "gin":
+            return GINConv(
+                Sequential(
+                    Linear(in_channels, out_channels),
+                    ReLU(),
+                    Linear(out_channels, out_channels),
+                ),
+                train_eps=True,
+            )
+        elif conv_type == "graph":
+            return GraphConv(
+                in_channels,
+                out_channels,
+                aggr="add" if conv_aggr == "sum" else conv_aggr,
+            )
+        elif conv_type == "rgcn":
+            return RGCNConv(
+                in_channels,
+                out_channels,
+                num_relations,
+                aggr="add" if conv_aggr == "sum" else conv_aggr,
+            )
+        raise ValueError(f"Unknown convolution type {conv_type}")
+
     def fix_data(self, data):
         # If the data does not have any batches, assign all the nodes to the same batch
         if data.batch is None:
@@ -78,37 +137,129 @@ class GNN(torch.nn.Module):
         # If there are no edge weights, assign weight 1 to all edges
         if data.edge_weight is None:
             data.edge_weight = torch.ones(data.edge_index.shape[1])
+        # Edge types are the index of the one-hot edge attributes (like MUTAG's bond types)
+        if "edge_type" not in data and data.edge_attr is not None:
+            data.edge_type = data.edge_attr.argmax(dim=1)
         data.x = data.x.to(next(self.parameters()).dtype)
         return data
 
     def forwardXA(self, X, A):
         # Same as forward, but takes node features and adjacency matrix instead of a Data object
+        # A can also be the stacked adjacency matrices of each edge type, with shape (num_relations, n, n)
         X = torch.Tensor(X)
-        A = torch.Tensor(A)
-        edge_index, edge_weight = dense_to_sparse(A.to(next(self.parameters()).device))
-        data = Data(x=X.to(self.device, next(self.parameters()).dtype), edge_index=edge_index, edge_weight=edge_weight)
+        A = torch.Tensor(A).to(next(self.parameters()).device)
+        edge_index, edge_weight = dense_to_sparse(A.sum(dim=0) if A.dim() == 3 else A)
+        data = Data(
+            x=X.to(self.device, next(self.parameters()).dtype),
+            edge_index=edge_index,
+            edge_weight=edge_weight,
+        )
+        if A.dim() == 3:
+            data.edge_type = A[:, edge_index[0], edge_index[1]].argmax(dim=0)
         return self.forward(data)
 
+    def conv(self, layer, x, data):
+        # Applies a message passing layer, RGCNConv layers also need the type of each edge
+        edge_index = data.edge_index.to(self.device)
+        if isinstance(layer, RGCNConv):
+            return layer(x, edge_index, data.edge_type.to(self.device))
+        return layer(x, edge_index)
+
     def forward(self, data):
         data = self.fix_data(data)
         x = data.x.to(self.device, next(self.parameters()).dtype)
-        edge_index = data.edge_index.to(self.device)
         for layer in self.layers.values():
-            if isinstance(layer, SAGEConv):
-                x = layer(x, edge_index)
+            if isinstance(layer, MessagePassing):
+                x = self.conv(layer, x, data)
             elif isinstance(layer, Aggregation):
                 x = layer(x, data.batch.to(self.device))
             else:
                 x = layer(x)
         return x.cpu()
 
+    def forward_dense(self, X, A, A_rel=None, return_all=False):
+        # Batched forward pass on dense node features X (batch, n, f) and adjacency matrices A (batch, n, n), which can be fractional
+        # A_rel (batch, num_relations, n, n) holds the adjacency matrices of each edge type, for RGCNConv layers
+        # Matches forward on binary graphs (up to the max aggregation, see dense_aggregate) and is differentiable with respect to X and A
+        dtype = next(self.parameters()).dtype
+        x = X.to(self.device, dtype)
+        A = A.to(self.device, dtype)
+        outputs = {}
+        for name, layer in self.layers.items():
+            if isinstance(layer, SAGEConv):
+                source = layer.lin(x).relu() if layer.project else x
+                out = layer.lin_l(dense_aggregate(A, source, layer.aggr))
+                if layer.root_weight:
+                    out = out + layer.lin_r(x)
+                x = (
+                    torch.nn.functional.normalize(out, p=2.0, dim=-1)
+                    if layer.normalize
+                    else out
+                )
+            elif isinstance(layer, GCNConv):
+                A_hat = A
+                if layer.add_self_loops:
+                    A_hat = A + (2 if layer.improved else 1) * torch.eye(
+                        A.shape[-1], device=A.device, dtype=dtype
+                    )
+                if layer.normalize:
+                    deg_inv_sqrt = A_hat.sum(dim=-1).pow(-0.5).nan_to_num(posinf=0.0)
+                    A_hat = (
+                        deg_inv_sqrt.unsqueeze(-1) * A_hat * deg_inv_sqrt.unsqueeze(-2)
+                    )
+                x = A_hat @ layer.lin(x)
+                if layer.bias is not None:
+                    x = x + layer.bias
+            elif isinstance(layer, GINConv):
+                x = layer.nn((1 + layer.eps) * x + A @ x)
+            elif isinstance(layer, GraphConv):
+                x = layer.lin_rel(dense_aggregate(A, x, layer.aggr)) + layer.lin_root(x)
+            elif isinstance(layer, RGCNConv):
+                weight = layer.weight
+                if layer.num_bases is not None:
+                    weight = (layer.comp @ weight.view(layer.num_bases, -1)).view(
+                        layer.num_relations, *weight.shape[1:]
+                    )
+                elif layer.num_blocks is not None:
+                    weight = torch.stack(
+                        [torch.block_diag(*blocks) for blocks in weight]
+                    )
+                A_rel = A_rel.to(self.device, dtype)
+                out = sum(
+                    dense_aggregate(A_rel[:, r], x, layer.aggr) @ weight[r]
+                    for r in range(layer.num_relations)
+                )
+                if layer.root is not None:
+                    out = out + x @ layer.root
+                x = out + layer.bias if layer.bias is not None else out
+            elif isinstance(layer, MessagePassing):
+                raise NotImplementedError(
+                    f"{type(layer).__name__} has no dense forward pass"
+                )
+            elif isinstance(layer, Aggregation):
+                # Global pooling over the nodes of each graph
+                if isinstance(layer, SumAggregation):
+                    x = x.sum(dim=-2)
+                elif isinstance(layer, MeanAggregation):
+                    x = x.mean(dim=-2)
+                elif isinstance(layer, MaxAggregation):
+                    x = x.max(dim=-2).values
+                else:
+                    raise NotImplementedError(
+                        f"{type(layer).__name__} has no dense forward pass"
+                    )
+            else:
+                # Node-wise layers (Linear, ReLU, ...) see the nodes of all graphs as one batch
+                x = layer(x.reshape(-1, x.shape[-1])).reshape(*x.shape[:-1], -1)
+            outputs[name] = x
+        return outputs if return_all else x
+
     def get_all_layer_outputs(self, data):
         data = self.fix_data(data)
         outputs = [("Input", data.x.to(self.device, next(self.parameters()).dtype))]
-        edge_index = data.edge_index.to(self.device)
         for name, layer in self.layers.items():
-            if isinstance(layer, SAGEConv):
-                outputs.append((name, layer(outputs[-1][1], edge_index)))
+            if isinstance(layer, MessagePassing):
+                outputs.append((name, self.conv(layer, outputs[-1][1], data)))
             elif isinstance(layer, Aggregation):
                 outputs.append((name, layer(outputs[-1][1], data.batch.to(self.device))))
             else:
@@ -118,12 +269,11 @@ class GNN(torch.nn.Module):
     def get_layer_output(self, data, layer_name):
         data = self.fix_data(data)
         x = data.x.to(self.device, next(self.parameters()).dtype)
-        edge_index = data.edge_index.to(self.device)
         if layer_name not in self.layers:
             raise ValueError(f"Network has no layer with name {layer_name}")
         for name, layer in self.layers.items():
-            if isinstance(layer, SAGEConv):
-                x = layer(x, edge_index)
+            if isinstance(layer, MessagePassing):
+                x = self.conv(layer, x, data)
             elif isinstance(layer, Aggregation):
                 x = layer(x, data.batch.to(self.device))
             else:
@@ -186,7 +336,7 @@ if __name__ == "__main__":
     epochs = 20
     num_inits = 5
     num_explanations = 3
-    conv_type = "sage"
+    conv_type = "sage"  # "rgcn" uses the edge types of datasets with one-hot edge attributes, like MUTAG
     global_aggr = "mean"
     conv_aggr = "sum"
     prune_threshold = 1e-5
@@ -225,6 +375,7 @@ if __name__ == "__main__":
     print("YS", ys[:10])
     num_classes = len(set(ys))
     num_node_features = dataset[0].x.shape[1]
+    num_relations = dataset[0].edge_attr.shape[1] if conv_type == "rgcn" else None
     train_dataset, test_dataset = train_test_split(
         dataset, train_size=0.8, stratify=ys, random_state=7
     )
@@ -254,6 +405,8 @@ if __name__ == "__main__":
             lin_features=[8],
             global_aggr=global_aggr,
             conv_aggr=conv_aggr,
+            conv_type=conv_type,
+            num_relations=num_relations,
         )
         model.to(torch.float64)
         # optimizer = torch.optim.AdamW(model.parameters(), weight_decay=0.0001)
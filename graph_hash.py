@@ -0,0 +1,47 @@
+import hashlib
+import numpy as np
+
+
+def wl_colors(A, X, iterations=None, decimals=6):
+    # Weisfeiler-Lehman color refinement on a dense adjacency matrix and node feature matrix
+    # Colors are numbered by the sorted order of their signatures, so they don't depend on the node ordering
+    # Yields the signatures of each round (the node's previous color followed by the count of each color among its neighbors),
+    # along with the number of nodes that have each signature
+    # A can also be the stacked adjacency matrices of each edge type, with shape (num_relations, n, n), whose neighbors are counted separately
+    A = np.round(np.asarray(A)).astype(np.int64)
+    n = A.shape[-1]
+    A = A.reshape(-1, n, n)
+    X = np.round(np.asarray(X, dtype=np.float64).reshape(n, -1), decimals)
+    signatures, colors, counts = np.unique(
+        X, axis=0, return_inverse=True, return_counts=True
+    )
+    colors = colors.reshape(-1)
+    yield signatures, counts
+    num_colors = len(signatures)
+    for _ in range(n if iterations is None else iterations):
+        onehot_colors = np.eye(num_colors, dtype=np.int64)[colors]
+        neighbor_counts = np.hstack([A_r @ onehot_colors for A_r in A])
+        signatures, colors, counts = np.unique(
+            np.column_stack([colors, neighbor_counts]),
+            axis=0,
+            return_inverse=True,
+            return_counts=True,
+        )
+        colors = colors.reshape(-1)
+        yield signatures, counts
+        # The partition is stable once no color class is split further
+        if len(signatures) == num_colors:
+            break
+        num_colors = len(signatures)
+
+
+def wl_hash(A, X, iterations=None, decimals=6):
+    # Isomorphism-invariant hash of a graph: isomorphic graphs always have the same hash
+    # Non-isomorphic graphs can only collide if WL refinement can't tell them apart, in which case message passing GNNs can't either
+    A = np.asarray(A)
+    digest = hashlib.sha1(np.array(A.shape, dtype=np.int64).tobytes())
+    for signatures, counts in wl_colors(A, X, iterations, decimals):
+        digest.update(np.array(signatures.shape, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(signatures).tobytes())
+        digest.update(counts.astype(np.int64).tobytes())
+    return digest.hexdigest()
@@ -1,38 +1,58 @@
 import gurobipy as gp
+from gurobipy import GRB
 import numpy as np
+import scipy.sparse as sp
 from numpy.linalg import norm
-from torch.nn import Linear, ReLU, Conv2d, MaxPool2d, Flatten
-from torch_geometric.nn.aggr import SumAggregation, MeanAggregation
-from torch_geometric.nn import SAGEConv
 from math import floor
-from tqdm.autonotebook import tqdm
+from outer_approximation import (
+    NormCut,
+    SquareCut,
+    MeanAggregationCut,
+    ConnectivityCut,
+)
 
 
 def invert_torch_layer(model, layer, **kwargs):
-    if isinstance(layer, Linear):
-        return torch_fc_constraint(model, layer=layer, **kwargs)
-    elif isinstance(layer, SAGEConv):
-        return torch_sage_constraint(model, layer=layer, **kwargs)
-    elif isinstance(layer, MeanAggregation):
-        return global_mean_pool(model, **kwargs)
-    elif isinstance(layer, SumAggregation):
-        return global_add_pool(model, **kwargs)
-    elif isinstance(layer, ReLU):
-        return add_relu_constraint(model, **kwargs)
-    elif isinstance(layer, Conv2d):
-        return add_torch_conv2d_constraint(model, layer, **kwargs)
-    elif isinstance(layer, MaxPool2d):
-        return add_torch_maxpool2d_constraint(model, layer, **kwargs)
-    elif isinstance(layer, Flatten):
-        return flatten(**kwargs)
-    else:
+    # Encodes a layer with the encoder registered for its type, see layer_encoders.py
+    # The registry imports torch and PyG, so it is not imported with the module
+    from layer_encoders import get_layer_encoder
+
+    encoder = get_layer_encoder(layer)
+    if encoder is None:
         raise NotImplementedError(f"layer type {layer} has no MIQCP analog")
+    return encoder.encode(model, layer, **kwargs)
+
+
+def get_coefficients(weight, max_density=0.5):
+    # Weight matrices with enough zeros are passed to the encoders as sparse matrices, so zero coefficients are never added to the model
+    if np.count_nonzero(weight) <= max_density * weight.size:
+        return sp.csr_matrix(weight)
+    return weight
+
+
+def add_affine_constraint(model, ts, terms, b, name=None):
+    # Constrains ts == sum(X @ W.T for X, W in terms) + b
+    # If any W is sparse, the constraint is added row by row as W @ x for each row x of X, which only uses W's nonzeros
+    b = np.asarray(b).reshape(1, -1)
+    if not any(sp.issparse(W) for _, W in terms):
+        return model.addConstr(ts == sum(X @ W.T for X, W in terms) + b, name=name)
+    return [
+        model.addConstr(
+            ts[i, :] == sum(W @ X[i, :] for X, W in terms) + b[0],
+            name=f"{name}[{i}]" if name else None,
+        )
+        for i in range(ts.shape[0])
+    ]
 
 
 def get_matmul_bounds(V, W):
-    # Define the bounds of AW, where A is a matrix of decision variables and W is a matrix of fixed scalars
-    lower_bounds = (V.getAttr("lb") @ W.clip(min=0)) + (V.getAttr("ub") @ W.clip(max=0))
-    upper_bounds = (V.getAttr("ub") @ W.clip(min=0)) + (V.getAttr("lb") @ W.clip(max=0))
+    # Define the bounds of AW, where A is a matrix of decision variables and W is a matrix of fixed scalars (dense or sparse)
+    if sp.issparse(W):
+        W_pos, W_neg = W.maximum(0), W.minimum(0)
+    else:
+        W_pos, W_neg = W.clip(min=0), W.clip(max=0)
+    lower_bounds = (V.getAttr("lb") @ W_pos) + (V.getAttr("ub") @ W_neg)
+    upper_bounds = (V.getAttr("ub") @ W_pos) + (V.getAttr("lb") @ W_neg)
     if not np.less_equal(lower_bounds, upper_bounds).all():
         breakpoint()
     assert np.less_equal(lower_bounds, upper_bounds).all()
@@ -45,13 +65,13 @@ def add_fc_constraint(model, X, W, b, name=None):
     # if name == "fc2":
     #     breakpoint()
     ts = model.addMVar(
-        (1, W.shape[0]),
+        (X.shape[0], W.shape[0]),
         lb=lower_bounds + b,
         ub=upper_bounds + b,
         name=f"{name}_t" if name else None,
     )
-    model.addConstr(
-        ts == X @ W.T + b, name=f"{name}_output_constraint" if name else None
+    add_affine_constraint(
+        model, ts, [(X, W)], b, name=f"{name}_output_constraint" if name else None
     )
     return ts
 
@@ -60,7 +80,7 @@ def flatten(X, name=None, **kwargs):
     return X.reshape((1, -1), order="C")  # TODO: Check order
 
 
-def add_torch_maxpool2d_constraint(model, layer, X, name=None):
+def add_torch_maxpool2d_constraint(model, layer, X, name=None, **kwargs):
     model.update()
 
     N = X.shape[0]
@@ -103,6 +123,9 @@ def add_torch_maxpool2d_constraint(model, layer, X, name=None):
 
     stride = layer.stride
 
+    # Imported here, only image models need progress bars
+    from tqdm.autonotebook import tqdm
+
     for channel in tqdm(range(C), desc=name):
         for i in range(0, Hout):
             for j in range(0, Wout):
@@ -131,7 +154,7 @@ def add_torch_maxpool2d_constraint(model, layer, X, name=None):
     return ts
 
 
-def add_torch_conv2d_constraint(model, layer, X, name=None):
+def add_torch_conv2d_constraint(model, layer, X, name=None, **kwargs):
     model.update()
 
     weight = layer.weight.cpu().detach().numpy()
@@ -188,6 +211,8 @@ def add_torch_conv2d_constraint(model, layer, X, name=None):
         X_array[:, :, 0 : 0 + weight[0].shape[-2], 0 : 0 + weight[0].shape[-1]].shape,
     )
 
+    from tqdm.autonotebook import tqdm
+
     # TODO: Parallelize
     for kernel_index in tqdm(range(Cout), desc=name):
         kernel = weight[kernel_index]
@@ -248,17 +273,134 @@ def add_torch_conv2d_constraint(model, layer, X, name=None):
     return ts
 
 
-def add_gcn_constraint(model, A, X, W, b, name=None):  # Unnormalized Adjacency Matrix
+def add_neighbor_sums(model, A, X, outer_approx=None, name=None):
+    # Returns variables constrained to A @ X, the sums of each node's neighbors' features
+    # Like the sum aggregation of SAGEConv, the products are quadratic unless outer_approx is given, then they are linearized exactly
     model.update()
-    lower_bounds, upper_bounds = get_matmul_bounds(X, W.T)
+    neighbor_sums = model.addMVar(
+        X.shape,
+        lb=A.getAttr("ub") @ X.getAttr("lb").clip(max=0),
+        ub=A.getAttr("ub") @ X.getAttr("ub").clip(min=0),
+        name=name,
+    )
+    if outer_approx is None:
+        products = A @ X
+    else:
+        products = add_binary_product(model, A, X, name=f"{name}_products").sum(axis=1)
+    model.addConstr(
+        neighbor_sums == products, name=f"{name}_constraint" if name else None
+    )
+    return neighbor_sums
+
+
+def add_gcn_constraint(
+    model, A, X, W, b, name=None, outer_approx=None
+):  # Unnormalized Adjacency Matrix
+    # Returns A @ X @ W + b, the bounds are those of the neighbor sums A @ X multiplied by W
+    neighbor_sums = add_neighbor_sums(
+        model, A, X, outer_approx=outer_approx, name=f"{name}_neighbor_sums"
+    )
+    model.update()
+    lower_bounds, upper_bounds = get_matmul_bounds(neighbor_sums, W)
     ts = model.addMVar(
         (A.shape[0], W.shape[1]),
         lb=lower_bounds + b,
         ub=upper_bounds + b,
         name=f"{name}_t" if name else None,
     )
+    add_affine_constraint(
+        model,
+        ts,
+        [(neighbor_sums, W.T)],
+        b,
+        name=f"{name}_output_constraint" if name else None,
+    )
+    return ts
+
+
+def add_degree_scaling(model, X, degree_indicators, scales, name=None):
+    # Returns Y with Y[i] == scales[d] * X[i] for the d with degree_indicators[i, d] == 1, linearized exactly with the bounds of X
+    model.update()
+    lb, ub = X.getAttr("lb")[:, np.newaxis, :], X.getAttr("ub")[:, np.newaxis, :]
+    indicators, X_i = degree_indicators[:, :, np.newaxis], X[:, np.newaxis, :]
+    # P[i, d] is X[i] if node i has degree d and 0 otherwise
+    P = model.addMVar(
+        (X.shape[0], len(scales), X.shape[1]),
+        lb=np.broadcast_to(lb.clip(max=0), (X.shape[0], len(scales), X.shape[1])),
+        ub=np.broadcast_to(ub.clip(min=0), (X.shape[0], len(scales), X.shape[1])),
+        name=f"{name}_products",
+    )
+    model.addConstr(P <= ub * indicators, name=f"{name}_mccormick_1")
+    model.addConstr(P >= lb * indicators, name=f"{name}_mccormick_2")
+    model.addConstr(P <= X_i - lb * (1 - indicators), name=f"{name}_mccormick_3")
+    model.addConstr(P >= X_i - ub * (1 - indicators), name=f"{name}_mccormick_4")
+    low, high = scales.min(), scales.max()
+    Y = model.addMVar(
+        X.shape,
+        lb=np.minimum(X.getAttr("lb") * low, X.getAttr("lb") * high),
+        ub=np.maximum(X.getAttr("ub") * low, X.getAttr("ub") * high),
+        name=name,
+    )
     model.addConstr(
-        ts == A @ X @ W + b, name=f"{name}_output_constraint" if name else None
+        Y == (P * scales[np.newaxis, :, np.newaxis]).sum(axis=1),
+        name=f"{name}_constraint",
+    )
+    return Y
+
+
+def add_normalized_gcn_constraint(
+    model, A, X, W, b, self_loop_weight=1, name=None, outer_approx=None
+):
+    # Returns the output of a GCNConv layer with symmetric normalization, D^-1/2 (A + self_loop_weight * I) D^-1/2 X W^T + b
+    # Node degrees are one-hot indicators, so the normalization is exact: features are scaled by D^-1/2 before and after aggregation
+    model.update()
+    n = A.shape[0]
+    H = add_fc_constraint(model, X, W, np.zeros(W.shape[0]), name=f"{name}_lin")
+
+    # degrees[i, d] indicates that node i has degree self_loop_weight + d (as in PyTorch Geometric, nodes with degree 0 are scaled by 0)
+    degree_values = self_loop_weight + np.arange(n)
+    scales = np.divide(
+        1,
+        np.sqrt(degree_values),
+        out=np.zeros(n),
+        where=degree_values > 0,
+    )
+    degrees = model.addMVar((n, n), vtype=GRB.BINARY, name=f"{name}_degrees")
+    model.addConstr(degrees.sum(axis=1) == 1, name=f"{name}_one_degree")
+    model.addConstr(
+        degrees @ np.arange(n) == A.sum(axis=1), name=f"{name}_degree_constraint"
+    )
+
+    scaled = add_degree_scaling(model, H, degrees, scales, name=f"{name}_scaled")
+    neighbor_sums = add_neighbor_sums(
+        model, A, scaled, outer_approx=outer_approx, name=f"{name}_neighbor_sums"
+    )
+    model.update()
+    propagated = model.addMVar(
+        H.shape,
+        lb=neighbor_sums.getAttr("lb")
+        + self_loop_weight * scaled.getAttr("lb").clip(max=0),
+        ub=neighbor_sums.getAttr("ub")
+        + self_loop_weight * scaled.getAttr("ub").clip(min=0),
+        name=f"{name}_propagated",
+    )
+    model.addConstr(
+        propagated == neighbor_sums + self_loop_weight * scaled,
+        name=f"{name}_propagated_constraint",
+    )
+    normalized = add_degree_scaling(
+        model, propagated, degrees, scales, name=f"{name}_normalized"
+    )
+    model.update()
+    ts = model.addMVar(
+        H.shape,
+        lb=normalized.getAttr("lb") + b,
+        ub=normalized.getAttr("ub") + b,
+        name=f"{name}_t" if name else None,
+    )
+    model.addConstr(
+        ts == normalized + b.reshape(1, -1),
+        name=f"{name}_output_constraint" if name else None,
     )
     return ts
 
@@ -292,13 +434,43 @@ def force_undirected(model, A):
 #         model.addConstr(gp.quicksum(A[i][j] + A[j][i] for j in range(i+1,A.shape[0])) >= 1, name=f"node_{i}_connected")
 
 
-def force_connected(model, A):
-    # Enforce partial ordering on nodes to ensure connectivity
-    for i in range(1, A.shape[0]):
-        model.addConstr(
-            gp.quicksum(A[i][j] + A[j][i] for j in range(i)) >= 1,
-            name=f"node_{i}_connected",
+def force_connected(model, A, method="ordering", lazy_constraints=None, node_mask=None):
+    # Constrains the graph with adjacency matrix A to be connected
+    # "ordering": every node connects to an earlier node, which is compact but only allows node orderings where that holds
+    # "lazy": cut-set constraints are added from the solver callback whenever an incumbent is disconnected, needs lazy_constraints
+    # "flow": node 0 sends one unit of flow to every other node along the edges of the graph
+    # If node_mask is given, only active nodes have to be connected, node 0 has to be active and active nodes have to come first
+    num_nodes = A.shape[0]
+    active = np.ones(num_nodes) if node_mask is None else node_mask
+    if method == "ordering":
+        for i in range(1, num_nodes):
+            model.addConstr(
+                gp.quicksum(A[i][j] + A[j][i] for j in range(i)) >= active[i],
+                name=f"node_{i}_connected",
+            )
+    elif method == "lazy":
+        if lazy_constraints is None:
+            raise ValueError(
+                "Lazy connectivity constraints need a lazy_constraints collection"
+            )
+        if num_nodes > 1:
+            # The cut-sets of single nodes are cheap enough to add up front
+            # Node 1 is active whenever there is more than one active node
+            model.addConstr(
+                A.sum(axis=0) + A.sum(axis=1) >= active + active[1] - 1,
+                name="node_connected",
+            )
+        lazy_constraints.add(ConnectivityCut(A, node_mask))
+    elif method == "flow":
+        flow = model.addMVar(
+            (num_nodes, num_nodes), lb=0, ub=num_nodes - 1, name="connectivity_flow"
         )
+        model.addConstr(flow <= (num_nodes - 1) * A, name="flow_on_edges")
+        net_inflow = flow.sum(axis=0) - flow.sum(axis=1)
+        model.addConstr(net_inflow[1:] == active[1:], name="flow_conservation")
+        model.addConstr(net_inflow[0] == -active[1:].sum(), name="flow_source")
+    else:
+        raise ValueError(f"Unknown connectivity method {method}")
 
 
 def order_onehot_features(model, A, X):
@@ -333,28 +505,111 @@ def lex_adj_matrix(model, A):
 #     return ts
 
 
-def add_relu_constraint(model, X, name=None, **kwargs):
+def add_relu_constraint(model, X, name=None, dead=None, active=None, **kwargs):
     # Returns a matrix of decision variables constrained to ReLU(X), where X is also a matrix of decision variables
+    # Units that are dead (given or ub <= 0) are fixed to 0 and units that are active (given or lb >= 0) are equal to their input,
+    # only the remaining units get a max constraint
     model.update()
-    print("X UB < 0 COUNT:", np.less(X.getAttr("ub"), 0).sum())
-    print("X LB > 0 COUNT:", np.greater(X.getAttr("lb"), 0).sum())
+    lb, ub = X.getAttr("lb"), X.getAttr("ub")
+    print("X UB < 0 COUNT:", np.less(ub, 0).sum())
+    print("X LB > 0 COUNT:", np.greater(lb, 0).sum())
+    dead = np.less_equal(ub, 0) | (
+        False if dead is None else np.broadcast_to(dead, X.shape)
+    )
+    active = (
+        np.greater_equal(lb, 0)
+        | (False if active is None else np.broadcast_to(active, X.shape))
+    ) & ~dead
+    # Active units pass their input through, even if it can be negative
     ts = model.addMVar(
         X.shape,
-        lb=X.getAttr("lb").clip(min=0),
-        ub=X.getAttr("ub").clip(min=0),
+        lb=np.where(dead, 0, np.where(active, lb, lb.clip(min=0))),
+        ub=np.where(dead, 0, ub.clip(min=0)),
         name=f"{name}_ts",
     )
 
     X_list = np.array(X.tolist()).flatten()
     t_list = np.array(ts.tolist()).flatten()
+    active, dead = active.flatten(), dead.flatten()
 
     model.update()
 
-    for i, (x, t) in enumerate(zip(X_list, t_list)):
-        model.addGenConstrMax(t, [x], constant=0, name=f"{name}_constraint_{i}")
+    if active.any():
+        model.addConstr(
+            gp.MVar.fromlist(t_list[active].tolist())
+            == gp.MVar.fromlist(X_list[active].tolist()),
+            name=f"{name}_active",
+        )
+    for i in np.flatnonzero(~active & ~dead):
+        model.addGenConstrMax(
+            t_list[i], [X_list[i]], constant=0, name=f"{name}_constraint_{i}"
+        )
     return ts
 
 
+def neighbor_aggregation_bounds(A_lb, A_ub, X_lb, X_ub, aggr="mean"):
+    # Bounds on the aggregated features of each node's neighborhood, given bounds on the adjacency matrix and on the features
+    if aggr == "sum":
+        return A_ub @ X_lb.clip(max=0), A_ub @ X_ub.clip(min=0)
+    if aggr in ["mean", "max"]:
+        A_lb, A_ub = A_lb[:, :, np.newaxis], A_ub[:, :, np.newaxis]
+        lb, ub = X_lb[np.newaxis, :, :], X_ub[np.newaxis, :, :]
+        # The mean and max are within the bounds of the possible neighbors, or 0 for nodes that can have no neighbors
+        has_fixed_neighbor = (A_lb > 0.5).any(axis=1)
+        neighbors_lb = np.where(A_ub > 0.5, lb, np.inf).min(axis=1)
+        neighbors_ub = np.where(A_ub > 0.5, ub, -np.inf).max(axis=1)
+        if aggr == "mean":
+            return (
+                np.where(has_fixed_neighbor, neighbors_lb, np.minimum(neighbors_lb, 0)),
+                np.where(has_fixed_neighbor, neighbors_ub, np.maximum(neighbors_ub, 0)),
+            )
+        # Nodes with a fixed neighbor have a max of at least that neighbor's lower bound
+        fixed_neighbors_lb = np.where(A_lb > 0.5, lb, -np.inf).max(axis=1)
+        return (
+            np.where(
+                has_fixed_neighbor, fixed_neighbors_lb, np.minimum(neighbors_lb, 0)
+            ),
+            np.where(has_fixed_neighbor, neighbors_ub, np.maximum(neighbors_ub, 0)),
+        )
+    raise NotImplementedError(f"{aggr} aggregation has no encoding")
+
+
+def add_neighbor_aggregation(
+    model, aggregated_features, A, X, aggr="mean", outer_approx=None, name=None
+):
+    # Constrains aggregated_features to the mean, sum or max of each node's neighbors' features, its bounds must already be set
+    # If outer_approx is given, the mean and sum are linearized and their quadratic terms are refined lazily
+    if aggr == "mean":
+        # aggregated_features[i][j] is the sum of all node i's neighbors' feature j divided by the number of node i's neighbors
+        # The product with the degree leaves it free for nodes without neighbors, which aggregate to 0 in PyTorch Geometric
+        add_empty_neighborhood(model, aggregated_features, A, name=name)
+        if outer_approx is None:
+            model.addConstr(
+                aggregated_features * gp.quicksum(A)[:, np.newaxis] == A @ X,
+                name=f"{name}_averages_constraint" if name else None,
+            )  # may need to transpose
+        else:
+            add_mean_aggregation_outer(
+                model, aggregated_features, A, X, outer_approx, name=name
+            )
+    elif aggr == "sum":
+        if outer_approx is None:
+            neighbor_sums = A @ X
+        else:
+            neighbor_sums = add_binary_product(
+                model, A, X, name=f"{name}_products"
+            ).sum(axis=1)
+        model.addConstr(
+            aggregated_features == neighbor_sums,
+            name=f"{name}_sum_constraint" if name else None,
+        )
+    elif aggr == "max":
+        add_max_aggregation(model, aggregated_features, A, X, name=name)
+    else:
+        raise NotImplementedError(f"{aggr} aggregation has no encoding")
+    model.update()
+
+
 def add_sage_constraint(
     model,
     A,
@@ -367,9 +622,11 @@ def add_sage_constraint(
     project=False,
     name=None,
     aggr="mean",
+    outer_approx=None,
     **kwargs,
 ):
     # Returns the output of a GraphSAGE convolutional layer, see the implementation in PyTorch-Geometric for details about the parameters
+    # If outer_approx is given, the aggregation is linearized and its quadratic terms are refined lazily
     model.update()
     if project:
         X = add_fc_constraint(
@@ -378,33 +635,25 @@ def add_sage_constraint(
         X = add_relu_constraint(model, X, name=name + "projection_relu")
 
     # Create decision variables to store the aggregated features of each node's neighborhood
+    model.update()
+    aggregated_lb, aggregated_ub = neighbor_aggregation_bounds(
+        A.getAttr("lb"), A.getAttr("ub"), X.getAttr("lb"), X.getAttr("ub"), aggr
+    )
     aggregated_features = model.addMVar(
-        X.shape, lb=-float("inf"), ub=float("inf"), name=f"{name}_aggregated_features"
+        X.shape,
+        lb=aggregated_lb,
+        ub=aggregated_ub,
+        name=f"{name}_aggregated_features",
+    )
+    add_neighbor_aggregation(
+        model,
+        aggregated_features,
+        A,
+        X,
+        aggr=aggr,
+        outer_approx=outer_approx,
+        name=name,
     )
-
-    model.update()
-
-    if aggr == "mean":
-        # aggregated_features[i][j] is the sum of all node i's neighbors' feature j divided by the number of node i's neighbors
-        # Ensure gp.quicksum(A) does not have any zeros
-        aggregated_features.setAttr(
-            "lb", (A.getAttr("ub") @ X.getAttr("lb").clip(max=0)) / X.shape[0]
-        )
-        aggregated_features.setAttr(
-            "ub", (A.getAttr("ub") @ X.getAttr("ub").clip(min=0)) / X.shape[0]
-        )
-        model.addConstr(
-            aggregated_features * gp.quicksum(A)[:, np.newaxis] == A @ X,
-            name=f"{name}_averages_constraint" if name else None,
-        )  # may need to transpose
-    elif aggr == "sum":
-        aggregated_features.setAttr("lb", A.getAttr("ub") @ X.getAttr("lb").clip(max=0))
-        aggregated_features.setAttr("ub", A.getAttr("ub") @ X.getAttr("ub").clip(min=0))
-
-        model.addConstr(
-            aggregated_features == A @ X,
-            name=f"{name}_sum_constraint" if name else None,
-        )
 
     model.update()
 
@@ -432,24 +681,226 @@ def add_sage_constraint(
     )
 
     assert ts_lower_bounds.shape == first_lower_bounds.shape
-    assert first_lower_bounds.shape == (X @ lin_r_weight.T).shape
-    assert second_lower_bounds.shape == (aggregated_features @ lin_l_weight.T).shape
+    assert first_lower_bounds.shape == (X.shape[0], lin_r_weight.shape[0])
+    assert second_lower_bounds.shape == (X.shape[0], lin_l_weight.shape[0])
     assert first_lower_bounds.shape == second_lower_bounds.shape
 
     # Constrain outputs to correct values
-    model.addConstr(
-        ts
-        == (X @ lin_r_weight.T)
-        + (aggregated_features @ lin_l_weight.T)
-        + np.expand_dims(lin_l_bias, 0),
+    add_affine_constraint(
+        model,
+        ts,
+        [(X, lin_r_weight), (aggregated_features, lin_l_weight)],
+        lin_l_bias,
         name=f"{name}_output_constraint" if name else None,
     )
     return ts
 
 
-def global_add_pool(model, X, name=None, **kwargs):
-    # Outputs variables constrained to the sum of node features element-wise
+def add_binary_product(model, A, X, name=None):
+    # Returns P with P[i, j, k] == A[i, j] * X[j, k] for binary A, linearized exactly with the bounds of X
     model.update()
+    X_lb, X_ub = X.getAttr("lb")[np.newaxis, :, :], X.getAttr("ub")[np.newaxis, :, :]
+    A_ub = A.getAttr("ub")[:, :, np.newaxis]
+    A_i, X_j = A[:, :, np.newaxis], X[np.newaxis, :, :]
+    P = model.addMVar(
+        (A.shape[0], A.shape[1], X.shape[1]),
+        lb=(A_ub * X_lb).clip(max=0),
+        ub=(A_ub * X_ub).clip(min=0),
+        name=name,
+    )
+    model.addConstr(P <= X_ub * A_i, name=f"{name}_mccormick_1" if name else None)
+    model.addConstr(P >= X_lb * A_i, name=f"{name}_mccormick_2" if name else None)
+    model.addConstr(
+        P <= X_j - X_lb * (1 - A_i), name=f"{name}_mccormick_3" if name else None
+    )
+    model.addConstr(
+        P >= X_j - X_ub * (1 - A_i), name=f"{name}_mccormick_4" if name else None
+    )
+    return P
+
+
+def add_mean_aggregation_outer(
+    model, aggregated_features, A, X, outer_approx, name=None
+):
+    # Linear relaxation of aggregated_features * degree == A @ X
+    # The neighbor sums are exact, the product with the degree starts as a McCormick envelope and is refined lazily
+    model.update()
+    n = A.shape[0]
+    neighbor_sums = model.addMVar(
+        X.shape,
+        lb=A.getAttr("ub") @ X.getAttr("lb").clip(max=0),
+        ub=A.getAttr("ub") @ X.getAttr("ub").clip(min=0),
+        name=f"{name}_neighbor_sums",
+    )
+    model.addConstr(
+        neighbor_sums
+        == add_binary_product(model, A, X, name=f"{name}_products").sum(axis=1),
+        name=f"{name}_neighbor_sums_constraint",
+    )
+
+    # degrees[i, d] indicates that node i has d neighbors
+    degrees = model.addMVar((n, n), vtype=GRB.BINARY, name=f"{name}_degrees")
+    degree = model.addMVar((n, 1), lb=0, ub=n - 1, name=f"{name}_degree")
+    model.addConstr(degrees.sum(axis=1) == 1, name=f"{name}_one_degree")
+    model.addConstr(
+        degree[:, 0] == degrees @ np.arange(n), name=f"{name}_degree_indicators"
+    )
+    model.addConstr(degree[:, 0] == A.sum(axis=1), name=f"{name}_degree_constraint")
+
+    # McCormick envelope of aggregated_features * degree with degree in [0, n-1]
+    lb, ub = aggregated_features.getAttr("lb"), aggregated_features.getAttr("ub")
+    model.addConstr(neighbor_sums >= lb * degree, name=f"{name}_mccormick_1")
+    model.addConstr(
+        neighbor_sums >= ub * degree + (n - 1) * aggregated_features - ub * (n - 1),
+        name=f"{name}_mccormick_2",
+    )
+    model.addConstr(neighbor_sums <= ub * degree, name=f"{name}_mccormick_3")
+    model.addConstr(
+        neighbor_sums <= lb * degree + (n - 1) * aggregated_features - lb * (n - 1),
+        name=f"{name}_mccormick_4",
+    )
+
+    outer_approx.add(MeanAggregationCut(aggregated_features, neighbor_sums, degrees))
+
+
+def add_max_selection(model, maxes, values, available=None, selected=None, name=None):
+    # maxes has shape (p,) and values and available have shape (p, c), all are arrays of variables (available binary)
+    # Constrains maxes[i] to the largest values[i, j] over the j with available[i, j] == 1 (all j if available is None)
+    # One candidate of row i is selected if selected[i] == 1 (always if selected is None), otherwise maxes[i] is only bounded below
+    # Candidates that can't reach the lower bound of maxes[i] or are never available are dominated, they get no constraints or binaries
+    model.update()
+
+    def get_bounds(variables):
+        return [
+            np.array(model.getAttr(attr, variables.flatten().tolist())).reshape(
+                variables.shape
+            )
+            for attr in ["lb", "ub"]
+        ]
+
+    maxes_lb, maxes_ub = get_bounds(maxes)
+    values_lb, values_ub = get_bounds(values)
+    candidates = values_ub >= maxes_lb[:, np.newaxis]
+    if available is not None:
+        candidates &= get_bounds(available)[1] > 0.5
+    rows, cols = np.nonzero(candidates)
+
+    max_vars = gp.MVar.fromlist(maxes[rows].tolist())
+    candidate_vars = gp.MVar.fromlist(values[rows, cols].tolist())
+    selection = model.addMVar((len(rows),), vtype=GRB.BINARY, name=f"{name}_selection")
+    if available is None:
+        unavailable = 0
+    else:
+        available_vars = gp.MVar.fromlist(available[rows, cols].tolist())
+        unavailable = 1 - available_vars
+        model.addConstr(selection <= available_vars, name=f"{name}_selection_available")
+    # The max is at least every available candidate, and at most the selected one
+    model.addConstr(
+        max_vars
+        >= candidate_vars - (values_ub[rows, cols] - maxes_lb[rows]) * unavailable,
+        name=f"{name}_lower",
+    )
+    model.addConstr(
+        max_vars
+        <= candidate_vars + (maxes_ub[rows] - values_lb[rows, cols]) * (1 - selection),
+        name=f"{name}_upper",
+    )
+    rows_of_candidates = sp.csr_matrix(
+        (np.ones(len(rows)), (rows, np.arange(len(rows)))),
+        shape=(len(maxes), len(rows)),
+    )
+    model.addConstr(
+        rows_of_candidates @ selection
+        == (1 if selected is None else gp.MVar.fromlist(selected.tolist())),
+        name=f"{name}_one_selected",
+    )
+    return selection
+
+
+def add_empty_neighborhood(model, aggregated_features, A, name=None):
+    # Forces aggregated_features[i] to 0 if node i has no neighbors, returns the binary indicators of nodes with neighbors
+    # 0 is within the bounds of aggregated_features unless a neighbor is fixed, see neighbor_aggregation_bounds
+    model.update()
+    has_neighbors = model.addMVar(
+        (A.shape[0],), vtype=GRB.BINARY, name=f"{name}_has_neighbors"
+    )
+    model.addConstr(has_neighbors <= A.sum(axis=1), name=f"{name}_no_neighbors")
+    has_any = has_neighbors.reshape(-1, 1)
+    model.addConstr(has_any >= A, name=f"{name}_some_neighbors")
+    model.addConstr(
+        aggregated_features <= aggregated_features.getAttr("ub") * has_any,
+        name=f"{name}_empty_ub",
+    )
+    model.addConstr(
+        aggregated_features >= aggregated_features.getAttr("lb") * has_any,
+        name=f"{name}_empty_lb",
+    )
+    return has_neighbors
+
+
+def add_max_aggregation(model, aggregated_features, A, X, name=None):
+    # aggregated_features[i] is the element-wise max over node i's neighbors' features, or 0 if node i has no neighbors (as in PyTorch Geometric)
+    # Its bounds must already be set, see neighbor_aggregation_bounds
+    model.update()
+    n, f = X.shape
+    has_neighbors = add_empty_neighborhood(model, aggregated_features, A, name=name)
+
+    # Row (i, k) of the selection chooses the neighbor j of node i with the largest feature k
+    X_vars, A_vars = np.array(X.tolist()), np.array(A.tolist())
+    add_max_selection(
+        model,
+        np.array(aggregated_features.tolist()).reshape(-1),
+        np.broadcast_to(X_vars.T[np.newaxis, :, :], (n, f, n)).reshape(n * f, n),
+        available=np.broadcast_to(A_vars[:, np.newaxis, :], (n, f, n)).reshape(
+            n * f, n
+        ),
+        selected=np.repeat(np.array(has_neighbors.tolist()), f),
+        name=name,
+    )
+
+
+def add_featurewise_affine_constraint(model, X, scale, shift, name=None):
+    # Returns X * scale + shift, where scale and shift have one value per feature (the second dimension of X)
+    model.update()
+    shape = (1, -1) + (1,) * (len(X.shape) - 2)
+    scale, shift = np.reshape(scale, shape), np.reshape(shift, shape)
+    lb, ub = X.getAttr("lb") * scale, X.getAttr("ub") * scale
+    ts = model.addMVar(
+        X.shape,
+        lb=np.minimum(lb, ub) + shift,
+        ub=np.maximum(lb, ub) + shift,
+        name=f"{name}_t" if name else None,
+    )
+    model.addConstr(
+        ts == X * scale + shift, name=f"{name}_output_constraint" if name else None
+    )
+    return ts
+
+
+def add_masked_features(model, X, node_mask, name=None):
+    # Returns Y with Y[i] == X[i] for active nodes (node_mask[i] == 1) and Y[i] == 0 otherwise, linearized exactly with the bounds of X
+    model.update()
+    lb, ub = X.getAttr("lb"), X.getAttr("ub")
+    mask = node_mask.reshape(-1, 1)
+    masked = model.addMVar(
+        X.shape,
+        lb=np.minimum(lb, 0),
+        ub=np.maximum(ub, 0),
+        name=f"{name}_masked" if name else None,
+    )
+    model.addConstr(masked <= ub * mask)
+    model.addConstr(masked >= lb * mask)
+    model.addConstr(masked <= X - lb * (1 - mask))
+    model.addConstr(masked >= X - ub * (1 - mask))
+    return masked
+
+
+def global_add_pool(model, X, name=None, node_mask=None, **kwargs):
+    # Outputs variables constrained to the sum of node features element-wise, only over active nodes if node_mask is given
+    model.update()
+    if node_mask is not None:
+        X = add_masked_features(model, X, node_mask, name=name)
+        model.update()
     sums = model.addMVar(
         (X.shape[1],),
         lb=X.getAttr("lb").sum(axis=0),
@@ -460,20 +911,69 @@ def global_add_pool(model, X, name=None, **kwargs):
     return sums[np.newaxis, :]
 
 
-def global_mean_pool(model, X, name=None, **kwargs):
+def global_mean_pool(model, X, name=None, node_mask=None, **kwargs):
     # Outputs variables constrained to the mean of node features element-wise
+    # If node_mask is given, the mean is over the active nodes, which have to come first (node_mask is non-increasing)
     model.update()
-    averages = model.addMVar(
-        (X.shape[1],),
-        lb=X.getAttr("lb").mean(axis=0),
-        ub=X.getAttr("ub").mean(axis=0),
-        name=name,
+    if node_mask is None:
+        averages = model.addMVar(
+            (X.shape[1],),
+            lb=X.getAttr("lb").mean(axis=0),
+            ub=X.getAttr("ub").mean(axis=0),
+            name=name,
+        )
+        model.addConstr(
+            averages == gp.quicksum(X) / X.shape[0],
+            name=f"{name}_constraint" if name else None,
+        )
+        return averages[np.newaxis, :]
+
+    # The mean of any subset of nodes is within the bounds of the individual nodes
+    averages_lb, averages_ub = X.getAttr("lb").min(axis=0), X.getAttr("ub").max(axis=0)
+    averages = model.addMVar((X.shape[1],), lb=averages_lb, ub=averages_ub, name=name)
+    masked = add_masked_features(model, X, node_mask, name=name)
+    sums_lb = np.minimum(X.getAttr("lb"), 0).sum(axis=0)
+    sums_ub = np.maximum(X.getAttr("ub"), 0).sum(axis=0)
+    sums = masked.sum(axis=0)
+    num_nodes = X.shape[0]
+    for count in range(1, num_nodes + 1):
+        # Exactly count nodes are active if node count - 1 is active and node count isn't
+        is_count = node_mask[count - 1] - (node_mask[count] if count < num_nodes else 0)
+        # count * averages == sums when is_count is 1, big-M otherwise
+        model.addConstr(
+            count * averages - sums <= (count * averages_ub - sums_lb) * (1 - is_count),
+            name=f"{name}_count_{count}_ub" if name else None,
+        )
+        model.addConstr(
+            count * averages - sums >= (count * averages_lb - sums_ub) * (1 - is_count),
+            name=f"{name}_count_{count}_lb" if name else None,
+        )
+    return averages[np.newaxis, :]
+
+
+def global_max_pool(model, X, name=None, node_mask=None, **kwargs):
+    # Outputs variables constrained to the max of node features element-wise, only over active nodes if node_mask is given
+    model.update()
+    lb, ub = X.getAttr("lb"), X.getAttr("ub")
+    # Nodes that are always part of the graph (only node 0 with a node mask) give a lower bound on the max
+    always_present_lb = lb if node_mask is None else lb[:1]
+    maxes = model.addMVar(
+        (X.shape[1],), lb=always_present_lb.max(axis=0), ub=ub.max(axis=0), name=name
     )
-    model.addConstr(
-        averages == gp.quicksum(X) / X.shape[0],
-        name=f"{name}_constraint" if name else None,
+    model.update()
+    node_vars = np.array(X.tolist()).T
+    add_max_selection(
+        model,
+        np.array(maxes.tolist()),
+        node_vars,
+        available=(
+            None
+            if node_mask is None
+            else np.broadcast_to(np.array(node_mask.tolist()), node_vars.shape)
+        ),
+        name=name,
     )
-    return averages[np.newaxis, :]
+    return maxes[np.newaxis, :]
 
 
 def torch_fc_constraint(model, X, layer, name=None, max_output=None, **kwargs):
@@ -484,77 +984,430 @@ def torch_fc_constraint(model, X, layer, name=None, max_output=None, **kwargs):
         weight = weight[max_output][np.newaxis, :]
         bias = np.atleast_2d(bias[max_output])
 
-    return add_fc_constraint(model, X, W=weight, b=bias, name=name)
+    return add_fc_constraint(model, X, W=get_coefficients(weight), b=bias, name=name)
 
 
 def torch_sage_constraint(model, A, X, layer, name=None, **kwargs):
     # Encodes a PyTorch-Geometric GraphSAGE convolutional layer object based on the input X and A
-    # TODO: Cleanup
-    lin_r_weight = layer.get_parameter("lin_r.weight").cpu().detach().numpy()
-    lin_l_weight = layer.get_parameter("lin_l.weight").cpu().detach().numpy()
-    lin_l_bias = layer.get_parameter("lin_l.bias").cpu().detach().numpy()
+    lin_l_weight = layer.lin_l.weight.cpu().detach().numpy()
+    lin_r_weight = (
+        layer.lin_r.weight.cpu().detach().numpy()
+        if layer.root_weight
+        else np.zeros((lin_l_weight.shape[0], X.shape[1]))
+    )
+    lin_l_bias = (
+        layer.lin_l.bias.cpu().detach().numpy()
+        if layer.lin_l.bias is not None
+        else np.zeros(lin_l_weight.shape[0])
+    )
     lin_weight, lin_bias = None, None
     if layer.project and hasattr(layer, "lin"):
-        lin_weight = layer.get_parameter("lin.weight").cpu().detach().numpy()
-        lin_bias = layer.get_parameter("lin.bias").cpu().detach().numpy()
+        lin_weight = layer.lin.weight.cpu().detach().numpy()
+        lin_bias = layer.lin.bias.cpu().detach().numpy()
     return add_sage_constraint(
         model,
         A,
         X,
-        lin_r_weight=lin_r_weight,
-        lin_l_weight=lin_l_weight,
+        lin_r_weight=get_coefficients(lin_r_weight),
+        lin_l_weight=get_coefficients(lin_l_weight),
         lin_l_bias=lin_l_bias,
         lin_weight=lin_weight,
         lin_bias=lin_bias,
         project=layer.project,
         aggr=layer.aggr,
         name=name,
+        **kwargs,
+    )
+
+
+def torch_relu_constraint(model, X, layer, name=None, **kwargs):
+    # Units of a StableReLU (see simplify.py) that are known to be dead or active don't need a max constraint
+    dead, active = getattr(layer, "dead", None), getattr(layer, "active", None)
+    return add_relu_constraint(
+        model,
+        X,
+        name=name,
+        dead=None if dead is None else dead.cpu().numpy(),
+        active=None if active is None else active.cpu().numpy(),
+        **kwargs,
+    )
+
+
+def torch_gcn_constraint(model, A, X, layer, name=None, **kwargs):
+    # Encodes a PyTorch-Geometric GCNConv layer object based on the input X and A
+    weight = layer.get_parameter("lin.weight").cpu().detach().numpy()
+    bias = (
+        layer.get_parameter("bias").cpu().detach().numpy()
+        if layer.bias is not None
+        else np.zeros(weight.shape[0])
+    )
+    if not layer.normalize:
+        return add_gcn_constraint(
+            model,
+            A,
+            X,
+            get_coefficients(weight.T),
+            bias,
+            name=name,
+            outer_approx=kwargs.get("outer_approx"),
+        )
+    self_loop_weight = (2 if layer.improved else 1) if layer.add_self_loops else 0
+    return add_normalized_gcn_constraint(
+        model,
+        A,
+        X,
+        get_coefficients(weight),
+        bias,
+        self_loop_weight=self_loop_weight,
+        name=name,
+        outer_approx=kwargs.get("outer_approx"),
+    )
+
+
+def torch_gin_constraint(model, A, X, layer, name=None, **kwargs):
+    # Encodes a PyTorch-Geometric GINConv layer object: its MLP (a Sequential of encodable layers) applied to (1 + eps) * X + A @ X
+    eps = float(layer.eps)
+    neighbor_sums = add_neighbor_sums(
+        model,
+        A,
+        X,
+        outer_approx=kwargs.get("outer_approx"),
+        name=f"{name}_neighbor_sums",
+    )
+    model.update()
+    self_lb, self_ub = (1 + eps) * X.getAttr("lb"), (1 + eps) * X.getAttr("ub")
+    combined = model.addMVar(
+        X.shape,
+        lb=np.minimum(self_lb, self_ub) + neighbor_sums.getAttr("lb"),
+        ub=np.maximum(self_lb, self_ub) + neighbor_sums.getAttr("ub"),
+        name=f"{name}_combined",
+    )
+    model.addConstr(
+        combined == (1 + eps) * X + neighbor_sums,
+        name=f"{name}_combined_constraint",
+    )
+    output = combined
+    for i, sublayer in enumerate(layer.nn.children()):
+        output = invert_torch_layer(
+            model, sublayer, A=A, X=output, name=f"{name}_nn_{i}", **kwargs
+        )
+    return output
+
+
+def torch_graph_conv_constraint(model, A, X, layer, name=None, **kwargs):
+    # Encodes a PyTorch-Geometric GraphConv layer object, which is a SAGEConv without normalization or projection
+    # lin_rel acts on the aggregated neighbor features and lin_root on the node's own features
+    return add_sage_constraint(
+        model,
+        A,
+        X,
+        lin_r_weight=get_coefficients(
+            layer.get_parameter("lin_root.weight").cpu().detach().numpy()
+        ),
+        lin_l_weight=get_coefficients(
+            layer.get_parameter("lin_rel.weight").cpu().detach().numpy()
+        ),
+        lin_l_bias=layer.get_parameter("lin_rel.bias").cpu().detach().numpy(),
+        aggr="sum" if layer.aggr == "add" else layer.aggr,
+        name=name,
+        **kwargs,
     )
 
 
-def get_cosine_similarity(model, var, vec, name="cosine_similarity"):
+def add_rgcn_constraint(
+    model,
+    A_rel,
+    X,
+    root_weight,
+    relation_weights,
+    bias,
+    aggr="mean",
+    outer_approx=None,
+    name=None,
+    **kwargs,
+):
+    # Returns X @ root_weight.T + sum(aggr(A_rel[r], X) @ relation_weights[r].T) + bias, where aggr is the mean, sum or max over each node's neighbors of relation r
+    # The aggregated features of all relations share one set of bounds, from the loosest adjacency bounds over the relations
+    model.update()
+    num_relations = A_rel.shape[0]
+    aggregated_lb, aggregated_ub = neighbor_aggregation_bounds(
+        A_rel.getAttr("lb").min(axis=0),
+        A_rel.getAttr("ub").max(axis=0),
+        X.getAttr("lb"),
+        X.getAttr("ub"),
+        aggr,
+    )
+    shape = (num_relations,) + tuple(X.shape)
+    aggregated_features = model.addMVar(
+        shape,
+        lb=np.broadcast_to(aggregated_lb, shape),
+        ub=np.broadcast_to(aggregated_ub, shape),
+        name=f"{name}_aggregated_features",
+    )
+    for r in range(num_relations):
+        add_neighbor_aggregation(
+            model,
+            aggregated_features[r],
+            A_rel[r],
+            X,
+            aggr=aggr,
+            outer_approx=outer_approx,
+            name=f"{name}_relation_{r}",
+        )
+
+    terms = [
+        (aggregated_features[r], relation_weights[r]) for r in range(num_relations)
+    ]
+    if root_weight is not None:
+        terms.insert(0, (X, root_weight))
+    # The bounds for the output of the layer will be the sums of the bounds of its addends
+    lower_bounds = np.zeros((X.shape[0], len(bias))) + bias
+    upper_bounds = lower_bounds.copy()
+    for V, W in terms:
+        term_lb, term_ub = get_matmul_bounds(V, W.T)
+        lower_bounds, upper_bounds = lower_bounds + term_lb, upper_bounds + term_ub
+    ts = model.addMVar(
+        (X.shape[0], len(bias)),
+        lb=lower_bounds,
+        ub=upper_bounds,
+        name=f"{name}_t" if name else None,
+    )
+    add_affine_constraint(
+        model, ts, terms, bias, name=f"{name}_output_constraint" if name else None
+    )
+    return ts
+
+
+def rgcn_relation_weights(layer):
+    # Weights (num_relations, in_channels, out_channels) of each relation of a PyTorch-Geometric RGCNConv layer
+    weight = layer.weight.cpu().detach().numpy()
+    if layer.num_bases is not None:
+        # Each relation's weight is a combination of the basis weights
+        comp = layer.comp.cpu().detach().numpy()
+        weight = (comp @ weight.reshape(weight.shape[0], -1)).reshape(
+            (layer.num_relations,) + weight.shape[1:]
+        )
+    elif layer.num_blocks is not None:
+        # Each relation's weight is block diagonal
+        weight = np.stack([sp.block_diag(list(blocks)).toarray() for blocks in weight])
+    return weight
+
+
+def torch_rgcn_constraint(model, X, layer, A_rel=None, name=None, **kwargs):
+    # Encodes a PyTorch-Geometric RGCNConv layer object based on the input X and the adjacency matrices A_rel of each relation (edge type)
+    if A_rel is None:
+        raise ValueError(
+            "RGCNConv layers need one adjacency matrix per relation (A_rel)"
+        )
+    weight = rgcn_relation_weights(layer)
+    bias = (
+        layer.bias.cpu().detach().numpy()
+        if layer.bias is not None
+        else np.zeros(weight.shape[2])
+    )
+    return add_rgcn_constraint(
+        model,
+        A_rel,
+        X,
+        root_weight=(
+            get_coefficients(layer.root.cpu().detach().numpy().T)
+            if layer.root is not None
+            else None
+        ),
+        relation_weights=[get_coefficients(W.T) for W in weight],
+        bias=bias,
+        aggr="sum" if layer.aggr == "add" else layer.aggr,
+        outer_approx=kwargs.get("outer_approx"),
+        name=name,
+    )
+
+
+def get_offset_bounds(var, vec):
+    # Bounds of var - vec, along with the largest magnitude each coordinate can take
+    lb = var.getAttr("lb") - vec
+    ub = var.getAttr("ub") - vec
+    return lb, ub, np.maximum(np.abs(lb), np.abs(ub))
+
+
+def add_offset_vars(model, var, vec, name="offset"):
+    # Returns decision variables constrained to var - vec
+    lb, ub, _ = get_offset_bounds(var, vec)
+    d = model.addMVar(var.shape, lb=lb, ub=ub, name=name)
+    model.addConstr(d == var - vec, name=f"{name}_constr")
+    return d
+
+
+def get_norm_directions(size):
+    # Unit vectors used for the initial outer approximation of a Euclidean norm: +/- each axis and the diagonals
+    directions = np.concatenate([np.eye(size), -np.eye(size)])
+    diagonal = np.ones((1, size)) / np.sqrt(size)
+    return np.concatenate([directions, diagonal, -diagonal])
+
+
+def add_norm_epigraph(
+    model, t, d, method="soc", directions=None, name="norm", outer_approx=None
+):
+    # Constrains t >= ||d||_2, which is exact whenever the objective pushes t down
+    # soc: a single second-order cone constraint
+    # pwl: an outer approximation by the tangent planes t >= g^T d for unit vectors g, refined lazily by outer_approx
+    if method == "pwl" and outer_approx is None:
+        raise ValueError("The pwl norm encoding needs outer_approx to refine it")
+    if method == "soc":
+        d_list = d.tolist()
+        model.addConstr(
+            gp.quicksum(v * v for v in d_list) <= t * t, name=f"{name}_soc_constr"
+        )
+    elif method == "pwl":
+        if directions is None:
+            directions = get_norm_directions(d.shape[0])
+        model.addConstr(directions @ d <= t, name=f"{name}_pwl_constr")
+        outer_approx.add(NormCut(t, d))
+    else:
+        raise ValueError(f"Unknown norm encoding '{method}'")
+
+
+def add_square_epigraph(
+    model, s, d, method="soc", num_breakpoints=8, name="square", outer_approx=None
+):
+    # Constrains s >= ||d||_2^2, which is exact whenever the objective pushes s down
+    # soc: a single rotated cone constraint (d^T d <= s * 1)
+    # pwl: tangent lines of each d_i^2 at breakpoints spread over the bounds of d_i, refined lazily by outer_approx
+    if method == "pwl" and outer_approx is None:
+        raise ValueError("The pwl square encoding needs outer_approx to refine it")
+    if method == "soc":
+        model.addConstr(d @ d <= s, name=f"{name}_soc_constr")
+    elif method == "pwl":
+        lb, ub = d.getAttr("lb"), d.getAttr("ub")
+        squares = model.addMVar(
+            d.shape, lb=0, ub=np.maximum(lb**2, ub**2), name=f"{name}_squares"
+        )
+        breakpoints = np.linspace(lb, ub, num_breakpoints, axis=-1)
+        for k in range(num_breakpoints):
+            p = breakpoints[..., k]
+            model.addConstr(
+                squares >= 2 * p * d - p**2, name=f"{name}_tangent_{k}_constr"
+            )
+        model.addConstr(s >= squares.sum(), name=f"{name}_pwl_constr")
+        outer_approx.add(SquareCut(s, d))
+    else:
+        raise ValueError(f"Unknown square encoding '{method}'")
+
+
+def add_binary_expansion(model, t, t_ub, precision_bits=8, name="expansion"):
+    # Returns (c, w) where c is a fraction in [0, 1] discretized with precision_bits binaries and w = c * t exactly
+    # Each binary-continuous product b_k * t is linearized exactly with big-M constraints
+    scale = 2**precision_bits / (2**precision_bits - 1)
+    weights = scale * 2.0 ** -np.arange(1, precision_bits + 1)
+    bits = model.addMVar((precision_bits,), vtype=GRB.BINARY, name=f"{name}_bits")
+    products = model.addMVar((precision_bits,), lb=0, ub=t_ub, name=f"{name}_products")
+    model.addConstr(products <= t_ub * bits, name=f"{name}_product_ub_1")
+    model.addConstr(products <= t, name=f"{name}_product_ub_2")
+    model.addConstr(products >= t - t_ub * (1 - bits), name=f"{name}_product_lb")
+    c = model.addVar(lb=0, ub=1, name=name)
+    model.addConstr(c == weights @ bits, name=f"{name}_constr")
+    return c, weights @ products
+
+
+def get_cosine_similarity(
+    model,
+    var,
+    vec,
+    name="cosine_similarity",
+    method="soc",
+    precision_bits=8,
+    outer_approx=None,
+):
     # Cosine Similarity between variable var and scalar vec
-    cosine_similarity = model.addVar(lb=0, ub=1, name=name)
+    # nonconvex: u^Tv = |u||v|cos_sim(u,v) with a norm general constraint and a bilinear product
+    # soc/pwl: |u| <= t is a cone (or its outer approximation) and cos_sim * t is linearized with a binary expansion of cos_sim
+    #   This is not a convex reformulation: it adds precision_bits binaries and big-M rows, and cos_sim is rounded down to a multiple
+    #   of 1 / (2^precision_bits - 1), so its value (and the objective) can differ from the true cosine by that much
+    #   Only a lower bound on the similarity, so it is only valid when the similarity is rewarded by the objective
+    vec_magnitude = np.linalg.norm(vec)
+    var_magnitude_ub = np.linalg.norm(
+        np.maximum(np.abs(var.getAttr("lb")), np.abs(var.getAttr("ub")))
+    )
     var_magnitude = model.addVar(
-        lb=0, ub=sum(var.getAttr("ub") ** 2) ** 0.5, name=f"{name}_magnitude"
+        lb=0, ub=var_magnitude_ub, name=f"{name}_magnitude"
     )  # Variables for embedding magnitude, intermediate value in calculation
-    vec_magnitude = np.linalg.norm(vec)
-    # m.addConstr(var_magnitude*var_magnitude == gp.quicksum(var*var), name=f"{name}_magnitude_constr")
-    model.addGenConstrNorm(var_magnitude, var, which=2, name=f"{name}_magnitude_constr")
-    model.addConstr(
-        gp.quicksum(var * vec) == var_magnitude * vec_magnitude * cosine_similarity,
-        name=f"{name}_constr",
-    )  # u^Tv=|u||v|cos_sim(u,v)
+    if method == "nonconvex":
+        cosine_similarity = model.addVar(lb=0, ub=1, name=name)
+        # m.addConstr(var_magnitude*var_magnitude == gp.quicksum(var*var), name=f"{name}_magnitude_constr")
+        model.addGenConstrNorm(
+            var_magnitude, var, which=2, name=f"{name}_magnitude_constr"
+        )
+        model.addConstr(
+            gp.quicksum(var * vec) == var_magnitude * vec_magnitude * cosine_similarity,
+            name=f"{name}_constr",
+        )  # u^Tv=|u||v|cos_sim(u,v)
+    else:
+        add_norm_epigraph(
+            model,
+            var_magnitude,
+            var,
+            method=method,
+            name=f"{name}_magnitude",
+            outer_approx=outer_approx,
+        )
+        cosine_similarity, scaled_magnitude = add_binary_expansion(
+            model, var_magnitude, var_magnitude_ub, precision_bits, name=name
+        )
+        model.addConstr(
+            vec_magnitude * scaled_magnitude <= var @ vec,
+            name=f"{name}_constr",
+        )  # cos_sim(u,v)|u||v| <= u^Tv
     return cosine_similarity, lambda newvec: np.dot(newvec, vec) / (
         norm(newvec) * norm(vec)
     )
 
 
-def get_l2_distance(model, var, vec, name="l2_distance"):
-    ub = np.linalg.norm(
-        np.maximum(
-            var.getAttr("ub").clip(max=0).abs(),
-            np.maximum(var.getAttr("ub").clip(min=0).abs()),
+def get_l2_distance(
+    model, var, vec, name="l2_distance", method="soc", outer_approx=None
+):
+    # nonconvex: l2_dist(u,v)^2 == (u-v)^T(u-v)
+    # soc/pwl: l2_dist(u,v) >= ||u-v||, only exact when the distance is penalized by the objective
+    _, _, max_offsets = get_offset_bounds(var, vec)
+    l2_distance = model.addVar(lb=0, ub=np.linalg.norm(max_offsets), name=name)
+    if method == "nonconvex":
+        model.addConstr(
+            l2_distance * l2_distance == gp.quicksum((vec - var) * (vec - var)),
+            name=f"{name}_constr",
+        )  # l2_dist(u,v)^2 = (u-v)^T(u-v)
+    else:
+        d = add_offset_vars(model, var, vec, name=f"{name}_offset")
+        add_norm_epigraph(
+            model, l2_distance, d, method=method, name=name, outer_approx=outer_approx
         )
-    )
-    l2_distance = model.addVar(lb=0, ub=ub, name=name)
-    model.addConstr(
-        l2_distance * l2_distance == gp.quicksum((vec - var) * (vec - var)),
-        name=f"{name}_constr",
-    )  # l2_dist(u,v)^2 = (u-v)^T(u-v)
     return l2_distance, lambda newvec: norm(newvec - vec)
 
 
-def get_squared_l2_distance(model, var, vec, name="squared_l2_distance"):
-    ub = np.linalg.norm(
-        np.maximum(
-            var.getAttr("ub").clip(max=0).abs(),
-            np.maximum(var.getAttr("ub").clip(min=0).abs()),
+def get_squared_l2_distance(
+    model,
+    var,
+    vec,
+    name="squared_l2_distance",
+    method="soc",
+    num_breakpoints=8,
+    outer_approx=None,
+):
+    # nonconvex: l2_dist(u,v)^2 == (u-v)^T(u-v)
+    # soc/pwl: l2_dist(u,v)^2 >= (u-v)^T(u-v), only exact when the distance is penalized by the objective
+    _, _, max_offsets = get_offset_bounds(var, vec)
+    squared_l2_distance = model.addVar(lb=0, ub=(max_offsets**2).sum(), name=name)
+    if method == "nonconvex":
+        model.addConstr(
+            squared_l2_distance == gp.quicksum((vec - var) * (vec - var)),
+            name=f"{name}_constr",
+        )  # l2_dist(u,v)^2 = (u-v)^T(u-v)
+    else:
+        d = add_offset_vars(model, var, vec, name=f"{name}_offset")
+        add_square_epigraph(
+            model,
+            squared_l2_distance,
+            d,
+            method=method,
+            num_breakpoints=num_breakpoints,
+            name=name,
+            outer_approx=outer_approx,
         )
-    )
-    squared_l2_distance = model.addVar(lb=0, ub=ub, name=name)
-    model.addConstr(
-        squared_l2_distance >= gp.quicksum((vec - var) * (vec - var)),
-        name=f"{name}_constr",
-    )  # l2_dist(u,v)^2 = (u-v)^T(u-v)
     return squared_l2_distance, lambda newvec: norm(newvec - vec) ** 2
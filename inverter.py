@@ -4,7 +4,13 @@ import pickle
 from collections import OrderedDict
 import numpy as np
 import warnings
+import os
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
+from outer_approximation import OuterApproximation
+import invert_utils
 
 
 class ObjectiveTerm:
@@ -16,6 +22,58 @@ class ObjectiveTerm:
         self.required_vars = required_vars
 
 
+def get_var_indices(var):
+    # Index map of an MVar into model.getVars(), stored as a range when the variables are contiguous
+    indices = np.fromiter(
+        (v.index for v in var.reshape(-1).tolist()), dtype=np.int64, count=var.size
+    )
+    if indices.size > 0 and np.array_equal(
+        indices, np.arange(indices[0], indices[0] + indices.size)
+    ):
+        return {"start": int(indices[0]), "shape": var.shape}
+    return {"indices": indices.reshape(var.shape)}
+
+
+def get_mvar_from_indices(all_vars, index_map):
+    # Inverse of get_var_indices, all_vars is model.getVars()
+    if "start" in index_map:
+        start, shape = index_map["start"], index_map["shape"]
+        var_list = all_vars[start : start + int(np.prod(shape))]
+    else:
+        shape = index_map["indices"].shape
+        var_list = [all_vars[i] for i in index_map["indices"].flatten()]
+    return gp.MVar.fromlist(var_list).reshape(shape)
+
+
+def layer_fingerprint(layer):
+    # Identifies a layer by its type, configuration and parameter values
+    fingerprint = hashlib.sha1(repr(layer).encode())
+    for key, value in layer.state_dict().items():
+        fingerprint.update(key.encode())
+        fingerprint.update(value.detach().cpu().numpy().tobytes())
+    return fingerprint.hexdigest()
+
+
+# Relative error histogram bins: one per decade from 1e-12 to 1, with catch-all bins on both ends
+DIVERGENCE_BINS = np.concatenate([[0], np.logspace(-12, 0, 13), [np.inf]])
+
+
+def layer_divergence(nn_values, solver_values, bins=DIVERGENCE_BINS):
+    # Compares the network's values of each layer with the solver's, both are dicts of arrays keyed by layer name
+    # Relative errors are taken with respect to max(|network value|, 1), like the mixed tolerance of np.allclose
+    divergence = dict()
+    for name, solver_value in solver_values.items():
+        nn_value = np.asarray(nn_values[name]).reshape(solver_value.shape)
+        error = np.abs(nn_value - solver_value)
+        relative_error = error / np.maximum(np.abs(nn_value), 1)
+        divergence[name] = {
+            "Max Error": float(error.max(initial=0)),
+            "Max Relative Error": float(relative_error.max(initial=0)),
+            "Relative Error Histogram": np.histogram(relative_error, bins)[0],
+        }
+    return divergence
+
+
 class Inverter:
     def __init__(
         self,
@@ -25,6 +83,9 @@ class Inverter:
         env,
         convert_inputs_func=None,
         model_name="model",
+        outer_approximation=False,
+        solution_hash=None,
+        record_layer_values=False,
     ):
         self.args = args
         self.nn = nn
@@ -41,6 +102,26 @@ class Inverter:
         self.solutions = []
         self.tracked_vars = dict()
         self.input_vars = dict()
+        # If set, encoders replace quadratic terms with linear relaxations that are refined lazily during the solve
+        self.outer_approx = OuterApproximation() if outer_approximation else None
+        # Constraints that are only enforced lazily, like connectivity cuts, independent of the encoders' relaxations
+        self.lazy_constraints = OuterApproximation(node_cuts=False)
+        # Snapshots of the model size taken before each encoded layer (or any other named step), used for incremental builds
+        self.checkpoints = OrderedDict()
+        self.layer_fingerprints = dict()
+        # Names of the encoded layers, in the order they were encoded
+        self.encoded_layers = []
+        # Maps the input variable values of a solution to a key, solutions with an already seen key are skipped by the default callback
+        self.solution_hash = solution_hash
+        self.solution_hashes = set()
+        self.duplicate_count = 0
+        # If set, the default callback stores the solver's values of every layer in each solution, for check_divergence
+        self.record_layer_values = record_layer_values
+        # Name of the input variable with one binary per node that is 1 if the node is part of the graph, see set_node_mask
+        self.node_mask_name = None
+        self.min_nodes = 1
+        # Bounds from relaxation_bound, keyed by (model hash, number of nodes, class, objective)
+        self.relaxation_bounds = dict()
 
     def convert_inputs(self, **kwargs):
         if self.convert_inputs_func is not None:
@@ -56,6 +137,36 @@ class Inverter:
         self.input_vars = input_vars
         self.all_vars.update(input_vars)
 
+    def set_node_mask(self, name, min_nodes=1):
+        # Marks the input variable name as the node mask of a variable size model, encoded for the largest number of nodes
+        # Node level layer values are only compared with the network on the active nodes
+        self.node_mask_name = name
+        self.min_nodes = min_nodes
+        self.set_num_nodes()
+
+    def set_num_nodes(self, num_nodes=None):
+        # Fixes the number of active nodes by changing the bounds of the node mask, the rest of the model is left as it is
+        # With num_nodes=None, any number of nodes between min_nodes and the maximum is allowed
+        node_mask = self.input_vars[self.node_mask_name]
+        max_nodes = node_mask.shape[0]
+        if num_nodes is None:
+            lb, ub = np.arange(max_nodes) < self.min_nodes, np.ones(max_nodes)
+        else:
+            if not 1 <= num_nodes <= max_nodes:
+                raise ValueError(
+                    f"Number of nodes has to be between 1 and {max_nodes}, got {num_nodes}"
+                )
+            lb = ub = np.arange(max_nodes) < num_nodes
+        node_mask.setAttr("lb", lb.astype(float))
+        node_mask.setAttr("ub", ub.astype(float))
+        self.m.update()
+
+    def get_node_rows(self, var, active):
+        # Index of the rows of var that belong to active nodes, all rows if there is no node mask or var isn't node level
+        if active is None or var.shape[0] != len(active):
+            return slice(None)
+        return np.flatnonzero(np.asarray(active).reshape(-1) > 0.5)
+
     # def set_output_vars(self, output_vars):
     #     self.output_vars = output_vars
     #     self.all_vars.update(output_vars)
@@ -68,34 +179,200 @@ class Inverter:
             self.m.write(file_name)
         return file_names if len(file_names) > 1 else file_names[0]
 
-    def save_inverter(self, filename="inverter.pkl"):
+    def save_inverter(self, filename="inverter.pkl", model_file=None):
+        # Saves the model as compressed MPS, along with the variable index ranges of the inputs and each layer's output
+        # Pass model_file=False if the model has already been saved
+        self.m.update()
+        if model_file is None:
+            model_file = f"{self.model_name}.mps.gz"
+        if model_file:
+            self.m.write(model_file)
         everything = dict()
-        everything["output_keys"] = {
-            key: var.varName for key, var in self.output_vars.items()
+        everything["model_file"] = model_file
+        everything["output_vars"] = {
+            key: get_var_indices(var) for key, var in self.output_vars.items()
+        }
+        everything["input_vars"] = {
+            key: get_var_indices(var) for key, var in self.input_vars.items()
         }
-        pickle.dump(everything, open(filename, "wb"))
-
-    def load_inverter(self, filename="inverter.pkl"):
-        everything = pickle.load(open(filename, "rb"))
-        get_var_matrix = np.vectorize(self.m.getVarByName)
-        for key, name_matrix in everything["output_keys"].items():
-            self.output_vars[key] = gp.MVar.fromlist(
-                get_var_matrix(name_matrix).tolist()
+        everything["tracked_vars"] = {
+            key: get_var_indices(var) for key, var in self.tracked_vars.items()
+        }
+        with open(filename, "wb") as f:
+            pickle.dump(everything, f)
+
+    def load_inverter(
+        self, filename="inverter.pkl", load_model=True, input_shapes=None
+    ):
+        # Variable order is preserved by MPS files, so each MVar is a slice of getVars()
+        # input_shapes (name -> shape) is only used for files in the older format, which don't store the input variables
+        with open(filename, "rb") as f:
+            everything = pickle.load(f)
+        if "output_keys" in everything:
+            # Older files store matrices of variable names, and the model was saved separately by save_model
+            if input_shapes is None:
+                raise ValueError(
+                    f"{filename} is in the older format without input variables, pass their shapes as input_shapes"
+                )
+            if load_model:
+                self.load_model(f"{self.model_name}.mps")
+            self.m.update()
+            get_var_matrix = np.vectorize(self.m.getVarByName)
+            for key, name_matrix in everything["output_keys"].items():
+                self.output_vars[key] = gp.MVar.fromlist(
+                    get_var_matrix(name_matrix).tolist()
+                )
+            self.set_input_vars(
+                {
+                    name: self.get_mvar(name, shape)
+                    for name, shape in input_shapes.items()
+                }
             )
+            return
+
+        if load_model and everything["model_file"]:
+            self.load_model(everything["model_file"])
+        self.m.update()
+        all_vars = self.m.getVars()
+        for key, index_map in everything["output_vars"].items():
+            self.output_vars[key] = get_mvar_from_indices(all_vars, index_map)
+        self.set_input_vars(
+            {
+                key: get_mvar_from_indices(all_vars, index_map)
+                for key, index_map in everything["input_vars"].items()
+            }
+        )
+        self.set_tracked_vars(
+            {
+                key: get_mvar_from_indices(all_vars, index_map)
+                for key, index_map in everything["tracked_vars"].items()
+            }
+        )
 
     def load_model(self, file_name="model.mps", input_var_names=[]):
-        self.model = gp.read(file_name)
+        self.model = gp.read(file_name, env=self.env)
         self.m = self.model
         self.set_input_vars(
             {name: self.m.getVarByName(name) for name in input_var_names}
         )
 
     def get_mvar(self, name, shape):
+        # Variables of an MVar are created (and named) contiguously in row-major order, so look up the first and last ones
+        first = self.m.getVarByName(f"{name}[{','.join('0' for _ in shape)}]")
+        last = self.m.getVarByName(f"{name}[{','.join(str(d - 1) for d in shape)}]")
+        size = int(np.prod(shape))
+        if (
+            first is not None
+            and last is not None
+            and last.index - first.index == size - 1
+        ):
+            return get_mvar_from_indices(
+                self.m.getVars(), {"start": first.index, "shape": shape}
+            )
         X = np.empty(shape, dtype=gp.Var)
         for index in product(*[range(d) for d in shape]):
             X[index] = self.m.getVarByName(f"{name}[{','.join(str(i) for i in index)}]")
         return gp.MVar.fromlist(X.tolist())
 
+    def checkpoint(self, name):
+        # Records the current state of the model, so everything added afterwards can be removed with rollback
+        self.m.update()
+        # A checkpoint that is taken again moves to the end, after everything it was taken on top of
+        self.checkpoints.pop(name, None)
+        self.checkpoints[name] = {
+            "NumVars": self.m.NumVars,
+            "NumConstrs": self.m.NumConstrs,
+            "NumQConstrs": self.m.NumQConstrs,
+            "NumGenConstrs": self.m.NumGenConstrs,
+            "NumSOS": self.m.NumSOS,
+            "output_vars": OrderedDict(self.output_vars),
+            "objective_terms": dict(self.objective_terms),
+            "layer_fingerprints": dict(self.layer_fingerprints),
+            "encoded_layers": list(self.encoded_layers),
+            "outer_approx": len(self.outer_approx) if self.outer_approx else 0,
+            "lazy_constraints": len(self.lazy_constraints),
+        }
+
+    def rollback(self, name):
+        # Removes everything that was added to the model after the checkpoint, along with any later checkpoints
+        # The checkpoint itself is kept, so the same suffix can be swapped out repeatedly
+        self.m.update()
+        state = self.checkpoints[name]
+        self.m.remove(self.m.getGenConstrs()[state["NumGenConstrs"] :])
+        self.m.remove(self.m.getQConstrs()[state["NumQConstrs"] :])
+        self.m.remove(self.m.getConstrs()[state["NumConstrs"] :])
+        self.m.remove(self.m.getSOSs()[state["NumSOS"] :])
+        self.m.remove(self.m.getVars()[state["NumVars"] :])
+        self.m.update()
+
+        self.output_vars = OrderedDict(state["output_vars"])
+        self.layer_fingerprints = dict(state["layer_fingerprints"])
+        self.encoded_layers = list(state["encoded_layers"])
+        self.objective_terms = dict(state["objective_terms"])
+        self.objective = gp.quicksum(
+            term.var * term.weight for term in self.objective_terms.values()
+        )
+        self.m.setObjective(self.objective, GRB.MAXIMIZE)
+        if self.outer_approx is not None:
+            del self.outer_approx.relations[state["outer_approx"] :]
+        del self.lazy_constraints.relations[state["lazy_constraints"] :]
+
+        names = list(self.checkpoints.keys())
+        for later_name in names[names.index(name) + 1 :]:
+            del self.checkpoints[later_name]
+
+    def encode_layer(self, name, layer, X, **kwargs):
+        # Encodes a single layer on top of X, checkpointing first so the layer can be re-encoded later
+        self.checkpoint(name)
+        output = invert_utils.invert_torch_layer(
+            self.m,
+            layer,
+            name=name,
+            X=X,
+            outer_approx=self.outer_approx,
+            **kwargs,
+        )
+        self.output_vars[name] = output
+        self.layer_fingerprints[name] = layer_fingerprint(layer)
+        self.encoded_layers.append(name)
+        return output
+
+    def encode_network(self, X, layers=None, **kwargs):
+        # Encodes the layers (by default self.nn.layers) in order on top of the input X
+        # The longest prefix of layers that are unchanged since the last build (same names, in the same order) is reused
+        # Everything encoded after that prefix is rolled back, including layers that were renamed or removed and anything built
+        # on top of the old layers (like the objective), and the rest of the layers are encoded
+        layers = self.nn.layers if layers is None else layers
+        names = list(layers.keys())
+        num_reused = 0
+        while (
+            num_reused < min(len(names), len(self.encoded_layers))
+            and names[num_reused] == self.encoded_layers[num_reused]
+            and self.layer_fingerprints.get(names[num_reused])
+            == layer_fingerprint(layers[names[num_reused]])
+        ):
+            num_reused += 1
+
+        if num_reused < len(self.encoded_layers):
+            self.rollback(self.encoded_layers[num_reused])
+        elif num_reused < len(names) and self.encoded_layers:
+            # New layers are added after the whole old network, so only what was built on top of its last layer goes
+            checkpoint_names = list(self.checkpoints.keys())
+            later = checkpoint_names[
+                checkpoint_names.index(self.encoded_layers[-1]) + 1 :
+            ]
+            if later:
+                self.rollback(later[0])
+
+        previous_layer_output = (
+            self.output_vars[names[num_reused - 1]] if num_reused else X
+        )
+        for name in names[num_reused:]:
+            previous_layer_output = self.encode_layer(
+                name, layers[name], previous_layer_output, **kwargs
+            )
+        return previous_layer_output
+
     def solve(self, callback=None, param_file=None, output_file=None, **kwargs):
         if callback is None:
             callback = self.get_default_callback()
@@ -109,15 +386,189 @@ class Inverter:
             self.m.setParam(param_name, param_value)
 
         self.solutions = []
+        self.solution_hashes = set()
+        self.duplicate_count = 0
         if param_file:
             self.m.read(param_file)
 
+        for relations in [self.outer_approx, self.lazy_constraints]:
+            if relations:
+                relations.set_params(self.m)
+                callback = relations.get_callback(callback)
+
         self.m.optimize(callback)
 
         if output_file:
             with open(self.args.output_file, "wb") as f:
                 pickle.dump(self.solutions, f)
 
+    def solve_size_sweep(self, sizes, callback=None, **kwargs):
+        # Solves the variable size model once for each number of nodes in sizes, only changing the bounds of the node mask in between
+        # Returns the objective, bound, status, runtime and solutions of each size
+        results = OrderedDict()
+        try:
+            for num_nodes in sizes:
+                self.set_num_nodes(num_nodes)
+                self.solve(callback, **kwargs)
+                results[num_nodes] = {
+                    "Objective": self.m.ObjVal if self.m.SolCount else None,
+                    # No size is better than an infeasible one
+                    "Upper Bound": (
+                        self.m.ObjBound
+                        if self.m.Status != GRB.INFEASIBLE
+                        else float("-inf")
+                    ),
+                    "Status": self.m.Status,
+                    "Runtime": self.m.Runtime,
+                    "Solutions": list(self.solutions),
+                }
+        finally:
+            self.set_num_nodes()
+        return results
+
+    def get_no_good_cut(self, input_values):
+        # Constraint that excludes exactly this assignment of the binary input variables
+        binary_vars, values = [], []
+        for name, var in self.input_vars.items():
+            for v, value in zip(
+                var.reshape(-1).tolist(), np.asarray(input_values[name]).flatten()
+            ):
+                if v.VType == GRB.BINARY and v.LB != v.UB:
+                    binary_vars.append(v)
+                    values.append(round(value))
+        return (
+            gp.quicksum(1 - v if value else v for v, value in zip(binary_vars, values))
+            >= 1
+        )
+
+    def enumerate_explanations(
+        self,
+        k,
+        classes=None,
+        objective_func=None,
+        output_name="Output",
+        checkpoint="Objective",
+        callback=None,
+        max_duplicate_cuts=1000,
+        **kwargs,
+    ):
+        # Collects the k best non-isomorphic solutions for each class, with one solve per class on the same encoded model
+        # For each class, everything after the checkpoint is rolled back and replaced with objective_func(self, target_class) (by default the margin objective)
+        # Gurobi's solution pool keeps the k best solutions, and incumbents that are duplicates (by solution_hash) of an earlier one are rejected
+        # with a lazy no-good cut, so isomorphic copies of the same graph don't take up places in the pool
+        # A no-good cut only removes one labeling of a graph, so up to n! relabelings can be found and cut one at a time (symmetry-breaking
+        # constraints of the encoding reduce this but don't rule it out). The solve of a class stops after max_duplicate_cuts cuts, and then
+        # the pool may have fewer than k explanations although more exist
+        if classes is None:
+            classes = range(self.output_vars[output_name].size)
+        if objective_func is None:
+            objective_func = (
+                lambda inverter, target_class: inverter.add_margin_objective(
+                    target_class, output_name=output_name
+                )
+            )
+        solution_hash = self.solution_hash or (
+            lambda **values: hashlib.sha1(
+                b"".join(np.round(value).tobytes() for value in values.values())
+            ).hexdigest()
+        )
+        inner_callback = self.get_default_callback() if callback is None else callback
+        self.m.update()
+        input_vars = list(self.input_vars.items())
+        last_output_key = next(reversed(self.output_vars))
+
+        # The pool parameters only apply to this enumeration, later solves get the previous values back
+        previous_params = {
+            param_name: self.m.getParamInfo(param_name)[2]
+            for param_name in [
+                "PoolSearchMode",
+                "PoolSolutions",
+                "LazyConstraints",
+                "SolutionNumber",
+            ]
+        }
+        explanations = dict()
+        try:
+            for target_class in classes:
+                if checkpoint in self.checkpoints:
+                    self.rollback(checkpoint)
+                objective_func(self, target_class)
+                seen = set()
+                num_no_good_cuts = 0
+
+                def enumeration_callback(model, where):
+                    nonlocal num_no_good_cuts
+                    if where == GRB.Callback.MIPSOL:
+                        values = {
+                            name: model.cbGetSolution(var) for name, var in input_vars
+                        }
+                        key = solution_hash(**values)
+                        if key in seen:
+                            model.cbLazy(self.get_no_good_cut(values))
+                            num_no_good_cuts += 1
+                            if (
+                                max_duplicate_cuts is not None
+                                and num_no_good_cuts >= max_duplicate_cuts
+                            ):
+                                model.terminate()
+                            return
+                        seen.add(key)
+                    inner_callback(model, where)
+
+                self.solve(
+                    enumeration_callback,
+                    PoolSearchMode=2,
+                    PoolSolutions=k,
+                    LazyConstraints=1,
+                    **kwargs,
+                )
+
+                # The pool is sorted by objective value, the lazy cuts should have removed duplicates but they are filtered again in case
+                # a pool solution never went through the callback
+                pool, pool_hashes = [], set()
+                for i in range(self.m.SolCount):
+                    self.m.setParam("SolutionNumber", i)
+                    values = {name: var.Xn for name, var in input_vars}
+                    key = solution_hash(**values)
+                    if key in pool_hashes:
+                        continue
+                    pool_hashes.add(key)
+                    nn_output = (
+                        dict(
+                            self.nn.get_all_layer_outputs(
+                                **self.convert_inputs(**values)
+                            )
+                        )[last_output_key]
+                        .detach()
+                        .numpy()
+                    )
+                    pool.append(
+                        values
+                        | {
+                            "Output": nn_output,
+                            "Objective Value": self.m.PoolObjVal,
+                            "Hash": key,
+                        }
+                    )
+                    if len(pool) == k:
+                        break
+                print(
+                    f"Class {target_class}: {len(pool)} explanations, {num_no_good_cuts} duplicates cut off"
+                )
+                explanations[target_class] = {
+                    "Explanations": pool,
+                    "Upper Bound": self.m.ObjBound if self.m.SolCount else None,
+                    "Duplicates Cut": num_no_good_cuts,
+                    "Duplicate Limit Reached": max_duplicate_cuts is not None
+                    and num_no_good_cuts >= max_duplicate_cuts,
+                    "Status": self.m.Status,
+                    "Solutions": self.solutions,
+                }
+        finally:
+            for param_name, param_value in previous_params.items():
+                self.m.setParam(param_name, param_value)
+        return explanations
+
     def computeIIS(self, output_fname=None):
         if output_fname is None:
             output_fname = f"{self.model_name}.ilp"
@@ -126,38 +577,108 @@ class Inverter:
         print(f"Wrote IIS to {output_fname}")
         return output_fname
 
+    def get_layer_values(self, values):
+        # Splits the values of all output variables (in order) into arrays for each layer
+        splits = np.cumsum([var.size for var in self.output_vars.values()])[:-1]
+        return {
+            name: part.reshape(var.shape)
+            for (name, var), part in zip(
+                self.output_vars.items(), np.split(np.asarray(values), splits)
+            )
+        }
+
+    def check_divergence(self, solutions=None, bins=DIVERGENCE_BINS):
+        # Compares the recorded layer values of solutions (by default self.solutions) with a single batched forward pass
+        # Returns the per-layer errors over all the solutions, see layer_divergence
+        solutions = self.solutions if solutions is None else solutions
+        if not all("Layer Values" in solution for solution in solutions):
+            raise ValueError(
+                "Solutions don't have layer values, set record_layer_values before solving"
+            )
+        inputs = [
+            self.convert_inputs(**{name: solution[name] for name in self.input_vars})
+            for solution in solutions
+        ]
+        if all(list(kwargs.keys()) == ["data"] for kwargs in inputs):
+            # Graphs are batched into one forward pass, node and graph level outputs are concatenated in the same order as the solutions
+            from torch_geometric.data import Batch
+
+            nn_values = {
+                name: value.detach().numpy()
+                for name, value in self.nn.get_all_layer_outputs(
+                    Batch.from_data_list([kwargs["data"] for kwargs in inputs])
+                )
+            }
+        else:
+            all_outputs = [
+                dict(self.nn.get_all_layer_outputs(**kwargs)) for kwargs in inputs
+            ]
+            nn_values = {
+                name: np.concatenate(
+                    [outputs[name].detach().numpy() for outputs in all_outputs]
+                )
+                for name in self.output_vars
+            }
+        solver_values = {
+            name: np.concatenate(
+                [solution["Layer Values"][name] for solution in solutions]
+            )
+            for name in self.output_vars
+        }
+        return layer_divergence(nn_values, solver_values, bins)
+
     def get_default_callback(self):
+        # All output variables are read with a single cbGetSolution call and compared with the forward pass, layer by layer
+        layer_vars = [
+            v for var in self.output_vars.values() for v in var.reshape(-1).tolist()
+        ]
+
         def solver_callback(model, where):
             if where == GRB.Callback.MIP:
                 pass
 
             if where == GRB.Callback.MIPSOL:
-                print("New Solution Found")
                 solution_inputs = {
                     name: model.cbGetSolution(var)
                     for name, var in self.input_vars.items()
                 }
+                # Skip verification and storage of graphs that were already found
+                if self.solution_hash is not None:
+                    key = self.solution_hash(**solution_inputs)
+                    if key in self.solution_hashes:
+                        self.duplicate_count += 1
+                        return
+                    self.solution_hashes.add(key)
+                print("New Solution Found")
 
                 last_output_key = next(reversed(self.output_vars))
 
-                nn_output = (
-                    dict(
-                        self.nn.get_all_layer_outputs(
-                            **self.convert_inputs(**solution_inputs)
-                        )
-                    )[last_output_key]
-                    .detach()
-                    .numpy()
-                )
-                output_var_value = model.cbGetSolution(
-                    self.output_vars[last_output_key]
-                )
-                # breakpoint()
-                divergence = np.abs(nn_output - output_var_value).max()
-                if not np.allclose(nn_output, output_var_value):
-                    "uh oh :("
+                nn_values = {
+                    name: value.detach().numpy()
+                    for name, value in self.nn.get_all_layer_outputs(
+                        **self.convert_inputs(**solution_inputs)
+                    )
+                }
+                nn_output = nn_values[last_output_key]
+                layer_values = self.get_layer_values(model.cbGetSolution(layer_vars))
+                if self.node_mask_name is not None:
+                    # The network is only evaluated on the active nodes
+                    active = solution_inputs[self.node_mask_name]
+                    layer_values = {
+                        name: values[self.get_node_rows(values, active)]
+                        for name, values in layer_values.items()
+                    }
+                layer_divergences = layer_divergence(nn_values, layer_values)
+                divergence = layer_divergences[last_output_key]["Max Error"]
+                if not np.allclose(nn_output, layer_values[last_output_key]):
+                    # Report the first layer that diverges, later layers inherit its error
+                    first_diverging = next(
+                        name
+                        for name in layer_values
+                        if not np.allclose(nn_values[name], layer_values[name])
+                    )
                     warnings.warn(
-                        f"Model outputs diverge: max difference is {divergence:.3e}",
+                        f"Model outputs diverge: max difference is {divergence:.3e}, starting at layer {first_diverging}",
                         category=RuntimeWarning,
                     )
 
@@ -173,9 +694,9 @@ class Inverter:
 
                 for name, var_value in objective_term_values.items():
                     term = self.objective_terms[name]
-                    if not hasattr(term, "calc"):
+                    if term.hybrid_calc is None:
                         continue
-                    real_value = term.calc(
+                    real_value = term.hybrid_calc(
                         *[
                             self.m.cbGetSolution(req_var)
                             for req_var in term.required_vars
@@ -197,8 +718,14 @@ class Inverter:
                         "Objective Value": self.m.cbGet(GRB.Callback.MIPSOL_OBJ),
                         "Upper Bound": self.m.cbGet(GRB.Callback.MIPSOL_OBJBND),
                         "Divergence": divergence,
+                        "Layer Divergence": {
+                            name: layer["Max Error"]
+                            for name, layer in layer_divergences.items()
+                        },
                     }
                 )
+                if self.record_layer_values:
+                    solution["Layer Values"] = layer_values
                 self.solutions.append(solution)
 
         return solver_callback
@@ -208,66 +735,453 @@ class Inverter:
         self.objective += term.var * term.weight
         self.m.setObjective(self.objective, GRB.MAXIMIZE)
 
-    def warm_start(self, input_var_values, debug_mode=False):
-        self.m.NumStart = 1
+    def remove_objective_term(self, name):
+        # The term's variables and constraints stay in the model, use checkpoint/rollback to remove them as well
+        del self.objective_terms[name]
+        self.objective = gp.quicksum(
+            term.var * term.weight for term in self.objective_terms.values()
+        )
+        self.m.setObjective(self.objective, GRB.MAXIMIZE)
+
+    def add_margin_objective(
+        self, target_class, output_name="Output", name="margin", disjunctive=True
+    ):
+        # Maximizes the target logit minus the largest competing logit
+        # The largest competitor is an explicit big-M disjunction over the output bounds, rather than a general max constraint
+        # Without the disjunction, other_outputs_max is only an upper bound, which is exact as long as it only appears in the objective
+        self.m.update()
+        outputs = self.output_vars[output_name].reshape(-1).tolist()
+        lb = np.array([var.LB for var in outputs])
+        ub = np.array([var.UB for var in outputs])
+
+        competitors = [j for j in range(len(outputs)) if j != target_class]
+        # Competitors whose upper bound is below another competitor's lower bound can never be the max
+        max_lb = lb[competitors].max()
+        competitors = [j for j in competitors if ub[j] >= max_lb]
+        max_ub = ub[competitors].max()
+
+        other_outputs_max = self.m.addVar(
+            lb=max_lb, ub=max_ub, name=f"{name}_other_outputs_max"
+        )
+        for j in competitors:
+            self.m.addConstr(
+                other_outputs_max >= outputs[j], name=f"{name}_geq_output_{j}"
+            )
+        if disjunctive:
+            # is_max[j] indicates the competitor that attains the max
+            is_max = self.m.addVars(
+                competitors, vtype=GRB.BINARY, name=f"{name}_is_max"
+            )
+            self.m.addConstr(is_max.sum() == 1, name=f"{name}_one_max")
+            for j in competitors:
+                self.m.addConstr(
+                    other_outputs_max
+                    <= outputs[j] + (max_ub - lb[j]) * (1 - is_max[j]),
+                    name=f"{name}_leq_output_{j}",
+                )
+
+        self.add_objective_term(
+            ObjectiveTerm("Target Class Output", outputs[target_class])
+        )
+        self.add_objective_term(
+            ObjectiveTerm("Max Non-Target Class Output", other_outputs_max, weight=-1)
+        )
+        return other_outputs_max
+
+    def solve_margin_subproblems(
+        self, target_class, output_name="Output", max_workers=None, **kwargs
+    ):
+        # For each competitor j, maximizes the target logit minus logit j on a separate copy of the model, in parallel
+        # The smallest subproblem bound is an upper bound on the margin, the best margin among their solutions is a lower bound
+        # Subproblems get the parameters of the model, the cores split evenly between them, and then kwargs
+        if self.has_lazy_relations():
+            raise ValueError(
+                "Lazy constraints live in the main process, use a connectivity encoding without them and no outer approximation"
+            )
+        self.m.update()
+        output_indices = [
+            var.index for var in self.output_vars[output_name].reshape(-1).tolist()
+        ]
+        input_indices = {
+            name: np.array([v.index for v in var.reshape(-1).tolist()]).reshape(
+                var.shape
+            )
+            for name, var in self.input_vars.items()
+        }
+        competitors = [j for j in range(len(output_indices)) if j != target_class]
+        max_workers = max_workers or min(len(competitors), os.cpu_count())
+        threads = max(os.cpu_count() // max_workers, 1)
+
+        def solve_subproblem(j):
+            # Gurobi environments are not thread-safe, so each subproblem gets its own
+            with gp.Env(params={"OutputFlag": 0}) as env, gp.read(
+                model_file, env=env
+            ) as sub:
+                sub_vars = sub.getVars()
+                sub.setObjective(
+                    sub_vars[output_indices[target_class]]
+                    - sub_vars[output_indices[j]],
+                    GRB.MAXIMIZE,
+                )
+                sub.read(param_file)
+                sub.setParam("Threads", threads)
+                for param_name, param_value in kwargs.items():
+                    sub.setParam(param_name, param_value)
+                sub.optimize()
+
+                result = {
+                    "Competitor": j,
+                    "Status": sub.Status,
+                    "Upper Bound": (
+                        float("-inf") if sub.Status == GRB.INFEASIBLE else sub.ObjBound
+                    ),
+                }
+                if sub.SolCount > 0:
+                    outputs = np.array(
+                        sub.getAttr("X", [sub_vars[i] for i in output_indices])
+                    )
+                    result["Margin"] = (
+                        outputs[target_class] - np.delete(outputs, target_class).max()
+                    )
+                    result["Inputs"] = {
+                        name: np.array(
+                            sub.getAttr("X", [sub_vars[i] for i in indices.flatten()])
+                        ).reshape(indices.shape)
+                        for name, indices in input_indices.items()
+                    }
+                return result
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Model files don't carry solver parameters, they are written separately
+            model_file = os.path.join(tmp_dir, f"{self.model_name}.mps")
+            param_file = os.path.join(tmp_dir, f"{self.model_name}.prm")
+            self.m.write(model_file)
+            self.m.write(param_file)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(solve_subproblem, competitors))
+
+        solved = [result for result in results if "Margin" in result]
+        best = max(solved, key=lambda result: result["Margin"], default=None)
+        return {
+            "Upper Bound": min(result["Upper Bound"] for result in results),
+            "Lower Bound": best["Margin"] if best else float("-inf"),
+            "Best Inputs": best["Inputs"] if best else None,
+            "Subproblems": results,
+        }
+
+    def has_lazy_relations(self):
+        # Lazy constraints and outer approximation cuts are only added by a callback, so copies of the model don't have them
+        return bool(
+            len(self.lazy_constraints) or (self.outer_approx and len(self.outer_approx))
+        )
+
+    def model_hash(self):
+        # Identifies the encoded model by the network's layers and the size of the model built on top of them
+        self.m.update()
+        fingerprint = hashlib.sha1()
+        for name, layer in self.nn.layers.items():
+            fingerprint.update(name.encode())
+            fingerprint.update(layer_fingerprint(layer).encode())
+        for attr in ["NumVars", "NumConstrs", "NumQConstrs", "NumGenConstrs"]:
+            fingerprint.update(str(self.m.getAttr(attr)).encode())
+        return fingerprint.hexdigest()
+
+    def get_num_nodes(self):
+        # Number of nodes of the encoded graphs, as the smallest and largest number of active nodes if there is a node mask
+        if self.node_mask_name is None:
+            return next(iter(self.input_vars.values())).shape[0]
+        node_mask = self.input_vars[self.node_mask_name]
+        return (
+            int(node_mask.getAttr("lb").sum().round()),
+            int(node_mask.getAttr("ub").sum().round()),
+        )
+
+    def get_nonlinear_vars(self):
+        # Indices of the variables in general constraints and quadratic terms, whose bounds determine how tight the relaxation is
+        self.m.update()
+        indices = set()
+        for genc in self.m.getGenConstrs():
+            if genc.GenConstrType == GRB.GENCONSTR_MAX:
+                res, xs, _ = self.m.getGenConstrMax(genc)
+                indices.update(var.index for var in [res] + xs)
+        for qc in self.m.getQConstrs():
+            row = self.m.getQCRow(qc)
+            for k in range(row.size()):
+                indices.update([row.getVar1(k).index, row.getVar2(k).index])
+        return sorted(indices)
+
+    def build_relaxation(self, lb, ub):
+        # Continuous relaxation of the model with the variable bounds lb and ub (arrays indexed like model.getVars())
+        # Binaries are relaxed to [0, 1], max general constraints to their convex hull over the bounds, bilinear terms to McCormick envelopes
+        # and 2-norm general constraints to second order cones, other general constraints are dropped
+        self.m.update()
+        relaxed = self.m.relax()
+        relaxed.update()
+        rvars = relaxed.getVars()
+        relaxed.setAttr("LB", rvars, lb.tolist())
+        relaxed.setAttr("UB", rvars, ub.tolist())
+
+        norms = []
+        for genc in self.m.getGenConstrs():
+            if genc.GenConstrType == GRB.GENCONSTR_NORM:
+                res, xs, which = self.m.getGenConstrNorm(genc)
+                if which == 2:
+                    norms.append((res.index, [x.index for x in xs]))
+                continue
+            if genc.GenConstrType != GRB.GENCONSTR_MAX:
+                continue
+            res, xs, constant = self.m.getGenConstrMax(genc)
+            t, inputs = rvars[res.index], [x.index for x in xs]
+            for i in inputs:
+                relaxed.addConstr(t >= rvars[i])
+            if constant > -GRB.INFINITY:
+                relaxed.addConstr(t >= constant)
+            if len(inputs) == 1 and constant > -GRB.INFINITY:
+                # Triangle relaxation: the upper side is the line through (lb, constant) and (ub, ub)
+                i = inputs[0]
+                if lb[i] >= constant:
+                    relaxed.addConstr(t <= rvars[i])
+                elif ub[i] <= constant:
+                    relaxed.addConstr(t <= constant)
+                else:
+                    slope = (ub[i] - constant) / (ub[i] - lb[i])
+                    relaxed.addConstr(t <= constant + slope * (rvars[i] - lb[i]))
+            else:
+                # The max is at most its largest upper bound, which is at most x_i plus the gap above x_i's lower bound
+                largest = max([ub[i] for i in inputs] + [constant])
+                for i in inputs:
+                    relaxed.addConstr(t <= rvars[i] + largest - lb[i])
+
+        products = dict()
+
+        def product(i, j):
+            # McCormick envelope of rvars[i] * rvars[j] over their bounds
+            i, j = min(i, j), max(i, j)
+            if (i, j) not in products:
+                x, y = rvars[i], rvars[j]
+                corners = [lb[i] * lb[j], lb[i] * ub[j], ub[i] * lb[j], ub[i] * ub[j]]
+                w = relaxed.addVar(lb=min(corners), ub=max(corners))
+                relaxed.addConstr(w >= lb[j] * x + lb[i] * y - lb[i] * lb[j])
+                relaxed.addConstr(w >= ub[j] * x + ub[i] * y - ub[i] * ub[j])
+                relaxed.addConstr(w <= ub[j] * x + lb[i] * y - lb[i] * ub[j])
+                relaxed.addConstr(w <= lb[j] * x + ub[i] * y - ub[i] * lb[j])
+                products[i, j] = w
+            return products[i, j]
+
+        for qc in relaxed.getQConstrs():
+            row = relaxed.getQCRow(qc)
+            expr = row.getLinExpr()
+            for k in range(row.size()):
+                expr += row.getCoeff(k) * product(
+                    row.getVar1(k).index, row.getVar2(k).index
+                )
+            relaxed.addLConstr(expr, qc.QCSense, qc.QCRHS)
+            relaxed.remove(qc)
+        for res, inputs in norms:
+            relaxed.addConstr(
+                gp.quicksum(rvars[i] * rvars[i] for i in inputs)
+                <= rvars[res] * rvars[res]
+            )
+        relaxed.update()
+        return relaxed
+
+    def relaxation_bound(
+        self,
+        target_class,
+        output_name="Output",
+        objective="margin",
+        obbt_rounds=0,
+        cache_file=None,
+        **kwargs,
+    ):
+        # Certified upper bound on the margin (target logit minus the largest other logit) or on the target logit ("logit")
+        # over every input of the model, from its continuous relaxation (see build_relaxation), without touching the solutions
+        # Each OBBT round tightens the bounds of the nonlinear variables with two LPs each, then the relaxation is rebuilt on the tighter bounds
+        # Bounds are cached by (model hash, number of nodes, class, objective), in cache_file if given, and reused if they had as many OBBT rounds
+        key = (self.model_hash(), self.get_num_nodes(), target_class, objective)
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                self.relaxation_bounds.update(pickle.load(f))
+        cached = self.relaxation_bounds.get(key)
+        if cached is not None and cached["OBBT Rounds"] >= obbt_rounds:
+            return cached
+
+        all_vars = self.m.getVars()
+        lb = np.array(self.m.getAttr("LB", all_vars))
+        ub = np.array(self.m.getAttr("UB", all_vars))
+        runtime, tightened = 0, 0
+        nonlinear = self.get_nonlinear_vars() if obbt_rounds > 0 else []
+        for _ in range(obbt_rounds):
+            relaxed = self.build_relaxation(lb, ub)
+            relaxed.Params.OutputFlag = 0
+            for param_name, param_value in kwargs.items():
+                relaxed.setParam(param_name, param_value)
+            rvars = relaxed.getVars()
+            for i in nonlinear:
+                for sense in [GRB.MINIMIZE, GRB.MAXIMIZE]:
+                    relaxed.setObjective(gp.LinExpr(rvars[i]), sense)
+                    relaxed.optimize()
+                    runtime += relaxed.Runtime
+                    if relaxed.Status != GRB.OPTIMAL:
+                        continue
+                    if sense == GRB.MINIMIZE and relaxed.ObjVal - 1e-6 > lb[i]:
+                        lb[i], tightened = relaxed.ObjVal - 1e-6, tightened + 1
+                    elif sense == GRB.MAXIMIZE and relaxed.ObjVal + 1e-6 < ub[i]:
+                        ub[i], tightened = relaxed.ObjVal + 1e-6, tightened + 1
+            relaxed.dispose()
+
+        relaxed = self.build_relaxation(lb, ub)
+        for param_name, param_value in kwargs.items():
+            relaxed.setParam(param_name, param_value)
+        rvars = relaxed.getVars()
+        outputs = [
+            rvars[var.index]
+            for var in self.output_vars[output_name].reshape(-1).tolist()
+        ]
+        if objective == "margin":
+            # The competitors' max only has lower bounds, the objective pushes it down to the largest competitor
+            other_outputs_max = relaxed.addVar(lb=-GRB.INFINITY)
+            for j, output in enumerate(outputs):
+                if j != target_class:
+                    relaxed.addConstr(other_outputs_max >= output)
+            relaxed.setObjective(
+                outputs[target_class] - other_outputs_max, GRB.MAXIMIZE
+            )
+        elif objective == "logit":
+            relaxed.setObjective(gp.LinExpr(outputs[target_class]), GRB.MAXIMIZE)
+        else:
+            raise ValueError(f"Unknown objective '{objective}'")
+        relaxed.optimize()
+        runtime += relaxed.Runtime
+
+        if relaxed.Status == GRB.INFEASIBLE:
+            upper_bound = float("-inf")
+        elif relaxed.Status == GRB.OPTIMAL:
+            upper_bound = relaxed.ObjVal
+        else:
+            upper_bound = float("inf")
+        result = {
+            "Upper Bound": upper_bound,
+            "Status": relaxed.Status,
+            "Runtime": runtime,
+            "OBBT Rounds": obbt_rounds,
+            "Tightened Bounds": tightened,
+        }
+        relaxed.dispose()
+
+        self.relaxation_bounds[key] = result
+        if cache_file is not None:
+            os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+            with open(cache_file, "wb") as f:
+                pickle.dump(self.relaxation_bounds, f)
+        return result
+
+    def warm_start(
+        self, input_var_values, debug_mode=False, repair=None, tol=1e-8, start_number=0
+    ):
+        # Sets the start values of every layer's output from a forward pass of the network
+        # Start values outside a layer's bounds raise an error, unless repair is "project" (clip the start values into the bounds)
+        # Widening the bounds instead wouldn't help, the constraints built from the old bounds would still exclude the start
+        # The solver keeps several starts, start_number 0 replaces all of them and higher numbers add more starts
+        self.m.update()
+        self.m.NumStart = (
+            1 if start_number == 0 else max(self.m.NumStart, start_number + 1)
+        )
+        self.m.update()
+        self.m.setParam("StartNumber", start_number)
         for input_name, value in input_var_values.items():
             self.input_vars[input_name].Start = value.detach().numpy()
         all_outputs = dict(
             self.nn.get_all_layer_outputs(**self.convert_inputs(**input_var_values))[1:]
         )
 
-        all_ub, all_lb = [], []
         # assert len(all_outputs) == len(self.output_vars), (
         #     len(all_outputs),
         #     len(self.output_vars),
         # )
 
-        for layer_name in self.output_vars.keys():
-            var = self.output_vars[layer_name]
+        bound_violations = OrderedDict()
+        lowest_lb, highest_ub, min_abs_bound = np.inf, -np.inf, np.inf
+        active = (
+            np.asarray(input_var_values[self.node_mask_name])
+            if self.node_mask_name is not None
+            else None
+        )
+        for layer_name, var in self.output_vars.items():
             output = all_outputs[layer_name].detach().numpy()
-
-            # Allows us to check ranges for bounds
-            all_lb.extend(var.getAttr("lb").flatten().tolist())
-            all_ub.extend(var.getAttr("ub").flatten().tolist())
+            # Only the active nodes of a variable size model get start values, the solver completes the rest
+            rows = self.get_node_rows(var, active)
+            full_lb, full_ub = var.getAttr("lb"), var.getAttr("ub")
+            lb, ub = full_lb[rows], full_ub[rows]
 
             # Check variables and ouputs have the same shape
-            assert var.shape == output.shape, (layer_name, var.shape, output.shape)
-            # Check initializations for all variables are geq the lower bounds
-            if not np.less_equal(var.getAttr("lb"), output + 1e-8).all():
-                print(
-                    f'\nERROR: Layer Output Lower than Lower Bounds\nLayer: {layer_name}\nTotal Bound Violations: {np.greater(var.getAttr("lb"), output).sum()} out of {output.size} elements\nLower Bounds:\n{var.getAttr("lb")[np.greater(var.getAttr("lb"), output)]}\nOutputs:\n{output[np.greater(var.getAttr("lb"), output)]}',
-                )
-                raise AssertionError(f"{layer_name} Lower Bound Violation")
+            assert lb.shape == output.shape, (layer_name, var.shape, output.shape)
 
-            # Check initializations for all variables are leq the upper bounds
-            if not np.greater_equal(var.getAttr("ub"), output - 1e-8).all():
-                print(
-                    f'\nERROR: Layer Output Greater than Upper Bounds\nLayer: {layer_name}\nTotal Bound Violations: {np.greater(var.getAttr("lb"), output).sum()} out of {output.size} elements\nLower Bounds:\n{var.getAttr("lb")[np.less(var.getAttr("ub"), output)]}\nOutputs:\n{output[np.less(var.getAttr("ub"), output)]}',
-                )
-                raise AssertionError(f"{layer_name} Upper Bound Violation")
+            # Allows us to check ranges for bounds
+            lowest_lb = min(lowest_lb, lb.min(initial=np.inf))
+            highest_ub = max(highest_ub, ub.max(initial=-np.inf))
+            abs_bounds = np.abs(np.concatenate([lb.ravel(), ub.ravel()]))
+            min_abs_bound = min(
+                min_abs_bound, abs_bounds[abs_bounds > 0].min(initial=np.inf)
+            )
 
-            var.Start = output
+            # Check initializations for all variables are within the bounds
+            below, above = lb - output > tol, output - ub > tol
+            bound_violations[layer_name] = {
+                "Lower Bound Violations": int(below.sum()),
+                "Upper Bound Violations": int(above.sum()),
+                "Max Violation": float(
+                    max((lb - output).max(initial=0), (output - ub).max(initial=0))
+                ),
+                "Size": output.size,
+            }
+            if below.any() or above.any():
+                if repair is None:
+                    print(
+                        f"\nERROR: Layer Output Outside of Bounds\nLayer: {layer_name}\n{bound_violations[layer_name]}",
+                    )
+                    raise AssertionError(f"{layer_name} Bound Violation")
+                elif repair == "project":
+                    output = output.clip(lb, ub)
+                else:
+                    raise ValueError(f"Unknown repair method '{repair}'")
+
+            start = np.full(var.shape, GRB.UNDEFINED)
+            start[rows] = output
+            var.Start = start
 
             if debug_mode:
                 print(f"Fixing Consteraint: {layer_name}")
-                self.m.addConstr(var == output, name=f"fixing_constraint_{layer_name}")
+                self.m.addConstr(
+                    var[rows] == output, name=f"fixing_constraint_{layer_name}"
+                )
 
         self.m.update()
 
-        for term in self.objective_terms:
-            if hasattr(term, "calc"):
-                term.calc(*[req_var.Start for req_var in term.required_vars])
+        for term in self.objective_terms.values():
+            if term.hybrid_calc is not None:
+                term.var.Start = term.hybrid_calc(
+                    *[req_var.Start for req_var in term.required_vars]
+                )
+        self.m.update()
 
         return {
-            "Lowest Lower Bound": min(all_lb),
-            "Highest Upper Bound": max(all_ub),
-            "Min ABS Bound": min([b for b in np.abs(all_lb + all_ub) if b > 0]),
+            "Lowest Lower Bound": lowest_lb,
+            "Highest Upper Bound": highest_ub,
+            "Min ABS Bound": min_abs_bound,
+            "Bound Violations": bound_violations,
         }
 
-    def tune(self, callback=None, **kwargs):
+    def tune(self, prefix="tune", **kwargs):
+        # Runs the solver's parameter tuning once, with kwargs as parameters (like TuneTimeLimit, or a WorkLimit for each trial)
+        # Each tuning result is written to {prefix}{i}.prm, best first, and the file names are returned
+        # Lazy constraints need a callback, which tuning trials don't have, so they tune the model without them
         for param_name, param_value in kwargs.items():
             self.m.setParam(param_name, param_value)
-            self.m.tune()
-            for i in range(self.m.tuneResultCount):
-                self.m.getTuneResult(i)
-                self.m.write("tune" + str(i) + ".prm")
+        self.m.tune()
+        file_names = []
+        for i in range(self.m.TuneResultCount):
+            self.m.getTuneResult(i)
+            file_names.append(f"{prefix}{i}.prm")
+            self.m.write(file_names[-1])
+        return file_names
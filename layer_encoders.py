@@ -0,0 +1,311 @@
+from collections import OrderedDict
+import numpy as np
+from torch.nn import Linear, ReLU, Dropout, Identity, Flatten, Conv2d, MaxPool2d
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch_geometric.nn import SAGEConv, GCNConv, GINConv, GraphConv, RGCNConv
+from torch_geometric.nn.aggr import SumAggregation, MeanAggregation, MaxAggregation
+import invert_utils
+from simplify import (
+    StableReLU,
+    batch_norm_params,
+    get_affine_params,
+    get_term_bounds,
+    interval_affine,
+    neighbor_bounds,
+    propagate_bounds,
+    to_numpy,
+)
+
+
+class LayerEncoder:
+    # Encoding of one torch module type as solver constraints, along with how bounds pass through the module
+    # encode returns the output variables for the input variables X, the other methods return None when they aren't supported
+    # Bounds are on the features of a single node (or sample), valid for every node of a graph with num_nodes nodes
+    # Variable size graphs can have as few as min_nodes nodes (by default exactly num_nodes), the other nodes are inactive
+    def encode(self, model, layer, X, name=None, **kwargs):
+        raise NotImplementedError
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        # Bounds on the output features given bounds on the input features
+        return None
+
+    def symbolic_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        # Linear functions of the input features that bound the output features on [lb, ub], as (W_lower, b_lower, W_upper, b_upper)
+        # with W_lower @ x + b_lower <= layer(x) <= W_upper @ x + b_upper
+        return None
+
+    def stable_units(self, layer, lb, ub):
+        # Masks of the units that are dead (always 0) and active (linear) for inputs in [lb, ub], for activation layers
+        return None
+
+
+class FunctionEncoder(LayerEncoder):
+    # Encodes a layer with a function from invert_utils, called as encode_func(model, layer=layer, X=X, name=name, **kwargs)
+    def __init__(self, encode_func):
+        self.encode_func = encode_func
+
+    def encode(self, model, layer, X, name=None, **kwargs):
+        return self.encode_func(model, layer=layer, X=X, name=name, **kwargs)
+
+
+class AffineEncoder(FunctionEncoder):
+    # Layers with affine parameters (see simplify.get_affine_params), their interval bounds are the sums of the bounds of each term
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        params = get_affine_params(layer)
+        if params is None:
+            return None
+        weights, bias = params
+        out_lb = np.zeros(weights[0][0].shape[0]) if bias is None else to_numpy(bias)
+        out_ub = out_lb.copy()
+        for (W, _), (in_lb, in_ub) in zip(
+            weights, get_term_bounds(layer, lb, ub, num_nodes)
+        ):
+            term_lb, term_ub = interval_affine(to_numpy(W), in_lb, in_ub)
+            out_lb, out_ub = out_lb + term_lb, out_ub + term_ub
+        return out_lb, out_ub
+
+
+class LinearEncoder(AffineEncoder):
+    def __init__(self):
+        super().__init__(invert_utils.torch_fc_constraint)
+
+    def symbolic_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        W = to_numpy(layer.weight)
+        b = np.zeros(W.shape[0]) if layer.bias is None else to_numpy(layer.bias)
+        return W, b, W, b
+
+
+class ReLUEncoder(FunctionEncoder):
+    # Also encodes StableReLUs, whose dead and active units are given instead of derived from bounds
+    def __init__(self):
+        super().__init__(invert_utils.torch_relu_constraint)
+
+    def get_masks(self, layer, lb, ub):
+        dead, active = ub <= 0, lb >= 0
+        if isinstance(layer, StableReLU):
+            dead = dead | layer.dead.cpu().numpy()
+            active = active | layer.active.cpu().numpy()
+        return dead, active & ~dead
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        dead, active = self.get_masks(layer, lb, ub)
+        return (
+            np.where(dead, 0, np.where(active, lb, np.maximum(lb, 0))),
+            np.where(dead, 0, np.maximum(ub, 0)),
+        )
+
+    def symbolic_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        # Triangle relaxation of the unstable units, with the lower bound (0 or x) that has the smaller area
+        dead, active = self.get_masks(layer, lb, ub)
+        unstable = ~dead & ~active
+        width = np.where(unstable, ub - lb, 1)
+        upper_slope = np.where(active, 1, np.where(unstable, ub / width, 0))
+        upper_offset = np.where(unstable, -ub * lb / width, 0)
+        lower_slope = np.where(active | (unstable & (ub > -lb)), 1, 0)
+        return (
+            np.diag(lower_slope.astype(float)),
+            np.zeros(len(lb)),
+            np.diag(upper_slope),
+            upper_offset,
+        )
+
+    def stable_units(self, layer, lb, ub):
+        dead, active = self.get_masks(layer, lb, ub)
+        return {"Dead": dead, "Active": active}
+
+
+class IdentityEncoder(LayerEncoder):
+    # Modules that are the identity at evaluation time, like Dropout, add no variables or constraints
+    def encode(self, model, layer, X, name=None, **kwargs):
+        return X
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        return lb, ub
+
+    def symbolic_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        identity = np.eye(len(lb))
+        return identity, np.zeros(len(lb)), identity, np.zeros(len(lb))
+
+
+class BatchNormEncoder(LayerEncoder):
+    # A BatchNorm at evaluation time scales and shifts each feature, see simplify.fold_batch_norm to fold it into the layer before it
+    def encode(self, model, layer, X, name=None, **kwargs):
+        scale, shift = batch_norm_params(layer)
+        return invert_utils.add_featurewise_affine_constraint(
+            model, X, scale, shift, name=name
+        )
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        scale, shift = batch_norm_params(layer)
+        return (
+            np.minimum(scale * lb, scale * ub) + shift,
+            np.maximum(scale * lb, scale * ub) + shift,
+        )
+
+    def symbolic_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        scale, shift = batch_norm_params(layer)
+        return np.diag(scale), shift, np.diag(scale), shift
+
+
+class PoolEncoder(FunctionEncoder):
+    # Global pooling over the nodes of a graph, sums are up to num_nodes times the features of a single node
+    # The max over the nodes isn't linear in their features, so max pooling (linear=False) only has interval bounds
+    def __init__(self, encode_func, sums=False, linear=True):
+        super().__init__(encode_func)
+        self.sums = sums
+        self.linear = linear
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        if not self.sums:
+            return lb, ub
+        # Only the active nodes are summed, there can be anywhere from min_nodes to num_nodes of them
+        min_nodes = num_nodes if min_nodes is None else min_nodes
+        return (
+            np.minimum(min_nodes * lb, num_nodes * lb),
+            np.maximum(min_nodes * ub, num_nodes * ub),
+        )
+
+    def symbolic_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        # The pooled lower (upper) bound is the mean or sum of the same linear function of each node, which is that function
+        # of the mean of the nodes, and the mean of the nodes is within the bounds of a single node
+        # A sum over a variable number of nodes has no single scale, so it only has interval bounds
+        if not self.linear or (
+            self.sums and min_nodes is not None and min_nodes < num_nodes
+        ):
+            return None
+        scaled = (num_nodes if self.sums else 1) * np.eye(len(lb))
+        return scaled, np.zeros(len(lb)), scaled, np.zeros(len(lb))
+
+
+class GCNEncoder(FunctionEncoder):
+    # The normalized aggregation of a GCNConv is a nonnegative combination of the node's and its neighbors' features,
+    # whose total weight depends on the degrees, so it is within the bounds of a single node scaled by the smallest and largest total weight
+    def __init__(self):
+        super().__init__(invert_utils.torch_gcn_constraint)
+
+    def total_weights(self, layer, num_nodes):
+        # Smallest and largest sum of the aggregation coefficients of a node, over its degree and its neighbors' degrees
+        if not layer.normalize:
+            # Without normalization there are no self loops, and each neighbor has weight 1
+            return 0, num_nodes - 1
+        loop = (2 if layer.improved else 1) if layer.add_self_loops else 0
+        degree = np.arange(num_nodes)
+        node_degree = degree + loop
+        # Nodes with degree 0 are scaled by 0, the neighbors' degrees are between 1 + loop and num_nodes - 1 + loop
+        with np.errstate(divide="ignore", invalid="ignore"):
+            own = np.where(node_degree > 0, loop / node_degree, 0)
+            low = own + np.where(
+                node_degree > 0,
+                degree / np.sqrt(node_degree * (num_nodes - 1 + loop)),
+                0,
+            )
+            high = own + np.where(
+                node_degree > 0, degree / np.sqrt(node_degree * (1 + loop)), 0
+            )
+        return low.min(), high.max()
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        low, high = self.total_weights(layer, num_nodes)
+        aggregated_lb = np.minimum(low * lb, high * lb)
+        aggregated_ub = np.maximum(low * ub, high * ub)
+        out_lb, out_ub = interval_affine(
+            to_numpy(layer.lin.weight), aggregated_lb, aggregated_ub
+        )
+        if layer.bias is not None:
+            out_lb, out_ub = out_lb + to_numpy(layer.bias), out_ub + to_numpy(
+                layer.bias
+            )
+        return out_lb, out_ub
+
+
+class GINEncoder(FunctionEncoder):
+    # The MLP of a GINConv is applied to (1 + eps) times the node's features plus the sum of its neighbors' features
+    def __init__(self):
+        super().__init__(invert_utils.torch_gin_constraint)
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        scale = 1 + float(layer.eps)
+        neighbors_lb, neighbors_ub = neighbor_bounds("sum", lb, ub, num_nodes)
+        combined_lb = np.minimum(scale * lb, scale * ub) + neighbors_lb
+        combined_ub = np.maximum(scale * lb, scale * ub) + neighbors_ub
+        sublayers = OrderedDict(layer.nn.named_children())
+        bounds = propagate_bounds(
+            sublayers, combined_lb, combined_ub, num_nodes, min_nodes=min_nodes
+        )
+        if len(bounds) < len(sublayers):
+            return None
+        return next(reversed(bounds.values()))
+
+
+class RGCNEncoder(FunctionEncoder):
+    # An RGCNConv sums the root term and one aggregation per relation, each with its own weight
+    def __init__(self):
+        super().__init__(invert_utils.torch_rgcn_constraint)
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        weight = invert_utils.rgcn_relation_weights(layer)
+        out_lb = (
+            np.zeros(weight.shape[2]) if layer.bias is None else to_numpy(layer.bias)
+        )
+        out_ub = out_lb.copy()
+        neighbors_lb, neighbors_ub = neighbor_bounds(layer.aggr, lb, ub, num_nodes)
+        terms = [(W.T, neighbors_lb, neighbors_ub) for W in weight]
+        if layer.root is not None:
+            terms.append((to_numpy(layer.root).T, lb, ub))
+        for W, in_lb, in_ub in terms:
+            term_lb, term_ub = interval_affine(W, in_lb, in_ub)
+            out_lb, out_ub = out_lb + term_lb, out_ub + term_ub
+        return out_lb, out_ub
+
+
+class FlattenEncoder(LayerEncoder):
+    def encode(self, model, layer, X, name=None, **kwargs):
+        return invert_utils.flatten(X, name=name)
+
+    def interval_bounds(self, layer, lb, ub, num_nodes, min_nodes=None):
+        return lb.reshape(-1), ub.reshape(-1)
+
+
+# Encoders for each module type, the last registered encoder that matches a module (by isinstance) is used
+LAYER_ENCODERS = OrderedDict()
+
+
+def register_layer_encoder(layer_type, encoder):
+    # Registering an encoder for a type that already has one replaces it, and a subclass registered later takes precedence
+    LAYER_ENCODERS.pop(layer_type, None)
+    LAYER_ENCODERS[layer_type] = encoder
+
+
+def get_layer_encoder(layer):
+    for layer_type, encoder in reversed(LAYER_ENCODERS.items()):
+        if isinstance(layer, layer_type):
+            return encoder
+    return None
+
+
+register_layer_encoder(Linear, LinearEncoder())
+register_layer_encoder(SAGEConv, AffineEncoder(invert_utils.torch_sage_constraint))
+register_layer_encoder(GCNConv, GCNEncoder())
+register_layer_encoder(GINConv, GINEncoder())
+register_layer_encoder(
+    GraphConv, AffineEncoder(invert_utils.torch_graph_conv_constraint)
+)
+register_layer_encoder(RGCNConv, RGCNEncoder())
+register_layer_encoder(ReLU, ReLUEncoder())
+register_layer_encoder(Dropout, IdentityEncoder())
+register_layer_encoder(Identity, IdentityEncoder())
+register_layer_encoder(_BatchNorm, BatchNormEncoder())
+register_layer_encoder(MeanAggregation, PoolEncoder(invert_utils.global_mean_pool))
+register_layer_encoder(
+    SumAggregation, PoolEncoder(invert_utils.global_add_pool, sums=True)
+)
+register_layer_encoder(
+    MaxAggregation, PoolEncoder(invert_utils.global_max_pool, linear=False)
+)
+register_layer_encoder(
+    Conv2d, FunctionEncoder(invert_utils.add_torch_conv2d_constraint)
+)
+register_layer_encoder(
+    MaxPool2d, FunctionEncoder(invert_utils.add_torch_maxpool2d_constraint)
+)
+register_layer_encoder(Flatten, FlattenEncoder())
@@ -0,0 +1,200 @@
+import gurobipy as gp
+from gurobipy import GRB
+import numpy as np
+from numpy.linalg import norm
+
+
+class NormCut:
+    # Refines the outer approximation of t >= ||d||_2 with the tangent plane at a violating point
+    user_cuts = True
+
+    def __init__(self, t, d):
+        self.t = t
+        self.d = d.tolist()
+        self.vars = [t] + self.d
+
+    def separate(self, values, tol):
+        t, d = values[0], values[1:]
+        d_norm = norm(d)
+        if d_norm - t <= tol:
+            return []
+        return [gp.LinExpr((d / d_norm).tolist(), self.d) <= self.t]
+
+
+class SquareCut:
+    # Refines the outer approximation of s >= ||d||_2^2 with the tangent plane at a violating point
+    user_cuts = True
+
+    def __init__(self, s, d):
+        self.s = s
+        self.d = d.tolist()
+        self.vars = [s] + self.d
+
+    def separate(self, values, tol):
+        s, d = values[0], values[1:]
+        if d @ d - s <= tol:
+            return []
+        return [gp.LinExpr((2 * d).tolist(), self.d) - d @ d <= self.s]
+
+
+class MeanAggregationCut:
+    # Enforces aggregated_features * degree == neighbor_sums, given one-hot degree indicators
+    # For each violated entry, adds the big-M constraints that are tight when the incumbent's degree is selected
+    user_cuts = False
+
+    def __init__(self, aggregated_features, neighbor_sums, degrees):
+        self.shape = aggregated_features.shape
+        self.aggregated_features = np.array(aggregated_features.tolist())
+        self.neighbor_sums = np.array(neighbor_sums.tolist())
+        self.degrees = np.array(degrees.tolist())
+        self.agg_lb = aggregated_features.getAttr("lb")
+        self.agg_ub = aggregated_features.getAttr("ub")
+        self.sums_lb = neighbor_sums.getAttr("lb")
+        self.sums_ub = neighbor_sums.getAttr("ub")
+        self.vars = (
+            self.aggregated_features.flatten().tolist()
+            + self.neighbor_sums.flatten().tolist()
+            + self.degrees.flatten().tolist()
+        )
+
+    def separate(self, values, tol):
+        size = self.aggregated_features.size
+        aggregated_features = values[:size].reshape(self.shape)
+        neighbor_sums = values[size : 2 * size].reshape(self.shape)
+        degree = values[2 * size :].reshape(self.degrees.shape).argmax(axis=1)
+
+        violation = np.abs(aggregated_features * degree[:, np.newaxis] - neighbor_sums)
+        # Isolated nodes have no mean, the sums are already zero
+        violation[degree == 0] = 0
+        cuts = []
+        for i, k in zip(*np.nonzero(violation > tol)):
+            d = degree[i]
+            lhs = d * self.aggregated_features[i, k] - self.neighbor_sums[i, k]
+            indicator = self.degrees[i, d]
+            cuts.append(
+                lhs <= (d * self.agg_ub[i, k] - self.sums_lb[i, k]) * (1 - indicator)
+            )
+            cuts.append(
+                lhs >= (d * self.agg_lb[i, k] - self.sums_ub[i, k]) * (1 - indicator)
+            )
+        return cuts
+
+
+def union_find_components(num_nodes, edges):
+    # Labels each node with the root of its connected component, using union-find with path halving
+    parent = list(range(num_nodes))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in edges:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_i] = root_j
+    return np.array([find(i) for i in range(num_nodes)])
+
+
+class ConnectivityCut:
+    # Enforces that the graph with adjacency matrix A is connected (only its active nodes, if node_mask is given)
+    # For each connected component S of a disconnected incumbent, adds the cut-set constraint that some edge leaves S
+    # With a node mask, the cut only applies if some node i in S and some node k outside of it are active
+    user_cuts = False
+
+    def __init__(self, A, node_mask=None):
+        self.A = np.array(A.tolist())
+        self.num_nodes = A.shape[0]
+        self.node_mask = None if node_mask is None else node_mask.tolist()
+        self.vars = self.A.flatten().tolist() + (self.node_mask or [])
+
+    def separate(self, values, tol):
+        num_entries = self.num_nodes * self.num_nodes
+        adjacency = values[:num_entries].reshape(self.num_nodes, self.num_nodes) > 0.5
+        active = (
+            values[num_entries:] > 0.5
+            if self.node_mask is not None
+            else np.ones(self.num_nodes, dtype=bool)
+        )
+        labels = union_find_components(self.num_nodes, zip(*np.nonzero(adjacency)))
+        components = np.unique(labels[active])
+        if len(components) <= 1:
+            return []
+        cuts = []
+        for component in components:
+            inside = np.flatnonzero(labels == component)
+            outside = np.flatnonzero(labels != component)
+            leaving_edges = gp.quicksum(
+                self.A[np.ix_(inside, outside)].flatten()
+            ) + gp.quicksum(self.A[np.ix_(outside, inside)].flatten())
+            if self.node_mask is None:
+                cuts.append(leaving_edges >= 1)
+            else:
+                i = inside[active[inside]][0]
+                k = outside[active[outside]][0]
+                cuts.append(leaving_edges >= self.node_mask[i] + self.node_mask[k] - 1)
+        return cuts
+
+
+class OuterApproximation:
+    # Collects nonlinear relations that the encoders replaced with linear relaxations
+    # The relations are refined with lazy constraints (and user cuts, where valid) in a solver callback
+    def __init__(self, tol=1e-6, node_cuts=True):
+        self.relations = []
+        self.tol = tol
+        self.node_cuts = node_cuts
+        self.num_lazy_constraints = 0
+        self.num_user_cuts = 0
+
+    def __len__(self):
+        return len(self.relations)
+
+    def add(self, relation):
+        self.relations.append(relation)
+        return relation
+
+    def set_params(self, model):
+        model.setParam("LazyConstraints", 1)
+        if self.node_cuts:
+            model.setParam("PreCrush", 1)
+
+    def separate(self, relations, values):
+        # values are the solver's values for the concatenated variables of all relations
+        cuts, offset = [], 0
+        for relation in relations:
+            size = len(relation.vars)
+            cuts.extend(relation.separate(values[offset : offset + size], self.tol))
+            offset += size
+        return cuts
+
+    def get_callback(self, callback=None):
+        all_vars = [var for relation in self.relations for var in relation.vars]
+        node_relations = [relation for relation in self.relations if relation.user_cuts]
+        node_vars = [var for relation in node_relations for var in relation.vars]
+
+        def outer_approximation_callback(model, where):
+            if where == GRB.Callback.MIPSOL:
+                values = np.array(model.cbGetSolution(all_vars))
+                cuts = self.separate(self.relations, values)
+                for cut in cuts:
+                    model.cbLazy(cut)
+                self.num_lazy_constraints += len(cuts)
+                if cuts:
+                    # The incumbent is rejected, so it is not reported to the callback
+                    return
+            elif (
+                where == GRB.Callback.MIPNODE
+                and self.node_cuts
+                and node_vars
+                and model.cbGet(GRB.Callback.MIPNODE_STATUS) == GRB.OPTIMAL
+            ):
+                values = np.array(model.cbGetNodeRel(node_vars))
+                cuts = self.separate(node_relations, values)
+                for cut in cuts:
+                    model.cbCut(cut)
+                self.num_user_cuts += len(cuts)
+            if callback is not None:
+                callback(model, where)
+
+        return outer_approximation_callback
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+import numpy as np
+
+
+def to_json(value):
+    # Fallback for values json can't serialize, e.g. arrays in solutions
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def graph_key(A, X):
+    # Identifies a graph by the exact contents of its adjacency and feature matrices
+    return hashlib.sha1(
+        np.ascontiguousarray(np.round(A)).tobytes()
+        + np.ascontiguousarray(np.round(X, 6)).tobytes()
+    ).hexdigest()
+
+
+class LoggingBackend:
+    # Destination for metrics, figures and summaries of a run
+    # Backends are created and used inside the logging process, so their constructors can do slow work like logging in
+    def log(self, metrics):
+        raise NotImplementedError
+
+    def log_figure(self, name, fig):
+        raise NotImplementedError
+
+    def update_summary(self, summary):
+        raise NotImplementedError
+
+    def save_file(self, path, policy="now"):
+        pass
+
+    def log_code(self, root="."):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalFileBackend(LoggingBackend):
+    # Writes metrics as JSON lines, figures as PNG files and the summary and config as JSON to out_dir/run_id
+    def __init__(self, out_dir="results/logs", run_id="run", config=None):
+        self.out_dir = os.path.join(out_dir, run_id)
+        os.makedirs(os.path.join(self.out_dir, "figures"), exist_ok=True)
+        with open(os.path.join(self.out_dir, "config.json"), "w") as f:
+            json.dump(config or {}, f, default=to_json, indent=2)
+        self.metrics_file = open(os.path.join(self.out_dir, "metrics.jsonl"), "a")
+        self.summary = dict()
+        self.num_figures = 0
+
+    def log(self, metrics):
+        self.metrics_file.write(json.dumps(metrics, default=to_json) + "\n")
+        self.metrics_file.flush()
+
+    def log_figure(self, name, fig):
+        fig.savefig(
+            os.path.join(self.out_dir, "figures", f"{name}_{self.num_figures}.png")
+        )
+        self.num_figures += 1
+
+    def update_summary(self, summary):
+        self.summary.update(summary)
+        with open(os.path.join(self.out_dir, "summary.json"), "w") as f:
+            json.dump(self.summary, f, default=to_json, indent=2)
+
+    def close(self):
+        self.metrics_file.close()
+
+
+class WandbBackend(LoggingBackend):
+    # Logs to Weights & Biases, under a run id chosen by the main process
+    def __init__(self, project="GNN-Inverter", run_id=None, config=None):
+        import wandb
+
+        self.wandb = wandb
+        wandb.login()
+        wandb.init(project=project, id=run_id, config=config)
+
+    def log(self, metrics):
+        self.wandb.log(metrics)
+
+    def log_figure(self, name, fig):
+        self.wandb.log({name: self.wandb.Image(fig)})
+
+    def update_summary(self, summary):
+        self.wandb.run.summary.update(summary)
+
+    def save_file(self, path, policy="now"):
+        self.wandb.save(path, policy=policy)
+
+    def log_code(self, root="."):
+        self.wandb.run.log_code(root)
+
+    def close(self):
+        self.wandb.finish()
+
+
+class GraphDrawer:
+    # Picklable wrapper around a dataset's draw_graph, which only needs the dataset's class-level metadata
+    def __init__(self, dataset_name):
+        self.dataset_name = dataset_name
+        self.dataset = None
+
+    def __call__(self, A, X):
+        if self.dataset is None:
+            from datasets import get_dataset_class
+
+            dataset_class = get_dataset_class(self.dataset_name)
+            # Skip __init__, drawing doesn't need the graphs to be loaded
+            self.dataset = dataset_class.__new__(dataset_class)
+        fig, _ = self.dataset.draw_graph(A=A, X=X)
+        return fig
+
+
+def logging_worker(messages, backend_factories, draw_graph, min_figure_interval):
+    # Runs in the logging process: applies messages to every backend, rendering at most one figure per min_figure_interval seconds
+    # If graphs arrive faster than that, only the latest one is rendered once the interval has passed
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    backends = [factory() for factory in backend_factories]
+    pending_graph, last_figure_time = None, -float("inf")
+
+    def render(name, A, X):
+        fig = draw_graph(A, X)
+        for backend in backends:
+            backend.log_figure(name, fig)
+        plt.close(fig)
+
+    while True:
+        wait = max(0, last_figure_time + min_figure_interval - time.monotonic())
+        try:
+            kind, payload = messages.get(timeout=wait if pending_graph else None)
+        except queue.Empty:
+            kind, payload = None, None
+
+        if kind == "graph":
+            # Without draw_graph there is nothing to render
+            if draw_graph is not None:
+                pending_graph = payload
+        elif kind == "close":
+            if pending_graph is not None and draw_graph is not None:
+                render(*pending_graph)
+            for backend in backends:
+                backend.close()
+            return
+        elif kind is not None:
+            method, args = payload
+            for backend in backends:
+                getattr(backend, method)(*args)
+
+        if (
+            pending_graph is not None
+            and time.monotonic() - last_figure_time >= min_figure_interval
+        ):
+            render(*pending_graph)
+            pending_graph, last_figure_time = None, time.monotonic()
+
+
+class ExperimentLogger:
+    # Front end used by the solver process: every call only puts a message on a queue for a background logging process
+    # Metrics are dropped (and counted) rather than blocking when the queue is full
+    # Graphs are deduplicated before being sent, using graph_hash (by default, the exact contents of A and X)
+    def __init__(
+        self,
+        backend_factories,
+        draw_graph=None,
+        min_figure_interval=5.0,
+        max_queue_size=1000,
+        graph_hash=graph_key,
+    ):
+        context = mp.get_context("spawn")
+        self.messages = context.Queue(max_queue_size)
+        self.process = context.Process(
+            target=logging_worker,
+            args=(self.messages, backend_factories, draw_graph, min_figure_interval),
+            daemon=True,
+        )
+        self.process.start()
+        self.draws_graphs = draw_graph is not None
+        self.graph_hash = graph_hash
+        self.graph_hashes = set()
+        self.summary = dict()
+        self.num_dropped = 0
+
+    def _send(self, kind, payload, block=False):
+        try:
+            self.messages.put((kind, payload), block=block)
+        except queue.Full:
+            self.num_dropped += 1
+
+    def log(self, metrics):
+        self._send("call", ("log", (metrics,)))
+
+    def log_graph(self, A, X, name="fig"):
+        # Returns False if the graph was already logged, or can't be drawn because there is no draw_graph
+        if not self.draws_graphs:
+            return False
+        key = self.graph_hash(A, X)
+        if key in self.graph_hashes:
+            return False
+        self.graph_hashes.add(key)
+        self._send("graph", (name, A, X))
+        return True
+
+    def update_summary(self, summary):
+        # The summary is also kept here, so it can be read back without a round trip to the backends
+        self.summary.update(summary)
+        self._send("call", ("update_summary", (summary,)), block=True)
+
+    def save_file(self, path, policy="now"):
+        self._send("call", ("save_file", (path, policy)), block=True)
+
+    def log_code(self, root="."):
+        self._send("call", ("log_code", (root,)), block=True)
+
+    def close(self, timeout=None):
+        self._send("close", None, block=True)
+        self.process.join(timeout)
+        return self.summary
@@ -0,0 +1,482 @@
+import copy
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.nn import Linear, ReLU, Dropout, Identity, Conv2d, ModuleDict
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch_geometric.nn import SAGEConv, GraphConv
+from torch_geometric.nn.aggr import SumAggregation, MeanAggregation, MaxAggregation
+
+# Layers that act on each feature separately, so they don't change which features are always zero
+FEATUREWISE_LAYERS = (
+    ReLU,
+    Dropout,
+    Identity,
+    SumAggregation,
+    MeanAggregation,
+    MaxAggregation,
+)
+
+
+class StableReLU(ReLU):
+    # ReLU whose dead units always output zero and whose active units pass their input through
+    # The encoders only add max constraints for the remaining units
+    def __init__(self, dead, active):
+        super().__init__()
+        self.register_buffer("dead", torch.as_tensor(dead, dtype=torch.bool))
+        self.register_buffer(
+            "active", torch.as_tensor(active, dtype=torch.bool) & ~self.dead
+        )
+
+    def select_units(self, keep):
+        self.dead = self.dead[keep]
+        self.active = self.active[keep]
+
+    def num_unstable(self):
+        return int((~self.dead & ~self.active).sum())
+
+    def forward(self, x):
+        return torch.where(
+            self.active,
+            x,
+            torch.where(self.dead, torch.zeros_like(x), torch.relu(x)),
+        )
+
+
+def get_affine_params(layer):
+    # Weights of an affine layer, each with whether it acts on the aggregated neighbor features (True) or the node's own features, and the bias
+    # Returns None for layers that aren't affine (or aren't supported)
+    if isinstance(layer, Linear):
+        return [(layer.weight, False)], layer.bias
+    if isinstance(layer, SAGEConv) and not layer.project and layer.root_weight:
+        return [
+            (layer.lin_l.weight, True),
+            (layer.lin_r.weight, False),
+        ], layer.lin_l.bias
+    if isinstance(layer, GraphConv):
+        return [
+            (layer.lin_rel.weight, True),
+            (layer.lin_root.weight, False),
+        ], layer.lin_rel.bias
+    return None
+
+
+def get_linear_modules(layer):
+    # Linear modules of an affine graph layer, their numbers of channels change along with the weights
+    if isinstance(layer, SAGEConv):
+        return [layer.lin_l, layer.lin_r]
+    return [layer.lin_rel, layer.lin_root]
+
+
+def to_numpy(param):
+    return param.detach().cpu().numpy()
+
+
+def batch_norm_params(layer):
+    # Scale and shift of each feature of a BatchNorm at evaluation time
+    scale = 1 / np.sqrt(to_numpy(layer.running_var) + layer.eps)
+    if layer.affine:
+        scale = scale * to_numpy(layer.weight)
+    shift = -to_numpy(layer.running_mean) * scale
+    if layer.affine:
+        shift = shift + to_numpy(layer.bias)
+    return scale, shift
+
+
+def set_param(param, value):
+    param.data = torch.as_tensor(value, dtype=param.dtype, device=param.device)
+
+
+def neighbor_bounds(aggr, lb, ub, num_nodes):
+    # Bounds of the aggregated neighbor features, nodes can be isolated so they always include 0
+    if aggr in ["mean", "max"]:
+        return np.minimum(lb, 0), np.maximum(ub, 0)
+    elif aggr in ["sum", "add"]:
+        return num_nodes * np.minimum(lb, 0), num_nodes * np.maximum(ub, 0)
+    raise NotImplementedError(f"No bounds for {aggr} aggregation")
+
+
+def get_term_bounds(layer, lb, ub, num_nodes):
+    # Bounds of the input of each weight matrix of an affine layer
+    return [
+        neighbor_bounds(layer.aggr, lb, ub, num_nodes) if neighbors else (lb, ub)
+        for _, neighbors in get_affine_params(layer)[0]
+    ]
+
+
+def interval_affine(W, lb, ub):
+    # Bounds of W @ x for lb <= x <= ub
+    W_pos, W_neg = W.clip(min=0), W.clip(max=0)
+    return W_pos @ lb + W_neg @ ub, W_pos @ ub + W_neg @ lb
+
+
+def layer_bounds(layer, lb, ub, num_nodes, min_nodes=None):
+    # Bounds of the output features of a layer, given bounds on its input features for every node of a graph with num_nodes nodes
+    # (or between min_nodes and num_nodes active nodes)
+    # Returns None if the layer is not supported, see LayerEncoder.interval_bounds
+    from layer_encoders import get_layer_encoder
+
+    encoder = get_layer_encoder(layer)
+    return (
+        None
+        if encoder is None
+        else encoder.interval_bounds(layer, lb, ub, num_nodes, min_nodes)
+    )
+
+
+def propagate_bounds(
+    layers, input_lb, input_ub, num_nodes, symbolic=False, min_nodes=None
+):
+    # Interval bounds on the output features of each layer, valid for every node of any graph with num_nodes nodes
+    # (or, for variable size graphs, any graph with min_nodes to num_nodes active nodes)
+    # Propagation stops at the first layer that isn't supported
+    # With symbolic, each layer's output is also bounded by linear functions of the input of the first layer in a run of layers
+    # with symbolic bounds (see LayerEncoder.symbolic_bounds), which are tighter than intervals because they keep dependencies
+    from layer_encoders import get_layer_encoder
+
+    bounds = OrderedDict()
+    lb, ub = np.asarray(input_lb, dtype=float), np.asarray(input_ub, dtype=float)
+    linear_bounds = None
+    for name, layer in layers.items():
+        layer_bound = layer_bounds(layer, lb, ub, num_nodes, min_nodes)
+        if layer_bound is None:
+            break
+        out_lb, out_ub = layer_bound
+        transfer = (
+            get_layer_encoder(layer).symbolic_bounds(
+                layer, lb, ub, num_nodes, min_nodes
+            )
+            if symbolic and lb.ndim == 1
+            else None
+        )
+        if transfer is None:
+            linear_bounds = None
+        else:
+            if linear_bounds is None:
+                # The linear functions start as the identity of this layer's input
+                anchor_lb, anchor_ub = lb, ub
+                identity, zeros = np.eye(len(lb)), np.zeros(len(lb))
+                linear_bounds = (identity, zeros, identity, zeros)
+            W_lower, b_lower, W_upper, b_upper = linear_bounds
+            T_lower, c_lower, T_upper, c_upper = transfer
+            # Positive coefficients of the lower bound take the input's lower bound, negative ones its upper bound
+            linear_bounds = (
+                T_lower.clip(min=0) @ W_lower + T_lower.clip(max=0) @ W_upper,
+                T_lower.clip(min=0) @ b_lower + T_lower.clip(max=0) @ b_upper + c_lower,
+                T_upper.clip(min=0) @ W_upper + T_upper.clip(max=0) @ W_lower,
+                T_upper.clip(min=0) @ b_upper + T_upper.clip(max=0) @ b_lower + c_upper,
+            )
+            W_lower, b_lower, W_upper, b_upper = linear_bounds
+            out_lb = np.maximum(
+                out_lb, interval_affine(W_lower, anchor_lb, anchor_ub)[0] + b_lower
+            )
+            out_ub = np.minimum(
+                out_ub, interval_affine(W_upper, anchor_lb, anchor_ub)[1] + b_upper
+            )
+        lb, ub = bounds[name] = out_lb, out_ub
+    return bounds
+
+
+def prune_layer(layer, lb, ub, num_nodes, budget):
+    # Replaces weights w[o, i] by their contribution at the midpoint of input i, w[o, i] * (lb[i] + ub[i]) / 2, which is folded into the bias
+    # This changes output o by at most |w[o, i]| * (ub[i] - lb[i]) / 2, the smallest changes are made first until they add up to budget
+    # Returns the number of pruned weights
+    weights, bias = get_affine_params(layer)
+    if bias is None:
+        return 0
+    term_bounds = get_term_bounds(layer, lb, ub, num_nodes)
+    W = np.concatenate([to_numpy(weight) for weight, _ in weights], axis=1)
+    in_lb = np.concatenate([term_lb for term_lb, _ in term_bounds])
+    in_ub = np.concatenate([term_ub for _, term_ub in term_bounds])
+
+    error = np.abs(W) * (in_ub - in_lb)[np.newaxis, :] / 2
+    error[(W == 0) | ~np.isfinite(error)] = np.inf
+    order = np.argsort(error, axis=1)
+    sorted_error = np.take_along_axis(error, order, axis=1)
+    prune = np.zeros(W.shape, dtype=bool)
+    np.put_along_axis(prune, order, np.cumsum(sorted_error, axis=1) <= budget, axis=1)
+
+    midpoints = np.where(prune.any(axis=0), (in_lb + in_ub) / 2, 0)
+    set_param(bias, to_numpy(bias) + np.where(prune, W, 0) @ midpoints)
+    W[prune] = 0
+    splits = np.cumsum([weight.shape[1] for weight, _ in weights])[:-1]
+    for (weight, _), value in zip(weights, np.split(W, splits, axis=1)):
+        set_param(weight, value)
+    return int(prune.sum())
+
+
+def select_outputs(layer, keep):
+    # Keeps only the output features in keep
+    weights, bias = get_affine_params(layer)
+    for weight, _ in weights:
+        set_param(weight, to_numpy(weight)[keep])
+    if bias is not None:
+        set_param(bias, to_numpy(bias)[keep])
+    if isinstance(layer, Linear):
+        layer.out_features = len(keep)
+    else:
+        layer.out_channels = len(keep)
+        for lin in get_linear_modules(layer):
+            lin.out_channels = len(keep)
+
+
+def select_inputs(layer, keep):
+    # Keeps only the input features in keep
+    weights, _ = get_affine_params(layer)
+    for weight, _ in weights:
+        set_param(weight, to_numpy(weight)[:, keep])
+    if isinstance(layer, Linear):
+        layer.in_features = len(keep)
+    else:
+        layer.in_channels = len(keep)
+        for lin in get_linear_modules(layer):
+            lin.in_channels = len(keep)
+
+
+def remove_dead_neurons(layers, units):
+    # Removes the dead units of each ReLU in units (see stable_units) from the affine layer before it,
+    # along with the inputs of the next affine layer that read them
+    # Returns the number of removed neurons
+    names = list(layers.keys())
+    num_removed = 0
+    for i, name in enumerate(names):
+        if name not in units or i == 0:
+            continue
+        dead = units[name]["Dead"]
+        if dead.ndim != 1 or not dead.any():
+            continue
+        if get_affine_params(layers[names[i - 1]]) is None:
+            continue
+        # The first non featurewise layer after the ReLU consumes the features
+        j = i + 1
+        while j < len(names) and isinstance(layers[names[j]], FEATUREWISE_LAYERS):
+            j += 1
+        if j == len(names) or get_affine_params(layers[names[j]]) is None:
+            continue
+        # If every unit is dead, one is kept so shapes stay valid
+        keep = np.flatnonzero(~dead)
+        keep = keep if len(keep) > 0 else np.array([0])
+        num_removed += len(dead) - len(keep)
+        select_outputs(layers[names[i - 1]], keep)
+        select_inputs(layers[names[j]], keep)
+        for k in range(i, j):
+            if isinstance(layers[names[k]], StableReLU):
+                layers[names[k]].select_units(keep)
+    return num_removed
+
+
+def merge_affine_layers(layers):
+    # Merges each Linear layer into the Linear layer directly after it (keeping the second name), if that doesn't add nonzeros
+    merged = ModuleDict()
+    num_merged = 0
+    for name, layer in layers.items():
+        previous_name = next(reversed(merged.keys()), None)
+        previous = merged[previous_name] if previous_name is not None else None
+        if isinstance(layer, Linear) and isinstance(previous, Linear):
+            W1, W2 = to_numpy(previous.weight), to_numpy(layer.weight)
+            W = W2 @ W1
+            if np.count_nonzero(W) <= np.count_nonzero(W1) + np.count_nonzero(W2):
+                b = np.zeros(W.shape[0]) if layer.bias is None else to_numpy(layer.bias)
+                if previous.bias is not None:
+                    b = b + W2 @ to_numpy(previous.bias)
+                combined = Linear(W.shape[1], W.shape[0]).to(
+                    dtype=layer.weight.dtype, device=layer.weight.device
+                )
+                set_param(combined.weight, W)
+                set_param(combined.bias, b)
+                del merged[previous_name]
+                merged[name] = combined
+                num_merged += 1
+                continue
+        merged[name] = layer
+    return merged, num_merged
+
+
+def fold_batch_norm(layers):
+    # Folds each BatchNorm directly after an affine layer (see get_affine_params) or a Conv2d into that layer's weights and bias
+    # Returns the layers without the folded BatchNorms and their number, BatchNorms that can't be folded are encoded on their own
+    folded = ModuleDict()
+    num_folded = 0
+    for name, layer in layers.items():
+        previous_name = next(reversed(folded.keys()), None)
+        previous = folded[previous_name] if previous_name is not None else None
+        if isinstance(layer, _BatchNorm) and layer.running_var is not None:
+            if isinstance(previous, Conv2d):
+                weights, bias = [(previous.weight, False)], previous.bias
+            elif previous is not None and get_affine_params(previous) is not None:
+                weights, bias = get_affine_params(previous)
+            else:
+                weights, bias = None, None
+            if weights is not None and bias is not None:
+                scale, shift = batch_norm_params(layer)
+                for weight, _ in weights:
+                    set_param(
+                        weight,
+                        to_numpy(weight)
+                        * scale.reshape((-1,) + (1,) * (weight.dim() - 1)),
+                    )
+                set_param(bias, to_numpy(bias) * scale + shift)
+                num_folded += 1
+                continue
+        folded[name] = layer
+    return folded, num_folded
+
+
+def count_nonzeros(layers):
+    return sum(
+        int(np.count_nonzero(to_numpy(weight)))
+        for layer in layers.values()
+        if get_affine_params(layer) is not None
+        for weight, _ in get_affine_params(layer)[0]
+    )
+
+
+def simplify_network(
+    nn,
+    input_lb,
+    input_ub,
+    num_nodes,
+    budget=1e-6,
+    round_decimals=None,
+    min_nodes=None,
+):
+    # Returns a simplified copy of nn to encode instead of nn, along with a report of the changes
+    # input_lb and input_ub bound each input feature, num_nodes is the number of nodes of the encoded graph
+    # (min_nodes the smallest number of active nodes of a variable size graph)
+    # Weights are pruned layer by layer with an error budget per output (see prune_layer), so errors can add up through the layers
+    # Dead neurons and merged layers don't change the network's output, rounding weights to round_decimals decimals does
+    nn = copy.deepcopy(nn)
+    layers = nn.layers
+    report = {"Nonzeros Before": count_nonzeros(layers)}
+
+    with torch.no_grad():
+        layers, report["Folded BatchNorms"] = fold_batch_norm(layers)
+        num_pruned = 0
+        lb, ub = np.asarray(input_lb, dtype=float), np.asarray(input_ub, dtype=float)
+        for layer in layers.values():
+            if get_affine_params(layer) is not None and budget > 0:
+                num_pruned += prune_layer(layer, lb, ub, num_nodes, budget)
+            layer_bound = layer_bounds(layer, lb, ub, num_nodes, min_nodes)
+            if layer_bound is None:
+                break
+            lb, ub = layer_bound
+        report["Pruned Weights"] = num_pruned
+
+        bounds = propagate_bounds(
+            layers, input_lb, input_ub, num_nodes, min_nodes=min_nodes
+        )
+        report["Dead Neurons"] = remove_dead_neurons(
+            layers, stable_units(layers, bounds=bounds)
+        )
+        layers, report["Merged Layers"] = merge_affine_layers(layers)
+
+        if round_decimals is not None:
+            for layer in layers.values():
+                if get_affine_params(layer) is not None:
+                    weights, bias = get_affine_params(layer)
+                    for param in [weight for weight, _ in weights] + [bias]:
+                        if param is not None:
+                            set_param(param, np.round(to_numpy(param), round_decimals))
+
+    nn.layers = layers
+    report["Nonzeros After"] = count_nonzeros(layers)
+    return nn, report
+
+
+def activation_statistics(nn, batches):
+    # Runs nn over the batches and records statistics of the input of each ReLU, for every unit:
+    # the fraction of samples where it is positive, and its min and max
+    # The first dimension of each layer output indexes the samples (nodes for node level layers), the rest are units
+    statistics = dict()
+    nn.eval()
+    with torch.no_grad():
+        for batch in batches:
+            outputs = nn.get_all_layer_outputs(batch)
+            for (_, relu_input), (name, _) in zip(outputs, outputs[1:]):
+                if not isinstance(nn.layers[name], ReLU):
+                    continue
+                x = relu_input.detach().cpu().numpy()
+                if name not in statistics:
+                    statistics[name] = {
+                        "Count": 0,
+                        "Active Count": np.zeros(x.shape[1:], dtype=np.int64),
+                        "Min": np.full(x.shape[1:], np.inf),
+                        "Max": np.full(x.shape[1:], -np.inf),
+                    }
+                layer_statistics = statistics[name]
+                layer_statistics["Count"] += x.shape[0]
+                layer_statistics["Active Count"] += (x > 0).sum(axis=0)
+                layer_statistics["Min"] = np.minimum(
+                    layer_statistics["Min"], x.min(axis=0)
+                )
+                layer_statistics["Max"] = np.maximum(
+                    layer_statistics["Max"], x.max(axis=0)
+                )
+    for layer_statistics in statistics.values():
+        layer_statistics["Active Fraction"] = layer_statistics["Active Count"] / max(
+            layer_statistics["Count"], 1
+        )
+    return statistics
+
+
+def stable_units(layers, bounds=None, statistics=None):
+    # Finds the dead (input always <= 0) and active (input always >= 0) units of each ReLU
+    # With bounds (see propagate_bounds) the units are certified stable, with statistics (see activation_statistics) they were only
+    # stable on the dataset, so treating them as stable changes the network on other inputs
+    from layer_encoders import get_layer_encoder
+
+    names = list(layers.keys())
+    units = OrderedDict()
+    for i, name in enumerate(names):
+        if not isinstance(layers[name], ReLU) or i == 0:
+            continue
+        dead, active = None, None
+        if bounds is not None and names[i - 1] in bounds:
+            certified = get_layer_encoder(layers[name]).stable_units(
+                layers[name], *bounds[names[i - 1]]
+            )
+            dead, active = certified["Dead"], certified["Active"]
+        if statistics is not None and name in statistics:
+            observed_dead = statistics[name]["Max"] <= 0
+            observed_active = statistics[name]["Min"] >= 0
+            dead = observed_dead if dead is None else dead | observed_dead
+            active = observed_active if active is None else active | observed_active
+        if dead is not None:
+            units[name] = {"Dead": dead, "Active": active & ~dead}
+    return units
+
+
+def prune_stable_units(nn, units):
+    # Returns a copy of nn where the ReLUs in units (see stable_units) are StableReLUs, dead units are removed where possible
+    # and ReLUs with only active units are dropped (merging the affine layers around them), along with a report of the changes
+    nn = copy.deepcopy(nn)
+    layers = nn.layers
+    report = {
+        "Nonzeros Before": count_nonzeros(layers),
+        "ReLU Units": sum(int(masks["Dead"].size) for masks in units.values()),
+        "Dead Units": sum(int(masks["Dead"].sum()) for masks in units.values()),
+        "Active Units": sum(int(masks["Active"].sum()) for masks in units.values()),
+    }
+    with torch.no_grad():
+        for name, masks in units.items():
+            layers[name] = StableReLU(masks["Dead"], masks["Active"])
+        report["Removed Neurons"] = remove_dead_neurons(layers, units)
+
+        linear_relus = [
+            name
+            for name, layer in layers.items()
+            if isinstance(layer, StableReLU) and bool(layer.active.all())
+        ]
+        for name in linear_relus:
+            del layers[name]
+        report["Removed ReLU Layers"] = len(linear_relus)
+        layers, report["Merged Layers"] = merge_affine_layers(layers)
+
+    nn.layers = layers
+    report["Unstable Units"] = sum(
+        layer.num_unstable()
+        for layer in layers.values()
+        if isinstance(layer, StableReLU)
+    )
+    report["Nonzeros After"] = count_nonzeros(layers)
+    return nn, report
@@ -0,0 +1,188 @@
+import argparse
+import copy
+import json
+import os
+import tempfile
+from itertools import product
+import numpy as np
+import gurobipy as gp
+from gurobipy import GRB
+import explain_gnn
+
+# Tunes the solver parameters of explain_gnn.py on a set of models of one family (the same network and encoding, for several classes and
+# numbers of nodes), then stores every candidate parameter set with its score so explain_gnn.py can pick the best one (--param_file auto)
+# Candidates are the tuning results of each model on top of the base parameters (--param_file), and the base parameters themselves
+# Arguments that aren't listed below are passed on to explain_gnn.py, for example:
+#   python tuning.py --classes 0 1 --node_counts 6 8 --work_limit 200 -d MUTAG --connectivity flow
+
+DEFAULT_PARAM_FILE = "./tune0.prm"
+
+
+def read_param_file(file_name):
+    # Parameters of a Gurobi .prm file as a dict, numbers are converted to int or float
+    params = dict()
+    with open(file_name) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            name, value = line.split()[:2]
+            for convert in [int, float]:
+                try:
+                    value = convert(value)
+                    break
+                except ValueError:
+                    pass
+            params[name] = value
+    return params
+
+
+def solver_params(args):
+    # Solver parameters of an explain_gnn.py run: args.param_file, or with "auto" the best stored set of its model family
+    # (the default file if the family was never tuned)
+    if args.param_file != "auto":
+        return read_param_file(args.param_file)
+    params = ParameterStore(args.param_store).best(model_family(args))
+    if params is None:
+        print(f"No tuned parameters for this model family, using {DEFAULT_PARAM_FILE}")
+        return read_param_file(DEFAULT_PARAM_FILE)
+    return params
+
+
+def model_family(args):
+    # Models of one family share the network and the encoding, only the explained class and number of nodes differ
+    return "|".join(
+        str(value)
+        for value in [
+            args.dataset_name,
+            args.model_path or f"models/{args.dataset_name}_model.pth",
+            args.connectivity,
+            args.outer_approximation,
+            args.regularizer_encoding,
+            sorted(args.regularizers or []),
+            args.variable_size,
+            args.edge_types,
+            args.simplify,
+            args.stable_units,
+        ]
+    )
+
+
+class ParameterStore:
+    # Tuned parameter sets of each model family with their scores (lower is better), saved as JSON
+    def __init__(self, path="results/parameters.json"):
+        self.path = path
+        self.families = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.families = json.load(f)
+
+    def update(self, family, candidates):
+        # Replaces the stored candidates of a family, scores of different tuning runs aren't comparable
+        self.families[family] = sorted(
+            candidates, key=lambda candidate: candidate["Score"]
+        )
+
+    def best(self, family):
+        # Parameters of the best candidate of the family, or None if the family was never tuned
+        candidates = self.families.get(family)
+        return candidates[0]["Parameters"] if candidates else None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.families, f, indent=2)
+
+
+def evaluate_parameters(inverters, params, work_limit):
+    # Solves every model with params under the work limit, returns the mean work with a penalty for unsolved models
+    # A model that isn't solved to optimality costs the work limit plus its MIP gap (at most 1) times the work limit
+    penalties = []
+    for inverter in inverters:
+        inverter.model.resetParams()
+        inverter.model.reset()
+        inverter.solve(
+            lambda model, where: None,
+            **dict(params, OutputFlag=0, WorkLimit=work_limit),
+        )
+        if inverter.model.Status == GRB.OPTIMAL:
+            penalties.append(inverter.model.Work)
+        else:
+            gap = min(inverter.model.MIPGap, 1) if inverter.model.SolCount else 1
+            penalties.append(work_limit * (1 + gap))
+    return float(np.mean(penalties))
+
+
+def tune_family(inverters, base_params, work_limit, tune_time_limit=None):
+    # Tunes each model on top of the base parameters, then scores every distinct candidate on all the models
+    candidates = [base_params]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, inverter in enumerate(inverters):
+            inverter.model.resetParams()
+            tune_params = dict(base_params, WorkLimit=work_limit)
+            if tune_time_limit is not None:
+                tune_params["TuneTimeLimit"] = tune_time_limit
+            for file_name in inverter.tune(
+                prefix=os.path.join(tmp_dir, f"model_{i}_tune"), **tune_params
+            ):
+                params = dict(base_params, **read_param_file(file_name))
+                # The trial limits are tuning settings, not solver parameters
+                for name in ["WorkLimit", "TuneTimeLimit"]:
+                    params.pop(name, None)
+                candidates.append(params)
+
+    unique = {tuple(sorted(params.items())): params for params in candidates}
+    results = []
+    for params in unique.values():
+        score = evaluate_parameters(inverters, params, work_limit)
+        print(f"Score {score:.2f}: {params}")
+        results.append({"Parameters": params, "Score": score})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tune solver parameters for a family of explain_gnn.py models"
+    )
+    parser.add_argument(
+        "--classes", type=int, nargs="+", default=[0], help="Classes to explain"
+    )
+    parser.add_argument(
+        "--node_counts", type=int, nargs="+", default=[8], help="Numbers of nodes"
+    )
+    parser.add_argument(
+        "--work_limit",
+        type=float,
+        default=100,
+        help="Work units of each tuning trial and each evaluation solve",
+    )
+    parser.add_argument(
+        "--tune_time_limit",
+        type=float,
+        help="Time limit in seconds of the solver's tuning of each model",
+    )
+    args, explain_argv = parser.parse_known_args(argv)
+    base_args = explain_gnn.parse_args(explain_argv)
+    base_params = solver_params(base_args)
+
+    env = gp.Env(logfilename="")
+    inverters = []
+    for target_class, num_nodes in product(args.classes, args.node_counts):
+        model_args = copy.copy(base_args)
+        model_args.max_class, model_args.num_nodes = target_class, num_nodes
+        inverter, _, _ = explain_gnn.build_explanation_model(model_args, env)
+        inverters.append(inverter)
+
+    results = tune_family(inverters, base_params, args.work_limit, args.tune_time_limit)
+    store = ParameterStore(base_args.param_store)
+    store.update(model_family(base_args), results)
+    store.save()
+    print(
+        f"Best parameters for {model_family(base_args)}:",
+        store.best(model_family(base_args)),
+    )
+    return results
+
+
+if __name__ == "__main__":
+    main()